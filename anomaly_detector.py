@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# Incremental RF anomaly detection over the intervals stats_downloader stores:
+#   python anomaly_detector.py [levitan|aws|local|<SQLite file>|parquet:<directory>]  (replays the stored history)
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from stats_store import *
+
+ANOMALY_STATE_FILE = 'anomaly_state.npz'
+DROPOUT_RSSI = -128
+SLOTS_PER_DAY = 96
+# intervals a host needs before it is judged, two days to learn the time of day profile
+WARMUP_INTERVALS = 2 * SLOTS_PER_DAY
+# update rates of the baseline, its spread and the time of day profile. Until a slot was seen
+# 1 / PROFILE_RATE times the profile is a plain average of the days seen
+BASELINE_RATE = 0.02
+SCALE_RATE = 0.02
+PROFILE_RATE = 0.1
+# smallest spread, in dB, a quiet link would flag every 1 dB wiggle otherwise
+MIN_SCALE_DB = 1.0
+# a fade is an interval FADE_Z spreads below the expected level
+FADE_Z = 4.0
+# CUSUM of the standardized residuals, a step is flagged when one side exceeds CUSUM_THRESHOLD
+CUSUM_DRIFT = 1.0
+CUSUM_THRESHOLD = 10.0
+
+STATE_ARRAYS = ['count', 'baseline', 'scale', 'profile', 'cusum_pos', 'cusum_neg', 'last_ts']
+
+
+class AnomalyDetector:
+    """Per host rolling state of the avg RSSI, updated one 15 minute interval at a time.
+
+    Every host has a robust baseline (a Huber clipped moving average), its spread (moving
+    mean absolute deviation), a time of day profile of 96 slots and two CUSUM sums. The
+    state lives in NumPy arrays indexed by host, so a batch of intervals is processed for
+    all the hosts at once, and is saved between runs: history is never recomputed.
+    Flags fades (one interval far below the expected level), step changes (a sustained
+    shift, the baseline then moves to the new level) and -128 dropouts.
+    """
+
+    def __init__(self):
+        self.hosts = {}
+        self.count = np.zeros(0, dtype=np.int64)
+        self.baseline = np.zeros(0)
+        self.scale = np.zeros(0)
+        self.profile = np.zeros((0, SLOTS_PER_DAY))
+        self.cusum_pos = np.zeros(0)
+        self.cusum_neg = np.zeros(0)
+        self.last_ts = np.zeros(0, dtype='datetime64[s]')
+
+    def get_codes(self, hosts):
+        new_hosts = [host for host in pd.unique(hosts) if host not in self.hosts]
+        if new_hosts:
+            n = len(self.hosts)
+            for i, host in enumerate(new_hosts):
+                self.hosts[host] = n + i
+            grow = len(new_hosts)
+            self.count = np.concatenate([self.count, np.zeros(grow, dtype=np.int64)])
+            self.baseline = np.concatenate([self.baseline, np.zeros(grow)])
+            self.scale = np.concatenate([self.scale, np.full(grow, MIN_SCALE_DB)])
+            self.profile = np.concatenate([self.profile, np.zeros((grow, SLOTS_PER_DAY))])
+            self.cusum_pos = np.concatenate([self.cusum_pos, np.zeros(grow)])
+            self.cusum_neg = np.concatenate([self.cusum_neg, np.zeros(grow)])
+            self.last_ts = np.concatenate([self.last_ts, np.full(grow, np.datetime64(0, 's'))])
+        return np.array([self.hosts[host] for host in hosts], dtype=np.int64)
+
+    def update(self, stats):
+        # stats: new rf statistics intervals (host, start_ts, min-rssi, max-rssi), any number per host.
+        # Returns the anomalies found in them
+        columns = ['host', 'start_ts', 'type', 'value', 'expected', 'score']
+        if stats.empty:
+            return pd.DataFrame(columns=columns)
+
+        # an interval still in progress is judged on the next download, with its final values
+        if 'valid' in stats:
+            stats = stats[stats['valid'] != 'no']
+            if stats.empty:
+                return pd.DataFrame(columns=columns)
+        stats = stats.sort_values('start_ts', kind='stable')
+        codes = self.get_codes(stats['host'].to_numpy())
+        ts = stats['start_ts'].to_numpy().astype('datetime64[s]')
+        min_rssi = stats['min-rssi'].to_numpy(dtype=float)
+        value = (min_rssi + stats['max-rssi'].to_numpy(dtype=float)) / 2.0
+        dropout = min_rssi == DROPOUT_RSSI
+        slot = ((ts - ts.astype('datetime64[D]')).astype(np.int64) // (86400 // SLOTS_PER_DAY)) % SLOTS_PER_DAY
+
+        # intervals already seen (overlapping downloads) are skipped
+        new = ts > self.last_ts[codes]
+        codes, ts, value, dropout, slot = codes[new], ts[new], value[new], dropout[new], slot[new]
+
+        # the k-th interval of every host in the batch is processed together, a host appears once per step
+        rank = pd.Series(codes).groupby(codes).cumcount().to_numpy()
+        anomalies = []
+        for r in range(rank.max() + 1 if len(rank) else 0):
+            i = rank == r
+            anomalies += self.step(codes[i], ts[i], value[i], dropout[i], slot[i])
+
+        if not anomalies:
+            return pd.DataFrame(columns=columns)
+        anomalies = pd.concat(anomalies, ignore_index=True)
+        host_names = np.array(list(self.hosts))
+        anomalies['host'] = host_names[anomalies['host'].to_numpy()]
+        return anomalies[columns]
+
+    def step(self, codes, ts, value, dropout, slot):
+        anomalies = []
+        self.last_ts[codes] = ts
+        if dropout.any():
+            anomalies.append(self.get_anomalies('dropout', codes[dropout], ts[dropout], value[dropout],
+                                                self.baseline[codes[dropout]] + self.profile[codes[dropout], slot[dropout]],
+                                                np.zeros(dropout.sum())))
+
+        c, ts, x, slot = codes[~dropout], ts[~dropout], value[~dropout], slot[~dropout]
+        # the first interval of a host sets its level
+        first = self.count[c] == 0
+        self.baseline[c[first]] = x[first]
+
+        profile = self.profile[c, slot]
+        expected = self.baseline[c] + profile
+        residual = x - expected
+        scale = np.maximum(self.scale[c], MIN_SCALE_DB)
+        z = residual / scale
+        warm = self.count[c] >= WARMUP_INTERVALS
+
+        fade = warm & (z < -FADE_Z)
+        cusum_pos = np.maximum(0, self.cusum_pos[c] + np.clip(z, -FADE_Z, FADE_Z) - CUSUM_DRIFT)
+        cusum_neg = np.maximum(0, self.cusum_neg[c] - np.clip(z, -FADE_Z, FADE_Z) - CUSUM_DRIFT)
+        step = warm & ((cusum_pos > CUSUM_THRESHOLD) | (cusum_neg > CUSUM_THRESHOLD))
+        if fade.any():
+            anomalies.append(self.get_anomalies('fade', c[fade], ts[fade], x[fade], expected[fade], z[fade]))
+        if step.any():
+            anomalies.append(self.get_anomalies('step', c[step], ts[step], x[step], expected[step],
+                                                np.where(cusum_pos[step] > cusum_neg[step], cusum_pos[step], -cusum_neg[step])))
+
+        # robust updates: residuals are clipped to one spread, a fade barely moves the baseline
+        clipped = np.clip(residual, -scale, scale)
+        baseline = self.baseline[c] + BASELINE_RATE * clipped
+        # after a step the baseline jumps to the new level and the sums start over
+        baseline[step] = x[step] - profile[step]
+        cusum_pos[step] = 0
+        cusum_neg[step] = 0
+        self.baseline[c] = baseline
+        self.scale[c] += SCALE_RATE * (np.minimum(np.abs(residual), FADE_Z * scale) - self.scale[c])
+        profile_rate = np.maximum(PROFILE_RATE, 1.0 / (self.count[c] // SLOTS_PER_DAY + 1))
+        self.profile[c, slot] = profile + profile_rate * (np.clip(x - baseline, -FADE_Z * scale, FADE_Z * scale) - profile)
+        self.cusum_pos[c] = cusum_pos
+        self.cusum_neg[c] = cusum_neg
+        self.count[c] += 1
+        return anomalies
+
+    def get_anomalies(self, anomaly_type, codes, ts, value, expected, score):
+        return pd.DataFrame({'host': codes, 'start_ts': ts.astype('datetime64[ns]'), 'type': anomaly_type,
+                             'value': value, 'expected': expected, 'score': score})
+
+    def save(self, filename=ANOMALY_STATE_FILE):
+        tmp_filename = filename + '.tmp.npz'
+        np.savez(tmp_filename, hosts=np.array(list(self.hosts), dtype=str),
+                 **{name: getattr(self, name) for name in STATE_ARRAYS})
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename=ANOMALY_STATE_FILE):
+        detector = cls()
+        if os.path.exists(filename):
+            state = np.load(filename)
+            detector.hosts = {host: i for i, host in enumerate(state['hosts'].tolist())}
+            for name in STATE_ARRAYS:
+                setattr(detector, name, state[name])
+        return detector
+
+
+def detect_anomalies(store, rf_stats, state_file=ANOMALY_STATE_FILE):
+    # called with the rf intervals just stored, the anomalies go to the anomaly table
+    detector = AnomalyDetector.load(state_file)
+    anomalies = detector.update(rf_stats)
+    if not anomalies.empty:
+        store.write(RF_ANOMALY_TABLE_NAME, anomalies)
+    detector.save(state_file)
+    print('%s: %d anomalies' % (RF_ANOMALY_TABLE_NAME, len(anomalies)))
+    return anomalies
+
+
+##############################################################################
+##############################################################################
+if __name__ == '__main__':
+    # builds the state and the anomalies from the stored history, host batch by host batch
+    store = open_stats_store(sys.argv[1] if len(sys.argv) > 1 else 'levitan')
+    store.create_tables()
+    hosts = store.get_hosts(RF_STATS_TABLE_NAME)
+    for i in range(0, len(hosts), 500):
+        detect_anomalies(store, store.read(RF_STATS_TABLE_NAME, hosts=hosts[i:i + 500],
+                                           columns=['min-rssi', 'max-rssi']))
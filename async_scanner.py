@@ -0,0 +1,383 @@
+#!/usr/bin/python
+import asyncio
+import codecs
+import errno
+import os
+import re
+import sys
+import time
+
+import scan_cache
+import siklu_api
+from siklu_api import *
+
+# upper bound of concurrently open SSH sessions, every session is one ssh child and one pty fd
+MAX_SESSIONS = 1000
+COMMAND_TIMEOUT_SEC = 30
+
+
+############################################################################
+class AsyncSikluUnit(SikluUnit):
+    """SikluUnit driven from an asyncio event loop.
+
+    The ssh child is still spawned on a pty by pexpect, but its output is read through
+    loop.add_reader() so a single process can wait on thousands of units at once.
+    Prompts, answers and replies are the same as in SikluUnit.
+    """
+
+    def __init__(self, *args, **kwargs):
+        SikluUnit.__init__(self, *args, **kwargs)
+        self.buffer = ''
+        self.before = ''
+        self.after = ''
+        self.eof = False
+        self.data_event = None
+        self.decoder = None
+        self.loop = None
+
+    def disconnect(self):
+        # synchronous cleanup, used by __del__ and when the loop is gone
+        if self.connection is not None:
+            self.stop_reading()
+            try:
+                self.connection.close(force=True)
+            except Exception:
+                pass
+        self.connected = False
+        self.connection = None
+
+    async def disconnect_async(self):
+        if self.connected:
+            try:
+                self.connection.sendline(self.exit)
+                await self.expect([EOF, TIMEOUT], timeout=5)
+            except Exception:
+                pass
+        self.disconnect()
+
+    def start_reading(self):
+        self.buffer = ''
+        self.before = ''
+        self.eof = False
+        self.data_event = asyncio.Event()
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.loop = asyncio.get_running_loop()
+        os.set_blocking(self.connection.child_fd, False)
+        self.loop.add_reader(self.connection.child_fd, self.on_readable)
+
+    def stop_reading(self):
+        if self.loop is not None:
+            try:
+                self.loop.remove_reader(self.connection.child_fd)
+            except Exception:
+                pass
+            self.loop = None
+
+    def on_readable(self):
+        try:
+            data = os.read(self.connection.child_fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # EIO on linux when the child closed the pty
+            if e.errno != errno.EIO:
+                print("[%s] Read error: %s" % (self.host, e))
+            data = b''
+        if data:
+            self.buffer += self.decoder.decode(data)
+        else:
+            self.eof = True
+            self.stop_reading()
+        self.data_event.set()
+
+    async def expect(self, patterns, timeout=COMMAND_TIMEOUT_SEC):
+        # returns the index of the first matching pattern, TIMEOUT and EOF may be passed like in pexpect
+        compiled = [(i, re.compile(p)) for i, p in enumerate(patterns) if isinstance(p, str)]
+        deadline = time.time() + timeout
+
+        while True:
+            best = None
+            for i, regex in compiled:
+                r = regex.search(self.buffer)
+                if r and (best is None or r.start() < best[1].start()):
+                    best = (i, r)
+            if best:
+                i, r = best
+                self.before = self.buffer[:r.start()]
+                self.after = r.group(0)
+                self.buffer = self.buffer[r.end():]
+                return i
+
+            if self.eof:
+                self.before, self.buffer = self.buffer, ''
+                if EOF in patterns:
+                    return patterns.index(EOF)
+                raise EOF('[%s] EOF' % self.host)
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                if TIMEOUT in patterns:
+                    return patterns.index(TIMEOUT)
+                raise TIMEOUT('[%s] Timeout' % self.host)
+
+            self.data_event.clear()
+            try:
+                await asyncio.wait_for(self.data_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def connect_async(self):
+        if self.connected or self.connection is not None:
+            await self.disconnect_async()
+
+        kiss = True
+        start = time.time()
+
+        try:
+            # pexpect's blocking delays around send/close would stall every other session in the loop
+            self.connection = pexpect.spawn(self.get_spawn_cmd())
+            self.connection.delaybeforesend = None
+            self.connection.ptyproc.delayafterclose = 0
+            self.start_reading()
+
+            i = await self.expect([TIMEOUT, self.sshask_newkey, self.sshask_passwd, self.noroutehost],
+                                  timeout=self.connection_timeout)
+
+            if i == 0:  ## Timeout
+                if self.debug:
+                    print("[%s] Connection timeout" % self.host)
+                kiss = False
+            if i == 1:
+                self.connection.sendline(self.sshask_newkey_answer)
+                j = await self.expect([TIMEOUT, self.sshask_passwd], timeout=self.connection_timeout)
+                if j == 0:
+                    if self.debug:
+                        print("[%s] Password incorrect" % self.host)
+                    kiss = False
+            if i == 3:
+                if self.debug:
+                    print("[%s] No route to host" % self.host)
+                kiss = False
+            if kiss:
+                self.connection.sendline(self.passwd)
+                await self.expect([self.prompt2], timeout=self.connection_timeout)
+                self.cli_prompt = self.before.split('\n')[-1].strip() + '>'
+                self.connected = True
+                if self.debug:
+                    print("[%s] Connected successfully" % self.host)
+        except Exception as e:
+            if self.debug:
+                print("[%s] Unexpected error: %s" % (self.host, e))
+
+        if not self.connected:
+            self.disconnect()
+
+        latency.record('connect', self.host, 'connected' if self.connected else 'failed', time.time() - start, start)
+
+    async def send_command_async(self, command, no_wait=False):
+        if self.debug:
+            print('[%s] %s' % (self.host, command))
+        self.connection.sendline(command)
+        if no_wait:
+            return
+
+        with latency.measure('command', self.host, command):
+            await self.expect([self.prompt2])
+        return self.before
+
+    async def send_commands_async(self, commands):
+        # pipelined mode of SikluUnit.send_commands()
+        if self.debug:
+            print('[%s] %s' % (self.host, '; '.join(commands)))
+        self.connection.send(''.join(command + os.linesep for command in commands))
+
+        text = ''
+        start = time.time()
+        deadline = start + COMMAND_TIMEOUT_SEC * len(commands)
+        prompt = re.escape(self.cli_prompt)
+        arrivals = []
+        try:
+            while text.count(self.cli_prompt) < len(commands):
+                await self.expect([prompt], timeout=max(deadline - time.time(), 1))
+                text += self.before + self.after
+                arrivals.append((time.time(), text.count(self.cli_prompt)))
+        finally:
+            latency.record_burst('command', self.host, commands, start, arrivals)
+
+        return self.split_replies(text, commands)
+
+
+############################################################################
+async def parse_commands_async(unit, commands, pipeline=False):
+    if not commands:
+        return []
+
+    # nothing is awaited between parse_text() and reading the values,
+    # so the command objects can be shared between all the sessions
+    replies = None
+    if pipeline:
+        replies = await unit.send_commands_async([command.cmd for command in commands])
+
+    values = []
+    if replies is None:
+        for command in commands:
+            reply = await unit.send_command_async(command.cmd)
+            command.set_connection(unit)
+            values.append(command.parse_text(reply))
+    else:
+        for command, reply in zip(commands, replies):
+            command.set_connection(unit)
+            values.append(command.parse_text(reply))
+
+    return values
+
+
+async def scan_unit_async(unit, commands, pipeline=False, cache=None):
+    # same columns and cache use as siklu_api.scan_unit
+    status = [unit.host, 'scan', True]
+
+    values = cache.lookup(commands) if cache else [None] * len(commands)
+    fresh = [i for i, value in enumerate(values) if value is None]
+    for i, value in zip(fresh, await parse_commands_async(unit, [commands[i] for i in fresh], pipeline)):
+        values[i] = value
+
+    if cache and cache.update(commands, values, fresh):
+        cached = [i for i in range(len(commands)) if i not in fresh]
+        for i, value in zip(cached, await parse_commands_async(unit, [commands[i] for i in cached], pipeline)):
+            values[i] = value
+        cache.update(commands, values, range(len(commands)))
+
+    for value in values:
+        status += value
+    return status
+
+
+async def send_unit_async(unit, command, status_command, lines, no_wait=False):
+    try:
+        for line in lines:
+            await unit.send_command_async(line, no_wait=no_wait)
+        status = [unit.host, status_command, True]
+    except Exception as e:
+        print(e)
+        status = [unit.host, status_command, False, str(e)]
+
+    return status
+
+
+async def run_command_async(unit_):
+    unit = unit_['unit']
+    command = unit_['command']
+
+    if not unit.connected:
+        await unit.connect_async()
+
+    if unit.connected:
+        if not command.startswith('scan') and not command.startswith('upload'):
+            scan_cache.invalidate(unit.host)
+        if command.startswith('upload_sw'):
+            status = await send_unit_async(unit, command, 'copy',
+                                           [siklu_api.get_firmware_command(command.replace('upload_sw', 'copy'))],
+                                           no_wait=True)
+        elif command.startswith('run_sw'):
+            status = await send_unit_async(unit, command, 'run_sw',
+                                           ['copy running-configuration startup-configuration',
+                                            'run sw next-rst %d' % 600,
+                                            'set rollback timeout %d' % 600])
+        elif command.startswith('accept'):
+            status = await send_unit_async(unit, command, 'accept', ['accept sw'])
+        elif command.startswith('scan'):
+            try:
+                cache = (scan_cache.ScanCache(unit.host, siklu_api.get_cache_ttls())
+                         if unit_.get('scan_cache', siklu_api.SCAN_CACHE) else None)
+                status = await scan_unit_async(unit, unit_['scan_commands'],
+                                               unit_.get('pipeline', siklu_api.PIPELINE_SCAN), cache)
+            except Exception as e:
+                print(e)
+                status = [unit.host, 'scan', False, str(e)]
+        elif command.startswith('upload_script'):
+            status = await send_unit_async(unit, command, 'upload_script',
+                                           [command.replace('upload_script', 'copy')], no_wait=True)
+        elif command.startswith('run_script'):
+            status = await send_unit_async(unit, command, 'run_script',
+                                           [command.replace('run_script', 'run')], no_wait=True)
+        elif command.startswith('run_command'):
+            status = await send_unit_async(unit, command, 'run_command',
+                                           [command.replace('run_command ', '')], no_wait=True)
+        else:
+            status = [unit.host, command, False, 'Invalid command']
+        await unit.disconnect_async()
+    else:
+        status = [unit.host, 'scan', False, 'No connection']
+
+    ts = time.strftime('%d-%m-%Y %H:%M:%S', time.localtime())
+    s = ','.join([ts] + [str(x) for x in status])
+    return s
+
+
+async def run_units_async(units, max_sessions, on_reply=None):
+    # replies in completion order, on_reply is called with every reply as soon as it is ready
+    semaphore = asyncio.Semaphore(max_sessions)
+
+    async def run_limited(unit_):
+        async with semaphore:
+            return await run_command_async(unit_)
+
+    replies = []
+    for future in asyncio.as_completed([run_limited(unit_) for unit_ in units]):
+        reply = await future
+        replies.append(reply)
+        if on_reply:
+            on_reply(reply)
+    return replies
+
+
+def units_manager_async(hosts, max_sessions=MAX_SESSIONS, progress_callback=None):
+    # same input and execution log as units_manager_parallel, one process for all the sessions
+    units = []
+
+    scan_commands = get_scan_commands()
+
+    for i, host in hosts.iterrows():
+        unit = AsyncSikluUnit(host['ip'], host['user'], host['password'],
+                              connection_timeout=siklu_api.CONNECTION_TIMEOUT_SEC, debug=False,
+                              spawn_cmd=siklu_api.get_host_spawn_cmd(host['ip']))
+        units.append({'unit': unit, 'command': host['command'], 'scan_commands': scan_commands,
+                      'pipeline': siklu_api.PIPELINE_SCAN})
+
+    filename = get_execution_log_filename()
+    log = ExecutionLogWriter(filename, get_execution_log_header(scan_commands))
+    progress = ScanProgress(len(units), max_sessions)
+    if siklu_api.TIMING_LOG:
+        latency.open_timing_file(filename.replace('execution_log', 'timing_log'))
+
+    def on_reply(reply):
+        log.write(reply)
+        progress.update(reply)
+        if progress_callback:
+            progress_callback(progress)
+
+    units, replies = preflight_units(units)
+    for reply in replies:
+        on_reply(reply)
+
+    try:
+        asyncio.run(run_units_async(units, max_sessions, on_reply))
+    finally:
+        log.close()
+        latency.close_timing_file()
+    record_scan_history(filename)
+    return filename
+
+
+##############################################################################
+##############################################################################
+if __name__ == '__main__':
+    # python async_scanner.py file.ini [max_sessions]
+    load_config(sys.argv[1] if len(sys.argv) > 1 else None)
+    if len(sys.argv) > 2:
+        MAX_SESSIONS = int(sys.argv[2])
+
+    hosts = pd.read_csv(siklu_api.CSV_FILENAME, comment='#')
+    hosts.dropna(subset=['ip', 'user', 'command'], how='any', inplace=True)
+    print(units_manager_async(hosts, MAX_SESSIONS, progress_callback=print_progress))
+    print(latency.report())
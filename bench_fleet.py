@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# Fleet scan benchmark against simulated units (siklu_simulator.py), no hardware needed
+#   python bench_fleet.py [--engine pool|async] [--units 100,1000,10000] [--concurrency 50] [--latency 0.05] ...
+import argparse
+import os
+import sys
+
+import pandas as pd
+
+import siklu_api
+from siklu_api import *
+
+
+def get_hosts(n_units):
+    hosts = [{'ip': '10.%d.%d.%d' % (i // 62500, i // 250 % 250, i % 250 + 1),
+              'user': 'admin', 'password': 'admin', 'command': 'scan'} for i in range(n_units)]
+    return pd.DataFrame(hosts)
+
+
+def get_simulator_cmd(args):
+    simulator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'siklu_simulator.py')
+    cmd = '%s %s {host} --latency %s --jitter %s --loss %s --reply-size %d --dead-rate %s' % (
+        sys.executable, simulator, args.latency, args.jitter, args.loss, args.reply_size, args.dead_rate)
+    if args.connect_delay is not None:
+        cmd += ' --connect-delay %s' % args.connect_delay
+    return cmd
+
+
+def run_fleet(hosts, engine, concurrency):
+    progress = []
+    latency.reset()
+    if engine == 'async':
+        import async_scanner
+        filename = async_scanner.units_manager_async(hosts, concurrency, progress_callback=progress.append)
+    else:
+        siklu_api.N_PROCESSES = concurrency
+        filename = units_manager_parallel(hosts, progress_callback=progress.append)
+    return filename, progress[-1]
+
+
+def report(n_units, filename, progress):
+    # unit latency is the sum of connect, command and parse time of the unit
+    units = latency.host_histogram()
+    connect = latency.phase_histogram('connect')
+
+    elapsed = progress.elapsed()
+    print('%6d units  %8.1f s  %8.1f units/s  failed %5d  unit p50 %6.2f p95 %6.2f p99 %6.2f max %6.2f  '
+          'connect p99 %6.2f  %s' % (n_units, elapsed, n_units / elapsed, progress.failed,
+                                     units.percentile(50), units.percentile(95), units.percentile(99), units.max,
+                                     connect.percentile(99), filename))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Fleet scan benchmark with simulated units')
+    parser.add_argument('--engine', choices=['pool', 'async'], default='pool')
+    parser.add_argument('--units', default='100,1000,10000', help='comma separated fleet sizes')
+    parser.add_argument('--concurrency', type=int, default=50, help='N_PROCESSES of pool, sessions of async')
+    parser.add_argument('--rings', type=int, default=3)
+    parser.add_argument('--mh-enabled', action='store_true')
+    parser.add_argument('--sequential', action='store_true', help='one command at a time instead of pipelining')
+    parser.add_argument('--timeout', type=int, default=12, help='CONNECTION_TIMEOUT_SEC')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--connect-delay', type=float, default=None)
+    parser.add_argument('--reply-size', type=int, default=0)
+    parser.add_argument('--dead-rate', type=float, default=0.0)
+    parser.add_argument('--adaptive', action='store_true', help='ADAPTIVE_CONCURRENCY, --concurrency is its ceiling')
+    parser.add_argument('--details', action='store_true', help='print the per command latency report')
+    return parser.parse_args()
+
+
+##############################################################################
+##############################################################################
+if __name__ == '__main__':
+    args = get_args()
+    siklu_api.RINGS = args.rings
+    siklu_api.MH_ENABLED = args.mh_enabled
+    siklu_api.PIPELINE_SCAN = not args.sequential
+    siklu_api.CONNECTION_TIMEOUT_SEC = args.timeout
+    siklu_api.SPAWN_CMD = get_simulator_cmd(args)
+    # every fleet size scans the same simulated ips: cached columns would skip most of the commands of
+    # the later runs, and the history is not what is measured
+    siklu_api.SCAN_CACHE = False
+    siklu_api.SCAN_HISTORY = False
+    siklu_api.ADAPTIVE_CONCURRENCY = args.adaptive
+
+    for n_units in [int(n) for n in args.units.split(',')]:
+        filename, progress = run_fleet(get_hosts(n_units), args.engine, args.concurrency)
+        report(n_units, filename, progress)
+        if args.details:
+            print(latency.report())
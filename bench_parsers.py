@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# Parse-time benchmark of the reply parsers against the captured replies in fixtures/
+#   python bench_parsers.py [repeat]
+import os
+import re
+import sys
+import timeit
+from datetime import datetime
+
+import pandas as pd
+
+from siklu_api import *
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load_fixture(cmd):
+    return open(os.path.join(FIXTURES_DIR, cmd.replace(' ', '_') + '.txt')).read()
+
+
+##############################################################################
+# the per interval implementation the table parsers replaced, kept for comparison
+def legacy_rf_statistics_summary(reply):
+    stats = []
+    for time_interval in range(0, 96):
+        regex = r"^(%d\s+[\.\d]+\s+[:\d]+\s+[-\d]+\s+[-\d]+\s+[-\d]+\s+[-\d]+\s+[\w\d\s\.]+\s{2,}[\w\d\s\.]+\s{2,}[yesnounknown]+)" % time_interval
+        r = re.search(regex, reply, re.MULTILINE)
+        if r:
+            interval_values = r.groups()[0].strip().replace(',', '')
+            r = re.search(
+                r"(\d+)\s+([\.\d]+\s+[:\d]+)\s+([-\d]+)\s+([-\d]+)\s+([-\d]+)\s+([-\d]+)\s+([\w\d\s\.]+)\s{2,}([\w\d\s\.]+)",
+                interval_values)
+            if r:
+                r = r.groups()
+                stats.append([int(r[0]), datetime.strptime(r[1], '%Y.%m.%d %H:%M:%S'), int(r[2]), int(r[3]), int(r[4]),
+                              int(r[5]), r[6], r[7]])
+
+    return pd.DataFrame(stats, columns=ShowRfStatisticsSummary.columns[:8])
+
+
+def legacy_eth_statistics_summary(reply):
+    stats = []
+    for time_interval in range(0, 96):
+        regex = r"^(%d\s+[\.\d]+\s+[:\d]+\s+eth\d\s+[\d]+\s+[\d]+\s+[\d]+\s+[\d]+\s+[\d]+)" % time_interval
+        r = re.search(regex, reply, re.MULTILINE)
+        if r:
+            interval_values = r.groups()[0].strip().replace(',', '')
+            r = re.search(r"(\d+)\s+([\.\d]+\s+[:\d]+)\s+(eth[\d])\s+([\d]+)\s+([\d]+)\s+([\d]+)\s+([\d]+)\s+([\d]+)",
+                          interval_values)
+            if r:
+                r = r.groups()
+                stats.append([int(r[0]), datetime.strptime(r[1], '%Y.%m.%d %H:%M:%S'), r[2], int(r[3]), int(r[4]),
+                              int(r[5]), int(r[6]), int(r[7])])
+
+    return pd.DataFrame(stats, columns=ShowEthStatisticsSummary.columns)
+
+
+def legacy_parse(command, reply):
+    # SikluCommandParserBase.parse_reply before the params were precompiled and merged
+    flags = re.MULTILINE if command.multiline else 0
+    values = []
+    for param in command.cmd_params:
+        value = param.value
+        if param.regex:
+            r = re.search(param.regex, reply, flags)
+            value = r.groups()[0].strip().replace(',', '') if r else []
+            if param.format_func:
+                value = param.format_func(command, value)
+        values.append(value)
+    return values
+
+
+def current_parse(command, reply):
+    # parse_text() without the latency sample it records, that one is timed on its own
+    command.reply = reply
+    return command.parse_reply()
+
+
+##############################################################################
+def compare(name, legacy, current, repeat):
+    t_legacy = min(timeit.repeat(legacy, number=1, repeat=repeat))
+    t_current = min(timeit.repeat(current, number=1, repeat=repeat))
+    print('%-40s legacy %8.3f ms  current %8.3f ms  speedup %5.1fx' %
+          (name, t_legacy * 1000, t_current * 1000, t_legacy / t_current))
+
+
+def bench_statistics_summary(repeat):
+    rf_reply = load_fixture(ShowRfStatisticsSummary.cmd)
+    eth_reply = load_fixture('show eth eth1 statistics-summary')
+
+    # the typed columns have to agree with what the per interval regexes produced
+    key_columns = ['interval', 'start_ts', 'min-rssi', 'max-rssi', 'min-cinr', 'max-cinr']
+    legacy = legacy_rf_statistics_summary(rf_reply)[key_columns]
+    current = ShowRfStatisticsSummary().parse_text(rf_reply)[key_columns]
+    assert (legacy.astype(str).values == current.astype(str).values).all()
+    legacy = legacy_eth_statistics_summary(eth_reply)
+    current = ShowEthStatisticsSummary().parse_text(eth_reply)
+    assert (legacy.astype(str).values == current.astype(str).values).all()
+
+    compare('show rf statistics-summary',
+            lambda: legacy_rf_statistics_summary(rf_reply),
+            lambda: ShowRfStatisticsSummary().parse_text(rf_reply), repeat)
+    compare('show eth eth1 statistics-summary',
+            lambda: legacy_eth_statistics_summary(eth_reply),
+            lambda: ShowEthStatisticsSummary().parse_text(eth_reply), repeat)
+
+
+def bench_scan_commands(repeat):
+    commands = [command for command in get_scan_commands(rings=3, mh_enabled=True)
+                if not isinstance(command, SikluTableParserBase)]
+    replies = [load_fixture(command.cmd) for command in commands]
+
+    # the scan columns have to stay exactly the same
+    for command, reply in zip(commands, replies):
+        assert legacy_parse(command, reply) == command.parse_text(reply), command.cmd
+
+    def run_legacy():
+        for command, reply in zip(commands, replies):
+            legacy_parse(command, reply)
+
+    def run_current():
+        for command, reply in zip(commands, replies):
+            current_parse(command, reply)
+
+    for command, reply in zip(commands, replies):
+        if len(command.cmd_params) >= 10:
+            compare(command.cmd, lambda: legacy_parse(command, reply), lambda: current_parse(command, reply), repeat)
+    compare('scan (%d commands)' % len(commands), run_legacy, run_current, repeat)
+
+    def measure():
+        with latency.measure('parse', '', ''):
+            pass
+
+    t_measure = min(timeit.repeat(measure, number=1000, repeat=repeat)) / 1000
+    print('%-40s %8.3f ms per parse, %8.3f ms per scan' % ('latency sample', t_measure * 1000,
+                                                           t_measure * len(commands) * 1000))
+
+
+##############################################################################
+##############################################################################
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    bench_statistics_summary(repeat)
+    bench_scan_commands(repeat)
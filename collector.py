@@ -0,0 +1,245 @@
+#!/usr/bin/python
+import collections
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from multiprocessing.connection import Client, Listener
+
+import siklu_api
+from siklu_api import *
+
+COLLECTOR_ADDRESS = ('localhost', 6000)
+COLLECTOR_AUTHKEY = b'siklu-collector'
+IDLE_TIMEOUT_SEC = 600
+LIVENESS_CHECK_SEC = 60
+# a live session answers an empty line within a round trip
+LIVENESS_TIMEOUT_SEC = 1
+
+
+############################################################################
+class SessionPool:
+    """Authenticated SikluUnit sessions kept open between jobs, one per host.
+
+    A session is checked out for the duration of one job on that host. Sessions idle
+    for more than idle_timeout are closed by the eviction thread, sessions idle for more
+    than liveness_check are probed with an empty line before reuse and reconnected when
+    the prompt does not come back. A session whose job failed is closed by drop().
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT_SEC, liveness_check=LIVENESS_CHECK_SEC,
+                 connection_timeout=CONNECTION_TIMEOUT_SEC):
+        self.idle_timeout = idle_timeout
+        self.liveness_check = liveness_check
+        self.connection_timeout = connection_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.stats = collections.Counter()
+        self.evictor = threading.Thread(target=self.evict_loop, daemon=True)
+        self.evictor.start()
+
+    def get_entry(self, host, user, password):
+        with self.lock:
+            entry = self.sessions.get(host)
+            if entry is None or entry['user'] != user or entry['password'] != password:
+                if entry is not None:
+                    self.close_entry(entry)
+                unit = SikluUnit(host, user, password, connection_timeout=self.connection_timeout, debug=False,
+                                 spawn_cmd=siklu_api.get_host_spawn_cmd(host))
+                entry = {'unit': unit, 'user': user, 'password': password,
+                         'last_used': 0, 'command': 'scan', 'lock': threading.Lock()}
+                self.sessions[host] = entry
+            return entry
+
+    def is_alive(self, unit):
+        if not unit.connected or not unit.connection.isalive():
+            return False
+        try:
+            # drop output left over by no_wait commands, otherwise its prompt answers the probe
+            while True:
+                unit.connection.read_nonblocking(65536, timeout=0.2)
+        except TIMEOUT:
+            pass
+        except Exception:
+            return False
+        try:
+            unit.connection.sendline('')
+            i = unit.connection.expect([unit.prompt2, TIMEOUT, EOF], timeout=LIVENESS_TIMEOUT_SEC)
+        except Exception:
+            return False
+        return i == 0
+
+    @contextmanager
+    def session(self, host, user, password, command='scan'):
+        entry = self.get_entry(host, user, password)
+        with entry['lock']:
+            unit = entry['unit']
+            probe = time.time() - entry['last_used'] > self.liveness_check or entry['command'] != 'scan'
+            if unit.connected and probe:
+                if not self.is_alive(unit):
+                    self.stats['dead'] += 1
+                    unit.connected = False
+                    unit.connection = None
+            if unit.connected:
+                self.stats['reused'] += 1
+            else:
+                self.stats['connected'] += 1
+                unit.connect()
+            try:
+                yield unit
+            finally:
+                entry['last_used'] = time.time()
+                entry['command'] = command
+
+    def drop(self, unit):
+        # a session that failed its job may still be sending that job's output, it is not reused
+        try:
+            unit.connection.close(force=True)
+        except Exception:
+            pass
+        unit.connected = False
+        unit.connection = None
+        self.stats['dropped'] += 1
+
+    def close_entry(self, entry):
+        try:
+            entry['unit'].disconnect()
+        except Exception:
+            entry['unit'].connected = False
+            entry['unit'].connection = None
+
+    def evict_idle(self):
+        now = time.time()
+        with self.lock:
+            idle = [host for host, entry in self.sessions.items()
+                    if now - entry['last_used'] > self.idle_timeout and not entry['lock'].locked()]
+            entries = [self.sessions.pop(host) for host in idle]
+        for entry in entries:
+            self.close_entry(entry)
+            self.stats['evicted'] += 1
+
+    def evict_loop(self):
+        while not self.stopped.wait(min(self.idle_timeout, 30)):
+            self.evict_idle()
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            entries = list(self.sessions.values())
+            self.sessions = {}
+        for entry in entries:
+            self.close_entry(entry)
+
+
+############################################################################
+class Collector:
+    """Long running process owning a SessionPool, jobs are submitted with submit_job()."""
+
+    def __init__(self, address=COLLECTOR_ADDRESS, authkey=COLLECTOR_AUTHKEY, n_sessions=None):
+        self.address = address
+        self.authkey = authkey
+        self.pool = SessionPool(connection_timeout=siklu_api.CONNECTION_TIMEOUT_SEC)
+        self.n_sessions = n_sessions or siklu_api.N_PROCESSES
+        self.executor = ThreadPoolExecutor(max_workers=self.n_sessions)
+
+    def run_host(self, host, rings, mh_enabled):
+        # the threads share the class level cmd_params, parse_reply() keeps the values out of them
+        with self.pool.session(host['ip'], host['user'], host['password'], host['command']) as unit:
+            try:
+                reply = run_command({'unit': unit, 'command': host['command'],
+                                     'scan_commands': get_scan_commands(rings, mh_enabled)})
+            except Exception as e:
+                print("[%s] %s" % (host['ip'], e))
+                ts = time.strftime('%d-%m-%Y %H:%M:%S', time.localtime())
+                reply = ','.join([ts, host['ip'], host['command'], 'False', str(e)])
+            # run_command reports a timed out or broken job as a False status, reconnect on the next one
+            if reply.split(',')[3] == 'False' and unit.connected:
+                self.pool.drop(unit)
+            return reply
+
+    def run_job(self, job):
+        rings = job.get('rings', siklu_api.RINGS)
+        mh_enabled = job.get('mh_enabled', siklu_api.MH_ENABLED)
+
+        filename = get_execution_log_filename()
+        file_header = get_execution_log_header(get_scan_commands(rings, mh_enabled))
+        log = ExecutionLogWriter(filename, file_header)
+        progress = ScanProgress(len(job['hosts']), self.n_sessions)
+
+        replies = []
+        try:
+            futures = [self.executor.submit(self.run_host, host, rings, mh_enabled) for host in job['hosts']]
+            for future in as_completed(futures):
+                reply = future.result()
+                replies.append(reply)
+                log.write(reply)
+                progress.update(reply)
+        finally:
+            log.close()
+        print(progress)
+        return {'filename': filename, 'header': file_header, 'replies': replies}
+
+    def handle(self, conn):
+        try:
+            job = conn.recv()
+            if job.get('type') == 'stats':
+                conn.send({'sessions': len(self.pool.sessions), 'stats': dict(self.pool.stats)})
+            else:
+                conn.send(self.run_job(job))
+        except Exception as e:
+            print(e)
+            try:
+                conn.send({'error': str(e)})
+            except Exception:
+                pass
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        listener = Listener(self.address, authkey=self.authkey)
+        print('Collector listening on %s:%d' % self.address)
+        try:
+            while True:
+                conn = listener.accept()
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            self.pool.close()
+
+
+def submit_job(hosts, rings=None, mh_enabled=None, address=COLLECTOR_ADDRESS, authkey=COLLECTOR_AUTHKEY):
+    # hosts is the cfg.csv DataFrame, returns the collector's execution log
+    job = {'hosts': hosts[['ip', 'user', 'password', 'command']].to_dict('records')}
+    if rings is not None:
+        job['rings'] = rings
+    if mh_enabled is not None:
+        job['mh_enabled'] = mh_enabled
+
+    conn = Client(address, authkey=authkey)
+    try:
+        conn.send(job)
+        result = conn.recv()
+    finally:
+        conn.close()
+
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    return result
+
+
+##############################################################################
+##############################################################################
+if __name__ == '__main__':
+    # python collector.py serve [file.ini]
+    # python collector.py submit [file.ini]
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'serve'
+    load_config(sys.argv[2] if len(sys.argv) > 2 else None)
+
+    if mode == 'serve':
+        Collector().serve_forever()
+    else:
+        hosts = pd.read_csv(siklu_api.CSV_FILENAME, comment='#')
+        hosts.dropna(subset=['ip', 'user', 'command'], how='any', inplace=True)
+        print(submit_job(hosts)['filename'])
@@ -0,0 +1,181 @@
+# AIMD control of the number of units in flight, from what the completed units tell about the network and the box
+import os
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# in-flight limit the run starts with, doubled every window until the first sign of congestion (slow start)
+START_CONCURRENCY = 8
+MIN_CONCURRENCY = 1
+# additive increase per window, multiplicative decrease on congestion
+INCREASE_STEP = 2
+DECREASE_FACTOR = 0.7
+# a window closes after ADJUST_INTERVAL_SEC with at least MIN_WINDOW_REPLIES replies
+ADJUST_INTERVAL_SEC = 2.0
+MIN_WINDOW_REPLIES = 5
+# congestion: connect p90 above LATENCY_FACTOR x the best window's (and above MIN_LATENCY_SEC),
+# more than MAX_TIMEOUT_RATE timeouts, CPUs busier than MAX_CPU_BUSY or more than MAX_FD_USE of the fd limit
+LATENCY_FACTOR = 3.0
+MIN_LATENCY_SEC = 1.0
+MAX_TIMEOUT_RATE = 0.1
+MAX_CPU_BUSY = 0.9
+MAX_FD_USE = 0.8
+
+CONCURRENCY_LOG_HEADER = 'time_stamp,limit,in_flight,replies,timeouts,connect_p90,base_connect_p90,cpu_busy,fd_use,action,reasons\n'
+
+
+def get_cpu_times():
+    # (busy, total) jiffies of all the CPUs, None where there is no /proc/stat
+    try:
+        with open('/proc/stat') as f:
+            values = [int(x) for x in f.readline().split()[1:]]
+    except (IOError, OSError, ValueError):
+        return None
+    idle = values[3] + (values[4] if len(values) > 4 else 0)
+    return sum(values) - idle, sum(values)
+
+
+def get_fd_use():
+    # open fds of this process over its soft limit, 0 where it is not known
+    if resource is None or not os.path.isdir('/proc/self/fd'):
+        return 0.0
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft <= 0:
+        return 0.0
+    return len(os.listdir('/proc/self/fd')) / float(soft)
+
+
+def is_timeout(reply):
+    fields = reply.split(',')
+    return len(fields) > 4 and fields[3] == 'False' and ('No connection' in fields[4] or 'imeout' in fields[4])
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)]
+
+
+class ConcurrencyController:
+    """Number of units allowed in flight, between MIN_CONCURRENCY and max_concurrency.
+
+    Fed with every completed unit (its reply and timing samples), it closes a window every
+    ADJUST_INTERVAL_SEC and then either cuts the limit by DECREASE_FACTOR, when the connects
+    slow down, time out or the box runs out of CPU or fds, or raises it, by INCREASE_STEP
+    (doubling before the first cut), when the limit was actually used. Every decision goes
+    to the log file and the changes to stdout.
+    """
+
+    def __init__(self, max_concurrency, log_filename=None, start=None):
+        self.max_concurrency = max(max_concurrency, MIN_CONCURRENCY)
+        self.limit = min(start or START_CONCURRENCY, self.max_concurrency)
+        self.slow_start = True
+        self.base_latency = None
+        self.cpu_times = get_cpu_times()
+        # the window after a cut still shows the load from before it, it cannot cut again
+        self.cooldown = False
+        self.log = open(log_filename, 'w') if log_filename else None
+        if self.log:
+            self.log.write(CONCURRENCY_LOG_HEADER)
+        self.start_window()
+
+    def start_window(self):
+        self.window_start = time.time()
+        self.replies = 0
+        self.timeouts = 0
+        self.connect_times = []
+        self.saturated = False
+
+    def update(self, reply, samples, in_flight):
+        # in_flight: units still running after this one completed
+        self.replies += 1
+        self.timeouts += is_timeout(reply)
+        self.connect_times += [sample[4] for sample in samples if sample[1] == 'connect']
+        if in_flight + 1 >= self.limit:
+            self.saturated = True
+        if time.time() - self.window_start >= ADJUST_INTERVAL_SEC and self.replies >= MIN_WINDOW_REPLIES:
+            self.adjust(in_flight)
+
+    def adjust(self, in_flight):
+        connect_p90 = percentile(self.connect_times, 0.9) if self.connect_times else None
+        if connect_p90 is not None and self.timeouts < self.replies:
+            self.base_latency = connect_p90 if self.base_latency is None else min(self.base_latency, connect_p90)
+        timeout_rate = float(self.timeouts) / self.replies
+        cpu_busy = self.get_cpu_busy()
+        fd_use = get_fd_use()
+
+        reasons = []
+        if timeout_rate > MAX_TIMEOUT_RATE:
+            reasons.append('timeouts')
+        if connect_p90 is not None and self.base_latency is not None and connect_p90 > MIN_LATENCY_SEC and \
+                connect_p90 > LATENCY_FACTOR * self.base_latency:
+            reasons.append('connect latency')
+        if cpu_busy > MAX_CPU_BUSY:
+            reasons.append('cpu')
+        if fd_use > MAX_FD_USE:
+            reasons.append('fds')
+
+        limit = self.limit
+        if reasons and self.cooldown:
+            action = 'cooldown'
+            self.cooldown = False
+        elif reasons:
+            action = 'decrease'
+            self.slow_start = False
+            self.cooldown = True
+            self.limit = max(MIN_CONCURRENCY, int(self.limit * DECREASE_FACTOR))
+        elif self.saturated and self.limit < self.max_concurrency:
+            action = 'increase'
+            self.limit = min(self.max_concurrency, self.limit * 2 if self.slow_start else self.limit + INCREASE_STEP)
+        else:
+            action = 'hold'
+        if action in ['increase', 'hold']:
+            self.cooldown = False
+
+        if self.limit != limit:
+            print('Concurrency %d -> %d%s' % (limit, self.limit, ' (%s)' % ', '.join(reasons) if reasons else ''))
+        if self.log:
+            ts = time.strftime('%d-%m-%Y %H:%M:%S', time.localtime())
+            self.log.write('%s,%d,%d,%d,%d,%s,%s,%.2f,%.3f,%s,%s\n' % (
+                ts, self.limit, in_flight, self.replies, self.timeouts,
+                '' if connect_p90 is None else '%.3f' % connect_p90,
+                '' if self.base_latency is None else '%.3f' % self.base_latency,
+                cpu_busy, fd_use, action, ';'.join(reasons)))
+            self.log.flush()
+        self.start_window()
+
+    def get_cpu_busy(self):
+        # busy fraction of the CPUs since the previous window
+        cpu_times = get_cpu_times()
+        if cpu_times is None or self.cpu_times is None or cpu_times[1] == self.cpu_times[1]:
+            return 0.0
+        busy = float(cpu_times[0] - self.cpu_times[0]) / (cpu_times[1] - self.cpu_times[1])
+        self.cpu_times = cpu_times
+        return busy
+
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+
+
+##############################################################################
+##############################################################################
+if __name__ == '__main__':
+    # an all dead fleet: every connect times out, there is no base latency yet and the windows are cut for the timeouts only
+    ADJUST_INTERVAL_SEC = 0
+    controller = ConcurrencyController(20, start=16)
+    for i in range(4 * MIN_WINDOW_REPLIES):
+        controller.update('10.0.0.%d,,,False,No connection\n' % i, [(0, 'connect', '10.0.0.%d' % i, '', 3.0)],
+                          controller.limit - 1)
+    assert controller.base_latency is None
+    assert controller.limit < 16, controller.limit
+    # then the connects come back: the first window sets the base latency and nothing is cut for it
+    controller.cooldown = False
+    limit = controller.limit
+    for i in range(MIN_WINDOW_REPLIES):
+        controller.update('10.0.0.%d,,,True,\n' % i, [(0, 'connect', '10.0.0.%d' % i, '', 2.0)], 0)
+    assert controller.base_latency == 2.0 and controller.limit == limit, (controller.base_latency, controller.limit)
+    print('all dead fleet: limit 16 -> %d, base latency %s' % (limit, controller.base_latency))
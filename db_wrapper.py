@@ -1,7 +1,6 @@
 from sqlalchemy import create_engine
 import pandas as pd
 import time
-import config as cfg
 import logging
 
 
@@ -52,6 +51,27 @@ class levitan_db(mysql_engine):
         self.db_name = 'siklu_internal_stats'
         mysql_engine.__init__(self, username, password, host, self.db_name)
 
+class sqlite_db:
+    # local file instead of MySQL, for testing
+    def __init__(self, filename='stats.db'):
+        self.db_name = 'main'
+        self.engine = create_engine('sqlite:///%s' % filename, echo=False)
+
+    def get_tables(self):
+        sql = "select name from sqlite_master where type = 'table'"
+        return pd.read_sql(sql, self.engine)
+
+
+def get_db(name='levitan'):
+    # levitan, aws, local or the filename of a SQLite database
+    if name == 'levitan':
+        return levitan_db()
+    if name == 'aws':
+        return aws_db()
+    if name == 'local':
+        return local_db()
+    return sqlite_db(name)
+
 ####################################################
 if __name__ == '__main__':
     engine = local_db().engine
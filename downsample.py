@@ -0,0 +1,70 @@
+import numpy as np
+
+# points per chart sent to the browser
+POINT_BUDGET = 5000
+
+
+def to_float(x):
+    # datetimes as nanoseconds, LTTB needs the x distances
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype('datetime64[ns]').astype(np.int64).astype(float)
+    return x.astype(float)
+
+
+def minmax_indices(y, n_out):
+    # the positions of the min and the max of n_out / 2 equal buckets, keeps every peak and dip
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n <= n_out or n_out < 2:
+        return np.arange(n)
+    n_buckets = n_out // 2
+    size = -(-n // n_buckets)
+    padded = np.full(n_buckets * size, np.nan)
+    padded[:n] = y
+    buckets = padded.reshape(n_buckets, size)
+    # NaN never wins, an all NaN bucket points at its first slot
+    lows = np.argmin(np.where(np.isnan(buckets), np.inf, buckets), axis=1)
+    highs = np.argmax(np.where(np.isnan(buckets), -np.inf, buckets), axis=1)
+    offsets = np.arange(n_buckets) * size
+    indices = np.unique(np.concatenate([offsets + lows, offsets + highs]))
+    return indices[indices < n]
+
+
+def lttb_indices(x, y, n_out):
+    # Largest-Triangle-Three-Buckets: first and last points, then per bucket the point making the
+    # largest triangle with the previous pick and the next bucket's average
+    x = to_float(x)
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    valid = ~np.isnan(y)
+    if not valid.all():
+        # NaN points are dropped, the chart shows a gap either way
+        positions = np.flatnonzero(valid)
+        return positions[lttb_indices(x[valid], y[valid], n_out)]
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = end, edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_start:next_end].mean() if next_end > next_start else x[-1]
+        avg_y = y[next_start:next_end].mean() if next_end > next_start else y[-1]
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        indices[i + 1] = a
+    return indices
+
+
+def downsample(series, n_out, method='lttb'):
+    # series with a datetime index, at most about n_out points of it
+    if len(series) <= n_out:
+        return series
+    if method == 'minmax':
+        return series.iloc[minmax_indices(series.to_numpy(), n_out)]
+    return series.iloc[lttb_indices(series.index.to_numpy(), series.to_numpy(), n_out)]
@@ -0,0 +1,176 @@
+#!/usr/bin/python
+# HTTP server of the SW images on the collector box, the units pull the image from here instead of a remote file server:
+#   python firmware_server.py <directory> [port]
+import mmap
+import os
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # ver. < 3.0
+    from SocketServer import ThreadingMixIn
+
+FIRMWARE_DIR = ''
+FIRMWARE_PORT = 8080
+# transfers served at the same time, a unit above it waits up to SLOT_WAIT_SEC for a free slot
+MAX_TRANSFERS = 20
+SLOT_WAIT_SEC = 600
+# all the transfers together, 0: no limit
+MAX_BANDWIDTH_MBPS = 100.0
+CHUNK_SIZE = 64 * 1024
+
+
+class RateLimiter:
+    # shared by the transfers, every chunk books its slot on one timeline
+    def __init__(self, mbps):
+        self.rate = mbps * 1e6 / 8
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self, n_bytes):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            # at most one second of unused bandwidth carries over
+            start = max(self.next_time, now - 1.0)
+            self.next_time = start + n_bytes / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class FirmwareRequestHandler(BaseHTTPRequestHandler):
+    def get_image(self):
+        image = self.server.get_image(self.path)
+        if image is None:
+            self.send_error(404, 'Not found')
+        return image
+
+    def send_headers(self, size):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+
+    def do_HEAD(self):
+        image = self.get_image()
+        if image is not None:
+            self.send_headers(len(image))
+
+    def do_GET(self):
+        image = self.get_image()
+        if image is None:
+            return
+        transfer = self.server.start_transfer(self.client_address[0], self.path, len(image))
+        if not self.server.slots.acquire(timeout=SLOT_WAIT_SEC):
+            self.server.end_transfer(transfer, 'busy')
+            self.send_error(503, 'Too many transfers')
+            return
+        status = 'failed'
+        try:
+            transfer['start'] = time.time()
+            self.send_headers(len(image))
+            data = memoryview(image)
+            for offset in range(0, len(image), CHUNK_SIZE):
+                chunk = data[offset:offset + CHUNK_SIZE]
+                self.server.limiter.wait(len(chunk))
+                self.wfile.write(chunk)
+                transfer['bytes'] += len(chunk)
+            status = 'done'
+        except Exception as e:
+            print('[%s] %s: %s' % (self.client_address[0], self.path, e))
+        finally:
+            self.server.slots.release()
+            self.server.end_transfer(transfer, status)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FirmwareServer(ThreadingMixIn, HTTPServer):
+    """Serves the files of a directory, memory-mapped, to the units copying them.
+
+    At most max_transfers are sent at the same time and all of them share max_bandwidth_mbps,
+    so hundreds of units pulling the same image neither flood the backhaul nor the box.
+    Every transfer is recorded: get_stats(host) gives the last one of a unit.
+    """
+    daemon_threads = True
+
+    def __init__(self, directory=None, port=None, max_transfers=None, max_bandwidth_mbps=None):
+        HTTPServer.__init__(self, ('', port or FIRMWARE_PORT), FirmwareRequestHandler)
+        self.directory = os.path.abspath(directory or FIRMWARE_DIR)
+        self.slots = threading.BoundedSemaphore(max_transfers or MAX_TRANSFERS)
+        self.limiter = RateLimiter(MAX_BANDWIDTH_MBPS if max_bandwidth_mbps is None else max_bandwidth_mbps)
+        self.images = {}
+        self.transfers = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def get_image(self, path):
+        # the mmap of the requested file, None when it is not in the directory
+        filename = os.path.abspath(os.path.join(self.directory, path.split('?')[0].lstrip('/')))
+        if not filename.startswith(self.directory + os.sep) or not os.path.isfile(filename):
+            return None
+        with self.lock:
+            if filename not in self.images:
+                with open(filename, 'rb') as f:
+                    self.images[filename] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.images[filename]
+
+    def start_transfer(self, host, path, size):
+        transfer = {'host': host, 'path': path, 'size': size, 'bytes': 0, 'queued': time.time(),
+                    'start': None, 'end': None, 'status': 'queued'}
+        with self.lock:
+            self.transfers.append(transfer)
+        return transfer
+
+    def end_transfer(self, transfer, status):
+        transfer['end'] = time.time()
+        transfer['status'] = status
+        duration = transfer['end'] - (transfer['start'] or transfer['end'])
+        print('[%s] %s %s, %d bytes in %.1f sec' % (transfer['host'], transfer['path'], status, transfer['bytes'],
+                                                     duration))
+
+    def get_stats(self, host):
+        # the last transfer of the unit: bytes, seconds waiting for a slot and sending, status
+        with self.lock:
+            transfers = [transfer for transfer in self.transfers if transfer['host'] == host]
+        if not transfers:
+            return None
+        transfer = transfers[-1]
+        end = transfer['end'] or time.time()
+        return {'bytes': transfer['bytes'], 'status': transfer['status'],
+                'wait_sec': (transfer['start'] or end) - transfer['queued'],
+                'send_sec': end - (transfer['start'] or end)}
+
+    def get_url(self, address):
+        # the base url the units use, address: the collector's address as seen from the units
+        return 'http://%s:%d' % (address, self.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        print('Serving %s on port %d' % (self.directory, self.server_address[1]))
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        for image in self.images.values():
+            image.close()
+
+
+##############################################################################
+##############################################################################
+if __name__ == '__main__':
+    server = FirmwareServer(sys.argv[1] if len(sys.argv) > 1 else '.',
+                            int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
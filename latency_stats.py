@@ -0,0 +1,173 @@
+import bisect
+import collections
+import threading
+import time
+from contextlib import contextmanager
+
+# histogram bucket upper bounds in seconds, 1 ms to ~18 min in steps of 2^(1/4)
+BUCKETS = [0.001 * 2 ** (i / 4.0) for i in range(81)]
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile, capped by the largest sample
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(BUCKETS[i] if i < len(BUCKETS) else self.max, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+
+class LatencyRecorder:
+    """Wall time per phase (connect, command, parse), per host and per command.
+
+    Samples go into in-memory histograms keyed by (phase, command) and, when a timing
+    file is open, one CSV line each. Pool workers collect() their samples, drain() them and
+    return them with the reply, the parent merge()s them into its own recorder.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timing_file = None
+        # samples are queued for drain() only in a process reporting to its parent
+        self.collecting = False
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = collections.OrderedDict()
+            self.host_totals = collections.Counter()
+            self.host_max = {}
+            self.pending = []
+
+    def record(self, phase, host, command, seconds, ts=None):
+        sample = (ts or time.time(), phase, host, command, seconds)
+        with self.lock:
+            self.add(sample)
+            if self.collecting:
+                self.pending.append(sample)
+
+    def add(self, sample):
+        ts, phase, host, command, seconds = sample
+        key = (phase, command)
+        if key not in self.histograms:
+            self.histograms[key] = LatencyHistogram()
+        self.histograms[key].add(seconds)
+        self.host_totals[host] += seconds
+        if seconds > self.host_max.get(host, (0, ''))[0]:
+            self.host_max[host] = (seconds, '%s %s' % (phase, command))
+        if self.timing_file:
+            self.timing_file.write('%s,%s,%s,%s,%.6f\n' % (
+                time.strftime('%d-%m-%Y %H:%M:%S', time.localtime(ts)), phase, host, command, seconds))
+
+    @contextmanager
+    def measure(self, phase, host, command=''):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(phase, host, command, time.time() - start, start)
+
+    def record_burst(self, phase, host, commands, start, arrivals):
+        # commands sent in one burst and answered in order. arrivals: (time, replies so far) after every read.
+        # A command takes from the previous reply to its own, the replies of one read share its time
+        done = 0
+        last = start
+        for ts, n in arrivals:
+            n = min(n, len(commands))
+            if n > done:
+                seconds = (ts - last) / (n - done)
+                for i in range(done, n):
+                    self.record(phase, host, commands[i], seconds, last + (i - done) * seconds)
+                done, last = n, ts
+
+    def collect(self):
+        # from now on the samples are also queued for drain()
+        with self.lock:
+            self.collecting = True
+            self.pending = []
+
+    def drain(self):
+        # samples recorded since the last drain
+        with self.lock:
+            samples, self.pending = self.pending, []
+        return samples
+
+    def merge(self, samples):
+        with self.lock:
+            for sample in samples:
+                self.add(sample)
+
+    def open_timing_file(self, filename):
+        self.timing_file = open(filename, 'w')
+        self.timing_file.write('time_stamp,phase,host,command,seconds\n')
+        return filename
+
+    def close_timing_file(self):
+        if self.timing_file:
+            self.timing_file.close()
+            self.timing_file = None
+
+    def summary(self):
+        # rows of (phase, command, count, mean, p50, p95, p99, max), slowest p95 first
+        rows = [(phase, command, h.count, h.mean(), h.percentile(50), h.percentile(95), h.percentile(99), h.max)
+                for (phase, command), h in self.histograms.items()]
+        return sorted(rows, key=lambda row: row[5], reverse=True)
+
+    def phase_histogram(self, phase):
+        # all the commands of one phase together
+        histogram = LatencyHistogram()
+        for (phase_, command), h in self.histograms.items():
+            if phase_ == phase:
+                histogram.merge(h)
+        return histogram
+
+    def host_histogram(self):
+        # distribution of the per host totals, i.e. the time one unit took
+        histogram = LatencyHistogram()
+        for seconds in self.host_totals.values():
+            histogram.add(seconds)
+        return histogram
+
+    def slowest_hosts(self, n=10):
+        # rows of (host, total seconds, slowest sample seconds, slowest phase and command)
+        return [(host, total) + self.host_max[host] for host, total in self.host_totals.most_common(n)]
+
+    def report(self, n_hosts=10):
+        lines = ['%-8s %-40s %7s %8s %8s %8s %8s %8s' % ('phase', 'command', 'count', 'mean', 'p50', 'p95', 'p99', 'max')]
+        for phase, command, count, mean, p50, p95, p99, max_ in self.summary():
+            lines.append('%-8s %-40s %7d %8.3f %8.3f %8.3f %8.3f %8.3f' % (
+                phase, command[:40], count, mean, p50, p95, p99, max_))
+        lines.append('')
+        lines.append('%-20s %10s %10s  %s' % ('slowest hosts', 'total', 'slowest', 'in'))
+        for host, total, slowest, where in self.slowest_hosts(n_hosts):
+            lines.append('%-20s %10.3f %10.3f  %s' % (host, total, slowest, where))
+        return '\n'.join(lines)
+
+
+latency = LatencyRecorder()
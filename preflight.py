@@ -0,0 +1,73 @@
+# Reachability of the units before any ssh is spawned: one non-blocking TCP connect to the SSH port per host,
+# the whole list at once. A dead host then costs PREFLIGHT_TIMEOUT_SEC once instead of a worker for the ssh timeout
+import asyncio
+import json
+import os
+import time
+
+PREFLIGHT_PORT = 22
+PREFLIGHT_TIMEOUT_SEC = 2
+# connects in flight, each one holds a socket
+PREFLIGHT_CONCURRENCY = 500
+# results younger than this are not checked again, 0: no cache
+PREFLIGHT_TTL_SEC = 300
+PREFLIGHT_CACHE_FILE = 'preflight_cache.json'
+
+
+async def check_host(ip, port, timeout, semaphore):
+    # (alive, reason)
+    async with semaphore:
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+            writer.close()
+            return True, ''
+        except asyncio.TimeoutError:
+            return False, 'Unreachable'
+        except ConnectionRefusedError:
+            return False, 'Port %d closed' % port
+        except OSError as e:
+            return False, e.strerror or str(e)
+
+
+async def check_hosts_async(ips, port, timeout, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*[check_host(ip, port, timeout, semaphore) for ip in ips])
+    return dict(zip(ips, results))
+
+
+def load_cache(filename):
+    # {ip: [time, alive, reason]}
+    if not os.path.exists(filename):
+        return {}
+    try:
+        return json.load(open(filename))
+    except ValueError:
+        return {}
+
+
+def save_cache(cache, filename):
+    tmp_filename = filename + '.tmp'
+    json.dump(cache, open(tmp_filename, 'w'))
+    os.replace(tmp_filename, filename)
+
+
+def check_hosts(ips, port=PREFLIGHT_PORT, timeout=None, ttl=None, cache_file=None):
+    # {ip: (alive, reason)}, from the cache when checked less than ttl seconds ago
+    timeout = PREFLIGHT_TIMEOUT_SEC if timeout is None else timeout
+    ttl = PREFLIGHT_TTL_SEC if ttl is None else ttl
+    cache_file = cache_file or PREFLIGHT_CACHE_FILE
+    now = time.time()
+    cache = {ip: entry for ip, entry in load_cache(cache_file).items() if now - entry[0] < ttl} if ttl else {}
+
+    results = {ip: (cache[ip][1], cache[ip][2]) for ip in ips if ip in cache}
+    todo = [ip for ip in dict.fromkeys(ips) if ip not in results]
+    if todo:
+        start = time.time()
+        checked = asyncio.run(check_hosts_async(todo, port, timeout, PREFLIGHT_CONCURRENCY))
+        results.update(checked)
+        print('Preflight: %d hosts checked in %.1f sec, %d unreachable, %d from the cache' % (
+            len(todo), time.time() - start, sum(1 for alive, reason in checked.values() if not alive), len(ips) - len(todo)))
+        if ttl:
+            cache.update((ip, [now, alive, reason]) for ip, (alive, reason) in checked.items())
+            save_cache(cache, cache_file)
+    return results
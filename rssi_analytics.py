@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+DROPOUT_RSSI = -128
+# 1 dB bins of the per host distributions
+RSSI_BINS = np.arange(-100, 1, 1)
+DELTA_BINS = np.arange(0, 41, 1)
+
+
+def compute_rssi(stats):
+    # avg-rssi, delta-rssi and dropout of every interval, columns of the whole frame at once
+    min_rssi = stats['min-rssi'].to_numpy()
+    max_rssi = stats['max-rssi'].to_numpy()
+    rssi = pd.DataFrame({'host': stats['host'].to_numpy(),
+                         'min-rssi': min_rssi,
+                         'max-rssi': max_rssi,
+                         'avg-rssi': (max_rssi + min_rssi) / 2.0,
+                         'delta-rssi': max_rssi - min_rssi,
+                         'dropout': min_rssi == DROPOUT_RSSI},
+                        index=stats.index)
+    return rssi
+
+
+def summarize_hosts(rssi):
+    # one row per host, from a single groupby over all the intervals.
+    # The levels of dropout intervals are not real, they only count as dropouts
+    levels = rssi[['min-rssi', 'max-rssi', 'avg-rssi', 'delta-rssi']].mask(rssi['dropout'], axis=0)
+    levels['host'] = rssi['host']
+    levels['dropout'] = rssi['dropout']
+    groups = levels.groupby('host')
+    summary = groups.agg(samples=('dropout', 'size'),
+                         dropouts=('dropout', 'sum'),
+                         min_rssi=('min-rssi', 'min'),
+                         max_rssi=('max-rssi', 'max'),
+                         avg_rssi=('avg-rssi', 'mean'),
+                         delta_mean=('delta-rssi', 'mean'),
+                         delta_max=('delta-rssi', 'max'))
+    summary['delta_p95'] = groups['delta-rssi'].quantile(0.95)
+    summary['dropout_rate'] = summary['dropouts'] / summary['samples']
+    return summary
+
+
+def host_histograms(rssi, column, bins):
+    # counts per host and bin (hosts x len(bins) - 1) with one bincount, values outside the bins
+    # and dropout intervals are dropped
+    values = rssi[column].to_numpy(dtype=float)
+    values[rssi['dropout'].to_numpy()] = np.nan
+    codes, hosts = pd.factorize(rssi['host'])
+    index = np.digitize(values, bins) - 1
+    valid = (index >= 0) & (index < len(bins) - 1) & ~np.isnan(values)
+    n_bins = len(bins) - 1
+    counts = np.bincount(codes[valid] * n_bins + index[valid], minlength=len(hosts) * n_bins)
+    return pd.DataFrame(counts.reshape(len(hosts), n_bins), index=hosts, columns=bins[:-1])
+
+
+def top_links(summary, n=20, by='delta_p95', ascending=False):
+    # fleet ranking, the n links with the largest (smallest) value of the summary column
+    return summary.sort_values(by, ascending=ascending).head(n)
+
+
+def split_hosts(rssi, hosts=None):
+    # {host: its intervals}, one groupby instead of a filter per host
+    if hosts is not None:
+        rssi = rssi[rssi['host'].isin(hosts)]
+    return dict(tuple(rssi.groupby('host', sort=False)))
@@ -1,12 +1,245 @@
-from siklu_api import *
-
-if __name__ == '__main__':
-
-    unit = SikluUnit('31.168.34.109', 'admin', 'admin', debug=False)
-    unit.connect()
-    for i in range(100):
-        reply = ShowRSSI(unit).parse()
-        rssi = int(reply[0])
-        # ts = time.strftime('%d-%m-%Y %H:%M:%S.%f', time.localtime())
-        ts = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-        print(f'{ts},{rssi}')
+#!/usr/bin/python
+# RSSI of many units at a fixed rate over persistent sessions, e.g. a whole ring during a rain event:
+#   python rssi_logger.py [--ini file.ini] [--hosts ip,ip,...] [--rate 1] [--duration 3600]
+#                         [--output rssi_<ts>.csv | parquet:<directory> | levitan|aws|local|<SQLite file>]
+#                         [--alert-below -70]
+# Without --hosts the units are the ips of cfg.csv
+import argparse
+import math
+import threading
+
+import siklu_api
+from siklu_api import *
+from telemetry_buffer import AlertRule, TelemetryStore
+
+SAMPLE_RATE_HZ = 1.0
+# a sample not answered within this is an error, the session is opened again
+SAMPLE_TIMEOUT_SEC = 5
+RECONNECT_SEC = 5
+# the buffered samples are written every FLUSH_INTERVAL_SEC or FLUSH_ROWS samples
+FLUSH_INTERVAL_SEC = 10
+FLUSH_ROWS = 10000
+RSSI_TABLE_NAME = 'rssi_samples_table'
+# ts: when the reply came (UTC), rtt_sec: its round trip, missed: ticks skipped right before this sample
+SAMPLE_COLUMNS = ['ts', 'host', 'rssi', 'rtt_sec', 'missed']
+# --alert-below: the RSSI mean of this window under the threshold is reported at every flush
+ALERT_WINDOW_SEC = 60
+EPOCH = datetime(1970, 1, 1)
+
+
+############################################################################
+class CsvSampleWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        if not os.path.exists(filename):
+            with open(filename, 'w') as f:
+                f.write(','.join(SAMPLE_COLUMNS) + '\n')
+
+    def write(self, samples):
+        with open(self.filename, 'a') as f:
+            for ts, host, rssi, rtt, missed in samples:
+                f.write('%s,%s,%s,%.3f,%d\n' % (ts.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], host,
+                                               '' if rssi is None else rssi, rtt, missed))
+
+
+class ParquetSampleWriter:
+    # one part file per flush
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, samples):
+        data = pd.DataFrame(samples, columns=SAMPLE_COLUMNS)
+        data['rssi'] = data['rssi'].astype('Int64')
+        data.to_parquet(os.path.join(self.directory, 'part-%s.parquet' % data['ts'].min().strftime('%Y%m%d%H%M%S%f')),
+                        index=False)
+
+
+class DbSampleWriter:
+    def __init__(self, db_name):
+        from db_wrapper import get_db
+        self.engine = get_db(db_name).engine
+
+    def write(self, samples):
+        data = pd.DataFrame(samples, columns=SAMPLE_COLUMNS)
+        data.to_sql(RSSI_TABLE_NAME, self.engine, if_exists='append', index=False)
+
+
+def get_writer(output):
+    if output.startswith('parquet:'):
+        return ParquetSampleWriter(output[len('parquet:'):])
+    if output.endswith('.csv'):
+        return CsvSampleWriter(output)
+    return DbSampleWriter(output)
+
+
+############################################################################
+class UnitSampler(threading.Thread):
+    """Samples one unit on its own schedule: tick k is due at start + k * period, whatever
+    the previous samples cost, so the rate does not drift. Ticks that passed while a reply
+    or a reconnect was awaited are skipped and counted, the next sample carries the count.
+    """
+
+    def __init__(self, host, user, password, period, sink, stopped):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.unit = SikluUnit(host, user, password, connection_timeout=siklu_api.CONNECTION_TIMEOUT_SEC,
+                              debug=False, spawn_cmd=get_host_spawn_cmd(host))
+        self.period = period
+        self.sink = sink
+        self.stopped = stopped
+        self.samples = 0
+        self.missed = 0
+        self.errors = 0
+        self.sent = 0
+
+    def sample(self):
+        # the RSSI, None without a session or a readable reply
+        if not self.unit.connected:
+            self.unit.connect()
+            if not self.unit.connected:
+                self.stopped.wait(RECONNECT_SEC)
+                return None
+            self.unit.connection.timeout = SAMPLE_TIMEOUT_SEC
+        try:
+            self.sent = time.time()
+            value = ShowRSSI(self.unit).parse()[0]
+            return int(value) if value != [] else None
+        except Exception as e:
+            print('[%s] %s' % (self.unit.host, str(e).splitlines()[0] if str(e) else repr(e)))
+            self.unit.connection.close(force=True)
+            self.unit.connected = False
+            self.unit.connection = None
+            return None
+
+    def run(self):
+        start = time.time()
+        tick = 0
+        missed = 0
+        while not self.stopped.is_set():
+            wait = start + tick * self.period - time.time()
+            if wait > 0 and self.stopped.wait(wait):
+                break
+            rssi = self.sample()
+            now = time.time()
+            if rssi is None:
+                self.errors += 1
+            else:
+                self.sink(datetime.utcfromtimestamp(now), self.unit.host, rssi, now - self.sent, missed)
+                self.samples += 1
+                missed = 0
+            # the next tick still ahead, the ones in between are lost
+            next_tick = max(tick + 1, int(math.ceil((now - start) / self.period)))
+            missed += next_tick - tick - 1
+            self.missed += next_tick - tick - 1
+            tick = next_tick
+        self.unit.disconnect()
+
+
+class RssiSampler:
+    # the UnitSamplers of all the units, their samples buffered in memory and flushed in batches.
+    # writer None keeps the samples in the telemetry store only
+    def __init__(self, hosts, writer, rate=None, telemetry=None, alert_rules=None):
+        self.writer = writer
+        self.telemetry = telemetry
+        self.alert_rules = alert_rules or []
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        period = 1.0 / (rate or SAMPLE_RATE_HZ)
+        self.samplers = [UnitSampler(host['ip'], host['user'], host['password'], period, self.add, self.stopped)
+                         for i, host in hosts.iterrows()]
+
+    def add(self, *sample):
+        if self.telemetry is not None:
+            ts, host, rssi, rtt = sample[:4]
+            ts = (ts - EPOCH).total_seconds()
+            self.telemetry.append(host, 'rssi', ts, rssi)
+            self.telemetry.append(host, 'rtt_sec', ts, rtt)
+        with self.lock:
+            self.buffer.append(sample)
+
+    def flush(self):
+        with self.lock:
+            samples, self.buffer = self.buffer, []
+        if samples and self.writer is not None:
+            self.writer.write(samples)
+        return len(samples)
+
+    def check_alerts(self):
+        for rule in self.alert_rules:
+            for host, value in rule.check(self.telemetry):
+                print('ALERT %-16s %s: %.1f' % (host, rule, value))
+
+    def report(self):
+        return 'samples %d, missed ticks %d, errors %d, units connected %d/%d' % (
+            sum(s.samples for s in self.samplers), sum(s.missed for s in self.samplers),
+            sum(s.errors for s in self.samplers), sum(s.unit.connected for s in self.samplers), len(self.samplers))
+
+    def run(self, duration=None):
+        start = time.time()
+        for sampler in self.samplers:
+            sampler.start()
+        last_flush = time.time()
+        try:
+            while (duration is None or time.time() - start < duration) and not self.stopped.is_set():
+                time.sleep(0.2)
+                if time.time() - last_flush >= FLUSH_INTERVAL_SEC or len(self.buffer) >= FLUSH_ROWS:
+                    self.flush()
+                    last_flush = time.time()
+                    print(self.report())
+                    self.check_alerts()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopped.set()
+            for sampler in self.samplers:
+                sampler.join(SAMPLE_TIMEOUT_SEC + 1)
+            self.flush()
+        for sampler in self.samplers:
+            print('%-16s samples %6d  missed %6d  errors %4d' % (sampler.unit.host, sampler.samples, sampler.missed,
+                                                                   sampler.errors))
+        print(self.report())
+
+    def start(self):
+        # run() in the background, e.g. under the live dashboard, until stop()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped.set()
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='RSSI of many units at a fixed rate')
+    parser.add_argument('--ini', default=None, help='file.ini, for CSV_FILENAME, CONNECTION_TIMEOUT_SEC, SPAWN_CMD')
+    parser.add_argument('--hosts', default=None, help='comma separated ips, default: the ips of cfg.csv')
+    parser.add_argument('--user', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--rate', type=float, default=SAMPLE_RATE_HZ, help='samples per second per unit')
+    parser.add_argument('--duration', type=float, default=None, help='seconds, default: until Ctrl-C')
+    parser.add_argument('--output', default=None, help='rssi_<ts>.csv, parquet:<directory> or a database name')
+    parser.add_argument('--alert-below', type=float, default=None,
+                        help='dBm, report the units whose %d sec RSSI mean is lower' % ALERT_WINDOW_SEC)
+    return parser.parse_args()
+
+
+##############################################################################
+##############################################################################
+if __name__ == '__main__':
+    args = get_args()
+    load_config(args.ini)
+    if args.hosts:
+        hosts = pd.DataFrame({'ip': args.hosts.split(','), 'user': args.user, 'password': args.password})
+    else:
+        hosts = pd.read_csv(siklu_api.CSV_FILENAME, comment='#')
+        hosts.dropna(subset=['ip', 'user'], how='any', inplace=True)
+        hosts = hosts.drop_duplicates('ip')
+
+    output = args.output or 'rssi_%s.csv' % time.strftime('%d%m%Y_%H%M', time.localtime())
+    alert_rules = [] if args.alert_below is None else [AlertRule('rssi', 'mean', '<', args.alert_below, ALERT_WINDOW_SEC)]
+    RssiSampler(hosts, get_writer(output), args.rate, TelemetryStore() if alert_rules else None,
+                alert_rules).run(args.duration)
+    print(output)
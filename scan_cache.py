@@ -0,0 +1,92 @@
+# Per unit cache of the scan columns that hardly ever change (serial, license, SNMP, NTP, syslog, VLAN).
+# One small JSON file per host, only the worker scanning the host reads and writes it
+import json
+import os
+import time
+
+SCAN_CACHE_DIR = 'scan_cache'
+# params telling the cached columns may be wrong: another serial number, or a reboot (uptime went down).
+# Their commands must not be cached, they are compared on every scan
+IDENTITY_PARAMS = ['system_sn', 'system_up_days']
+
+
+def get_cache_filename(host, directory=None):
+    return os.path.join(directory or SCAN_CACHE_DIR, '%s.json' % host)
+
+
+def invalidate(host, directory=None):
+    # after a command that may have changed the configuration, the next scan reads everything again
+    filename = get_cache_filename(host, directory)
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def is_complete(values):
+    # a param that was not found is [], such a reply is not cached
+    return all(value != [] and value != '' for value in values)
+
+
+class ScanCache:
+    """The cached columns of one host: {command: [time, values]} plus the identity of the unit.
+
+    ttls maps the commands' cache_group to seconds, a command without one is never cached.
+    update() stores what a scan read and tells when the unit is not the one the cache was
+    filled from, the served columns must then be read again.
+    """
+
+    def __init__(self, host, ttls, directory=None):
+        self.host = host
+        self.ttls = ttls
+        self.filename = get_cache_filename(host, directory)
+        self.entries = {}
+        self.identity = {}
+        if os.path.exists(self.filename):
+            try:
+                data = json.load(open(self.filename))
+                self.entries = data['entries']
+                self.identity = data['identity']
+            except (ValueError, KeyError):
+                pass
+
+    def lookup(self, commands):
+        # the cached values of every command, None when it has to be sent
+        now = time.time()
+        values = []
+        for command in commands:
+            ttl = self.get_ttl(command)
+            entry = self.entries.get(command.cmd)
+            values.append(entry[1] if ttl and entry and now - entry[0] < ttl else None)
+        return values
+
+    def update(self, commands, values, fresh):
+        # fresh: indexes of the commands just read from the unit. True when the unit changed and
+        # some values came from the cache
+        now = time.time()
+        changed = False
+        for i in fresh:
+            for param, value in zip(commands[i].cmd_params, values[i]):
+                if param.name not in IDENTITY_PARAMS or value in ['', []]:
+                    continue
+                old = self.identity.get(param.name)
+                if old is not None and (value < old if param.name == 'system_up_days' else value != old):
+                    changed = True
+                self.identity[param.name] = value
+
+        if changed:
+            self.entries = {}
+        for i in fresh:
+            if self.get_ttl(commands[i]) and is_complete(values[i]):
+                self.entries[commands[i].cmd] = [now, values[i]]
+        self.save()
+        return changed and len(fresh) < len(commands)
+
+    def get_ttl(self, command):
+        return self.ttls.get(getattr(command, 'cache_group', ''), 0)
+
+    def save(self):
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        tmp_filename = self.filename + '.tmp'
+        json.dump({'entries': self.entries, 'identity': self.identity}, open(tmp_filename, 'w'))
+        os.replace(tmp_filename, self.filename)
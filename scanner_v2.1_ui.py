@@ -1,5 +1,7 @@
 #!/usr/bin/python
+import siklu_api
 from siklu_api import *
+from collector import submit_job
 
 import streamlit as st
 import base64
@@ -19,8 +21,9 @@ if __name__ == '__main__':
 
     RINGS = int(st.number_input('Number of rings', value=3, format='%d'))
     MH_ENABLED = st.checkbox('Enable MH', True)
-    N_PROCESSES = int(st.number_input('Number of parallel processes', value=10, format='%d'))
+    N_PROCESSES = int(st.number_input('Max parallel processes (adapted at runtime)', value=10, format='%d'))
     CONNECTION_TIMEOUT_SEC = int(st.number_input('Connection timeout [sec]', value=12, format='%d'))
+    USE_COLLECTOR = st.checkbox('Submit to the collector (keeps sessions open between runs)', False)
 
     CSV_FILENAME = st.file_uploader("Choose a CSV file", type="csv")
 
@@ -31,7 +34,22 @@ if __name__ == '__main__':
 
     if st.button('Run'):
         if CSV_FILENAME is not None:
-            results_filename = units_manager_parallel(hosts)
+            if USE_COLLECTOR:
+                results_filename = submit_job(hosts, rings=RINGS, mh_enabled=MH_ENABLED)['filename']
+            else:
+                siklu_api.RINGS = RINGS
+                siklu_api.MH_ENABLED = MH_ENABLED
+                siklu_api.N_PROCESSES = N_PROCESSES
+                siklu_api.CONNECTION_TIMEOUT_SEC = CONNECTION_TIMEOUT_SEC
+
+                progress_bar = st.progress(0)
+                progress_text = st.empty()
+
+                def show_progress(progress):
+                    progress_bar.progress(progress.fraction())
+                    progress_text.text(str(progress))
+
+                results_filename = units_manager_parallel(hosts, show_progress)
 
             b64 = base64.b64encode(open(results_filename,
                                         'r').read().encode()).decode()  # some strings <-> bytes conversions necessary here
@@ -2,6 +2,7 @@ from __future__ import print_function
 
 import collections
 import os
+import queue
 import pandas as pd
 import platform
 import re
@@ -29,22 +30,113 @@ except:
 
 from datetime import datetime, timedelta
 
+import preflight
+import scan_cache
+import snapshot_store
+from concurrency_control import ConcurrencyController
+from latency_stats import latency
+
+RINGS = 0
+MH_ENABLED = False
+N_PROCESSES = 10
+CONNECTION_TIMEOUT_SEC = 12
+CSV_FILENAME = 'cfg.csv'
+PIPELINE_SCAN = True
+# the execution log is flushed every FLUSH_LINES results or FLUSH_INTERVAL_SEC, whichever comes first
+FLUSH_LINES = 50
+FLUSH_INTERVAL_SEC = 5
+# write every connect/command/parse wall time to timing_log_<ts>.csv
+TIMING_LOG = False
+# command line replacing ssh, {host} is the unit's ip, e.g. python siklu_simulator.py {host}
+SPAWN_CMD = ''
+# base url of the SW images, replaces the server in the upload_sw commands, e.g. http://10.0.0.5:8080 (firmware_server.py)
+FIRMWARE_URL = ''
+# TCP connect to port 22 of every host before the ssh workers start, unreachable ones are logged right away
+PREFLIGHT = True
+# units in flight set at runtime from the connect latency, timeouts and the box's load, N_PROCESSES is the upper bound
+ADAPTIVE_CONCURRENCY = True
+# serve the slow changing scan columns from scan_cache/<host>.json, see cache_group of the commands
+SCAN_CACHE = False
+# seconds the columns of the 'day' and 'config' cache groups are served
+CACHE_TTL_DAY = 24 * 3600
+CACHE_TTL_CONFIG = 6 * 3600
+# keep the scans in scan_history.db as changes only and write changes_<ts>.csv next to the execution log
+SCAN_HISTORY = False
+
+
+def load_config(filename=None):
+    global RINGS, MH_ENABLED, N_PROCESSES, CONNECTION_TIMEOUT_SEC, CSV_FILENAME, PIPELINE_SCAN, TIMING_LOG, SPAWN_CMD, \
+        FIRMWARE_URL, PREFLIGHT, ADAPTIVE_CONCURRENCY, SCAN_CACHE, CACHE_TTL_DAY, CACHE_TTL_CONFIG, SCAN_HISTORY
+
+    config = ConfigParser()
+    config.read_dict({'DEFAULT': {'RINGS': RINGS,
+                                  'MH_ENABLED': MH_ENABLED,
+                                  'N_PROCESSES': N_PROCESSES,
+                                  'CONNECTION_TIMEOUT_SEC': CONNECTION_TIMEOUT_SEC,
+                                  'CSV_FILENAME': CSV_FILENAME,
+                                  'PIPELINE_SCAN': PIPELINE_SCAN,
+                                  'TIMING_LOG': TIMING_LOG,
+                                  'SPAWN_CMD': SPAWN_CMD,
+                                  'FIRMWARE_URL': FIRMWARE_URL,
+                                  'PREFLIGHT': PREFLIGHT,
+                                  'ADAPTIVE_CONCURRENCY': ADAPTIVE_CONCURRENCY,
+                                  'SCAN_CACHE': SCAN_CACHE,
+                                  'CACHE_TTL_DAY': CACHE_TTL_DAY,
+                                  'CACHE_TTL_CONFIG': CACHE_TTL_CONFIG,
+                                  'SCAN_HISTORY': SCAN_HISTORY,
+                                  'PREFLIGHT_TIMEOUT_SEC': preflight.PREFLIGHT_TIMEOUT_SEC,
+                                  'PREFLIGHT_TTL_SEC': preflight.PREFLIGHT_TTL_SEC}})
+    if filename:
+        config.read(filename)
+
+    RINGS = config.getint('DEFAULT', 'RINGS')
+    MH_ENABLED = config.getboolean('DEFAULT', 'MH_ENABLED')
+    N_PROCESSES = config.getint('DEFAULT', 'N_PROCESSES')
+    CONNECTION_TIMEOUT_SEC = config.getint('DEFAULT', 'CONNECTION_TIMEOUT_SEC')
+    CSV_FILENAME = config.get('DEFAULT', 'CSV_FILENAME')
+    PIPELINE_SCAN = config.getboolean('DEFAULT', 'PIPELINE_SCAN')
+    TIMING_LOG = config.getboolean('DEFAULT', 'TIMING_LOG')
+    SPAWN_CMD = config.get('DEFAULT', 'SPAWN_CMD', raw=True)
+    FIRMWARE_URL = config.get('DEFAULT', 'FIRMWARE_URL')
+    PREFLIGHT = config.getboolean('DEFAULT', 'PREFLIGHT')
+    ADAPTIVE_CONCURRENCY = config.getboolean('DEFAULT', 'ADAPTIVE_CONCURRENCY')
+    SCAN_CACHE = config.getboolean('DEFAULT', 'SCAN_CACHE')
+    CACHE_TTL_DAY = config.getint('DEFAULT', 'CACHE_TTL_DAY')
+    CACHE_TTL_CONFIG = config.getint('DEFAULT', 'CACHE_TTL_CONFIG')
+    SCAN_HISTORY = config.getboolean('DEFAULT', 'SCAN_HISTORY')
+    preflight.PREFLIGHT_TIMEOUT_SEC = config.getfloat('DEFAULT', 'PREFLIGHT_TIMEOUT_SEC')
+    preflight.PREFLIGHT_TTL_SEC = config.getfloat('DEFAULT', 'PREFLIGHT_TTL_SEC')
+    return config
+
+
+def get_host_spawn_cmd(host):
+    return SPAWN_CMD.format(host=host) if SPAWN_CMD else None
+
+
+def get_cache_ttls():
+    # {cache_group: seconds} for scan_cache.ScanCache
+    return {'day': CACHE_TTL_DAY, 'config': CACHE_TTL_CONFIG}
+
 
 ############################################################################
 
 class SikluUnit:
-    def __init__(self, host, username, password, port='22', connection_timeout=12, debug=True):
+    def __init__(self, host, username, password, port='22', connection_timeout=12, debug=True, spawn_cmd=None):
         self.host = host
         self.user = username
         self.passwd = password
         self.port = port
         self.connection_timeout = connection_timeout
         self.debug = debug
+        # command line spawned instead of ssh/plink, e.g. a local CLI stand-in
+        self.spawn_cmd = spawn_cmd
         self.prompt = '~ #'
         self.prompt2 = ">$"
 
         self.connected = False
         self.connection = None
+        # full CLI prompt, e.g. 'EH-8010FX>', learnt when connecting
+        self.cli_prompt = '>'
 
         if platform.system() == 'Windows':
             self.sshask_newkey = 'Store key in cache?'
@@ -67,6 +159,13 @@ class SikluUnit:
     def __del__(self):
         self.disconnect()
 
+    def get_spawn_cmd(self):
+        if self.spawn_cmd:
+            return self.spawn_cmd
+        if platform.system() == 'Windows':
+            return r'plink -ssh %s@%s' % (self.user, self.host)
+        return 'ssh %s@%s' % (self.user, self.host)
+
     def connect(self):
         # renew SSH key
         # ssh - keygen - f  "/root/.ssh/known_hosts" - R 172.20.4.6
@@ -74,24 +173,25 @@ class SikluUnit:
             self.disconnect()
 
         kiss = True
+        start = time.time()
 
         try:
             if platform.system() == 'Windows':
-                foo = wexpect.spawn(r'plink -ssh %s@%s' % (self.user, self.host))
+                foo = wexpect.spawn(self.get_spawn_cmd())
             else:  # assume linux
-                foo = pexpect.spawn('ssh %s@%s' % (self.user, self.host))
+                foo = pexpect.spawn(self.get_spawn_cmd())
 
             i = foo.expect([TIMEOUT, self.sshask_newkey, self.sshask_passwd, self.noroutehost], timeout=self.connection_timeout)
 
             if i == 0:  ## Timeout
-                if debug:
+                if self.debug:
                     print("[%s] Connection timeout" % self.host)
                 kiss = False
             if i == 1:  ## lors de la premiere connexion
                 foo.sendline(self.sshask_newkey_answer)
                 j = foo.expect([TIMEOUT, self.sshask_passwd])
                 if j == 0:
-                    if debug:
+                    if self.debug:
                         print("[%s] Password incorrect" % self.host)
                     kiss = False
             if i == 3:
@@ -101,6 +201,7 @@ class SikluUnit:
             if kiss:
                 foo.sendline(self.passwd)
                 foo.expect(self.prompt2)
+                self.cli_prompt = self.decode(foo.before).split('\n')[-1].strip() + '>'
                 self.connection = foo
                 self.connected = True
                 if self.debug:
@@ -110,6 +211,8 @@ class SikluUnit:
                 print(e)
                 print("[%s] Unexpected error: %s" % (self.host, foo.before))
 
+        latency.record('connect', self.host, 'connected' if self.connected else 'failed', time.time() - start, start)
+
     def send_command(self, command, no_wait=False):
         if self.debug:
             print('[%s] %s' % (self.host, command))
@@ -117,20 +220,84 @@ class SikluUnit:
         if no_wait:
             return
 
-        self.connection.expect(self.prompt2)
+        with latency.measure('command', self.host, command):
+            self.connection.expect(self.prompt2)
+        return self.decode(self.connection.before)
+
+    def send_commands(self, commands):
+        # pipelined mode: all the commands go out in one burst and the output is split per command.
+        # Returns None when the CLI did not answer them one after the other (e.g. it echoed the queued input
+        # before running it), the caller then falls back to sending them one by one.
+        if self.debug:
+            print('[%s] %s' % (self.host, '; '.join(commands)))
+        self.connection.send(''.join(command + os.linesep for command in commands))
+
+        text = ''
+        timeout = self.connection.timeout * len(commands)
+        start = time.time()
+        deadline = start + timeout
+        # every prompt ends one command's reply, the time between prompts is that command's latency.
+        # The prompt is matched anywhere, '>$' only matches when it happens to end a read
+        prompt = re.escape(self.cli_prompt)
+        arrivals = []
+        try:
+            while text.count(self.cli_prompt) < len(commands):
+                self.connection.expect(prompt, timeout=max(deadline - time.time(), 1))
+                text += self.decode(self.connection.before) + self.decode(self.connection.after)
+                arrivals.append((time.time(), text.count(self.cli_prompt)))
+        finally:
+            latency.record_burst('command', self.host, commands, start, arrivals)
+
+        return self.split_replies(text, commands)
+
+    def split_replies(self, text, commands):
+        # every reply looks like the one send_command() returns: echoed command, output, prompt up to '>'
+        replies = []
+        start = 0
+        for i, command in enumerate(commands):
+            r = re.compile(r'[ ]*%s[ ]*\r?\n' % re.escape(command)).match(text, start)
+            if not r:
+                return None
+            end = text.find(self.cli_prompt, r.end())
+            if end < 0:
+                return None
+            end += len(self.cli_prompt) - 1
+            replies.append(text[start:end])
+            start = end + 1
+
+        return replies
+
+    def decode(self, data):
         try:
-            return self.connection.before.decode('utf-8')
+            return data.decode('utf-8')
         except:
-            return self.connection.before
+            return data
 
 
 #######################################################################################
+# regex endings of the 'key : value' params, these are matched together in one pass over the reply
+KEY_VALUE_SUFFIXES = (r"\s+: (.+)\n", r"\s+:\s+(.+)\n")
+
+
 class SikluCommandParam:
     def __init__(self, name='', value='', regex=r'', format_func=None):
         self.name = name
         self.value = value
         self.regex = regex
         self.format_func = format_func
+        # compiled once, for the class level cmd_params that is when the command class is defined
+        self.patterns = {}
+        if regex:
+            self.get_pattern()
+
+    def get_pattern(self, flags=0):
+        pattern = self.patterns.get(flags)
+        if pattern is None:
+            pattern = self.patterns[flags] = re.compile(self.regex, flags)
+        return pattern
+
+    def is_key_value(self):
+        return self.regex.endswith(KEY_VALUE_SUFFIXES) and self.get_pattern().groups == 1
 
 
 class SikluCommandParserBase:
@@ -138,33 +305,84 @@ class SikluCommandParserBase:
     cmd_params = [SikluCommandParam()]
     reverse_reply = False
     multiline = False
+    # match all the 'key : value' params in one pass over the reply, this only pays off for commands with
+    # dozens of them, for a few params the plain precompiled searches are faster
+    merge_key_values = False
+    # 'day' or 'config': the parsed values may be served from the scan cache for CACHE_TTL_DAY or
+    # CACHE_TTL_CONFIG seconds, '': read on every scan
+    cache_group = ''
 
     def __init__(self, connection=None):
         self.connection = connection
 
     def parse(self):
         if self.connection:
-            self.reply = self.connection.send_command(self.cmd)
-            if self.reverse_reply:
-                lines = self.reply.split("\r\n")
-                lines.reverse()
-                self.reply = r"\r\n".join(lines)
-        else:
-            self.reply = ''
-        return self.parse_reply()
+            return self.parse_text(self.connection.send_command(self.cmd))
+        return self.parse_text('')
+
+    def parse_text(self, reply):
+        # parse a reply that was already read from the unit
+        self.reply = reply
+        if self.reply and self.reverse_reply:
+            lines = self.reply.split("\r\n")
+            lines.reverse()
+            self.reply = r"\r\n".join(lines)
+        with latency.measure('parse', getattr(self.connection, 'host', ''), self.cmd):
+            return self.parse_reply()
 
     def parse_reply(self):
-        for param in self.cmd_params:
+        key_values = {}
+        pattern, index_set = None, ()
+        if self.merge_key_values:
+            cmd_params, pattern, indexes, index_set = self.get_key_value_pattern()
+        if pattern is not None:
+            for r in pattern.finditer(self.reply):
+                # one group per alternative, lastindex tells which param matched
+                i = indexes[r.lastindex - 1]
+                if i not in key_values:
+                    key_values[i] = r.group(r.lastindex).strip().replace(',', '')
+
+        # the values are collected here, not in the params: class level cmd_params are shared by
+        # every instance and the scanning threads parse at the same time
+        flags = self.get_flags()
+        values = []
+        for i, param in enumerate(self.cmd_params):
+            value = param.value
             if param.regex:
-                if param.format_func:
-                    param.value = param.format_func(self, self.find_value(param.regex, self.reply))
+                if i in index_set:
+                    value = key_values.get(i, [])
                 else:
-                    param.value = self.find_value(param.regex, self.reply)
-
-        return [param.value for param in self.cmd_params]
+                    r = param.get_pattern(flags).search(self.reply)
+                    value = r.group(1).strip().replace(',', '') if r else []
+                if param.format_func:
+                    value = param.format_func(self, value)
+            values.append(value)
+
+        return values
+
+    def get_flags(self):
+        return re.MULTILINE if self.multiline else 0
+
+    def get_key_value_pattern(self):
+        # all the 'key : value' params merged into one alternation, cached next to the cmd_params list
+        owner = self if 'cmd_params' in self.__dict__ else type(self)
+        cached = owner.__dict__.get('key_value_pattern')
+        if cached is None or cached[0] is not self.cmd_params:
+            indexes = [i for i, param in enumerate(self.cmd_params) if param.regex and param.is_key_value()]
+            pattern = None
+            if len(indexes) > 1 and self.merge_key_values:
+                pattern = re.compile('|'.join('(?:%s)' % self.cmd_params[i].regex for i in indexes),
+                                     self.get_flags())
+            else:
+                indexes = []
+            cached = (self.cmd_params, pattern, indexes, set(indexes))
+            setattr(owner, 'key_value_pattern', cached)
+        return cached
 
     def find_value(self, regex, text):
-        if self.multiline:
+        if hasattr(regex, 'search'):
+            r = regex.search(text)
+        elif self.multiline:
             r = re.search(regex, text, re.MULTILINE)
         else:
             r = re.search(regex, text)
@@ -200,12 +418,14 @@ class ShowSystem(SikluCommandParserBase):
 
 
 class ShowInventory(SikluCommandParserBase):
+    # the serial number tells a swapped unit, it is read on every scan and never served from the cache
     cmd = 'show inventory 1 serial'
     cmd_params = [SikluCommandParam('system_sn', '', r"inventory 1 serial\s+: (.+)\n"), ]
 
 
 class ShowNTP(SikluCommandParserBase):
     cmd = 'show ntp'
+    cache_group = 'config'
     cmd_params = [
         SikluCommandParam('ntp_1_server', '', r"ntp 1 server\s+: (.+)\n"),
         SikluCommandParam('ntp_1_tmz', '', r"ntp 1 tmz\s+: (.+)\n"),
@@ -214,6 +434,7 @@ class ShowNTP(SikluCommandParserBase):
 
 class ShowSNMPManager(SikluCommandParserBase):
     cmd = 'show snmp-mng'
+    cache_group = 'config'
     cmd_params = [
         SikluCommandParam('snmp_mng_1_ip_addr', '', r"snmp-mng 1 ip-addr\s+: (.+)\n"),
         SikluCommandParam('snmp_mng_1_sec_name', '', r"snmp-mng 1 security-name\s+: (.+)\n"),
@@ -222,6 +443,7 @@ class ShowSNMPManager(SikluCommandParserBase):
 
 class ShowSNMPAgent(SikluCommandParserBase):
     cmd = 'show snmp-agent'
+    cache_group = 'config'
     cmd_params = [
         SikluCommandParam('snmp_agent_read_com', '', r"snmp-agent read-com\s+: (.+)\n"),
         SikluCommandParam('snmp_agent_write_com', '', r"snmp-agent write-com\s+: (.+)\n"),
@@ -230,6 +452,7 @@ class ShowSNMPAgent(SikluCommandParserBase):
 
 class ShowSyslog(SikluCommandParserBase):
     cmd = 'show syslog'
+    cache_group = 'config'
     cmd_params = [
         SikluCommandParam('syslog_1_server', '', r"syslog 1 server\s+: (.+)\n"),
     ]
@@ -300,6 +523,7 @@ class ShowRSSI(SikluCommandParserBase):
 
 class ShowLicense(SikluCommandParserBase):
     cmd = 'show license'
+    cache_group = 'day'
     cmd_params = [SikluCommandParam('data_rate_status', '', r"license\s+data-rate\s+status\s+:\s+(.+)\n"),
                   SikluCommandParam('data_rate_permission', '', r"license\s+data-rate\s+permission\s+:\s+(.+)\n"),
                   ]
@@ -330,6 +554,7 @@ class ShowRing(SikluCommandParserBase):
 
 class ShowMngVLAN(SikluCommandParserBase):
     cmd = 'show bridge-port c3 eth1 pvid'
+    cache_group = 'config'
     cmd_params = [SikluCommandParam('eth1_pvid', '', r"bridge-port c3 eth1 pvid\s+: (.+)\n"),
                   ]
 
@@ -377,6 +602,7 @@ class ShowTU(SikluCommandParserBase):
 
 class ShowRemoteTU(SikluCommandParserBase):
     cmd = 'show remote-terminal-unit'
+    merge_key_values = True
 
     def __init__(self, connection=None):
         SikluCommandParserBase.__init__(self, connection)
@@ -402,6 +628,7 @@ class ShowRemoteTU(SikluCommandParserBase):
 
 class ShowLLDPRemote(SikluCommandParserBase):
     cmd = 'show lldp-remote'
+    merge_key_values = True
 
     def __init__(self, connection=None):
         SikluCommandParserBase.__init__(self, connection)
@@ -423,10 +650,15 @@ class ShowLLDPRemote(SikluCommandParserBase):
 class ShowRfStatisticsDaily(SikluCommandParserBase):
     cmd = 'show rf statistics-summary-days'
     multiline = True
+    n_days = 32
+    # the line of any day, matched at every line start instead of searching the reply once per day
+    row_regex = re.compile(r"(\d+)\s+[\.\d]+\s+[:\d]+\s+[-\d]+\s+[-\d]+\s+[-\d]+\s+[-\d]+\s+([\w\d]+)\s+[\w\d]+\s+[yesno]+")
+    line_start = re.compile(r"^(?=\d)", re.MULTILINE)
 
     def __init__(self, connection=None):
         SikluCommandParserBase.__init__(self, connection)
-        self.cmd_params = [item for sublist in [self.gen_cmd_params(day) for day in range(0, 32)] for item in sublist]
+        self.cmd_params = [item for sublist in [self.gen_cmd_params(day) for day in range(0, self.n_days)] for item in
+                           sublist]
 
     def gen_cmd_params(self, day):
         return [
@@ -437,142 +669,166 @@ class ShowRfStatisticsDaily(SikluCommandParserBase):
                               r"^%d\s+[\.\d]+\s+[:\d]+\s+[-\d]+\s+[-\d]+\s+[-\d]+\s+[-\d]+\s+([\w\d]+)\s+[\w\d]+\s+[yesno]+" % day),
         ]
 
+    def parse_reply(self):
+        mods = {}
+        for line in self.line_start.finditer(self.reply):
+            r = self.row_regex.match(self.reply, line.start())
+            if r and int(r.group(1)) not in mods:
+                mods[int(r.group(1))] = r.group(2).strip().replace(',', '')
+        return [mods.get(day, []) for day in range(0, self.n_days)]
+
 
-class ShowRfStatisticsSummary(SikluCommandParserBase):
+class SikluTableParserBase(SikluCommandParserBase):
+    # statistics-summary tables, one row per interval, parsed in a single pass over the reply
     multiline = True
-    columns = ['interval', 'start_ts', 'min-rssi', 'max-rssi', 'min-cinr', 'max-cinr', 'min-mod', 'max-mod']
+    n_intervals = 96
+    columns = []
+    int_columns = []
+    # groups: interval, date, time, then one group per remaining column
+    row_regex = None
 
-    def __init__(self, connection=None):
-        self.cmd = 'show rf statistics-summary'
+    def __init__(self, connection=None, since=None):
         SikluCommandParserBase.__init__(self, connection)
-        self.cmd_params = [item for sublist in [self.gen_cmd_params(time_interval) for time_interval in range(0, 96)]
-                           for item in sublist]
-
-    def gen_cmd_params(self, time_interval):
-        return [
-            SikluCommandParam('record_%d' % time_interval, '',
-                              r"^(%d\s+[\.\d]+\s+[:\d]+\s+[-\d]+\s+[-\d]+\s+[-\d]+\s+[-\d]+\s+[\w\d\s\.]+\s{2,}[\w\d\s\.]+\s{2,}[yesnounknown]+)" % time_interval),
-        ]
+        self.cmd_params = []
+        # only intervals starting after since are parsed, the unit's 'YYYY.MM.DD HH:MM:SS' sorts as text
+        if isinstance(since, datetime):
+            since = since.strftime('%Y.%m.%d %H:%M:%S')
+        self.since = since
+
+    def find_rows(self):
+        # first row of every interval, ordered by interval
+        rows = {}
+        for r in self.row_regex.finditer(self.reply):
+            interval = int(r.group(1))
+            if interval < self.n_intervals and interval not in rows:
+                # the interval at the watermark is read again: it may have been stored while still in
+                # progress, the upsert overwrites it with its final values
+                if self.since and r.group(2) + ' ' + r.group(3) < self.since:
+                    continue
+                rows[interval] = r.groups()
+        return [rows[interval] for interval in sorted(rows)]
 
     def parse_reply(self):
-        stats = []
-        for param in self.cmd_params:
-            interval_values = self.find_value(param.regex, self.reply)
-            # import pdb; pdb.set_trace()
-            if interval_values:
-                r = re.search(
-                    r"(\d+)\s+([\.\d]+\s+[:\d]+)\s+([-\d]+)\s+([-\d]+)\s+([-\d]+)\s+([-\d]+)\s+([\w\d\s\.]+)\s{2,}([\w\d\s\.]+)",
-                    interval_values)
-                if r:
-                    r = r.groups()
-                    stats.append(
-                        [int(r[0]), datetime.strptime(r[1], '%Y.%m.%d %H:%M:%S'), int(r[2]), int(r[3]), int(r[4]),
-                         int(r[5]), r[6], r[7]])
-                else:
-                    continue
+        rows = self.find_rows()
+        values = list(zip(*rows)) if rows else [()] * (len(self.columns) + 1)
+
+        data = collections.OrderedDict()
+        data[self.columns[0]] = [int(x) for x in values[0]]
+        data[self.columns[1]] = pd.to_datetime([d + ' ' + t for d, t in zip(values[1], values[2])],
+                                               format='%Y.%m.%d %H:%M:%S')
+        for column, column_values in zip(self.columns[2:], values[3:]):
+            if column in self.int_columns:
+                data[column] = [int(x) for x in column_values]
+            else:
+                data[column] = list(column_values)
 
-        return pd.DataFrame(stats, columns=self.columns)
+        return pd.DataFrame(data, columns=self.columns)
 
     def __str__(self):
         return ','.join(self.columns)
 
 
-class ShowRfStatisticsSummaryLast(SikluCommandParserBase):
-    columns = ['valid_line', 'min-rssi', 'min-cinr', 'min-mod']
-    multiline = True
+class ShowRfStatisticsSummary(SikluTableParserBase):
+    cmd = 'show rf statistics-summary'
+    # valid is 'no' for the interval still in progress, it is not a column of the stats table
+    columns = ['interval', 'start_ts', 'min-rssi', 'max-rssi', 'min-cinr', 'max-cinr', 'min-mod', 'max-mod', 'valid']
+    int_columns = ['min-rssi', 'max-rssi', 'min-cinr', 'max-cinr']
+    # a modulation is a name optionally followed by numbers, e.g. "qam64" or "qam64 4 0.75"
+    row_regex = re.compile(r"^(\d+)\s+([\.\d]+)\s+([:\d]+)\s+(-?\d+)\s+(-?\d+)\s+(-?\d+)\s+(-?\d+)\s+"
+                           r"(\w+(?: [\.\d]+)*)\s+(\w+(?: [\.\d]+)*)\s+(yes|no|unknown)\b", re.MULTILINE)
 
-    def __init__(self, connection=None):
-        self.cmd = 'show rf statistics-summary'
-        SikluCommandParserBase.__init__(self, connection)
-        self.cmd_params = [item for sublist in
-                           [self.gen_cmd_params(time_interval) for time_interval in range(95, -1, -1)] for item in
-                           sublist]
 
-    def gen_cmd_params(self, time_interval):
-        return [
-            SikluCommandParam('record_%d' % time_interval, '',
-                              r"^(%d\s+[\.\d]+\s+[:\d]+\s+[-\d]+\s+[-\d]+\s+[-\d]+\s+[-\d]+\s+[\w\d]+\s+[\w\d]+\s+[yesno]+)" % time_interval),
-        ]
+class ShowRfStatisticsSummaryLast(SikluTableParserBase):
+    cmd = 'show rf statistics-summary'
+    columns = ['valid_line', 'min-rssi', 'min-cinr', 'min-mod']
+    row_regex = ShowRfStatisticsSummary.row_regex
 
     def parse_reply(self):
-        valid_line = 95
-        for param in self.cmd_params:
-            interval_values = self.find_value(param.regex, self.reply)
-            # import pdb; pdb.set_trace()
-            if interval_values:
-                r = re.search(
-                    r"(\d+)\s+([\.\d]+\s+[:\d]+)\s+([-\d]+)\s+([-\d]+)\s+([-\d]+)\s+([-\d]+)\s+([\w\d]+)\s+([\w\d]+)",
-                    interval_values)
-                if r:
-                    r = r.groups()
-                    if int(r[0]) == valid_line:
-                        return [int(r[0]), int(r[2]), int(r[4]), r[6]]
-                    else:
-                        valid_line = int(r[0]) - 1
-                else:
-                    continue
+        valid_line = self.n_intervals - 1
+        for r in reversed(self.find_rows()):
+            if int(r[0]) == valid_line:
+                return [int(r[0]), int(r[3]), int(r[5]), r[7]]
+            else:
+                valid_line = int(r[0]) - 1
 
         return ["", "", "", ""]
 
-    def __str__(self):
-        return ','.join(self.columns)
 
-
-class ShowEthStatisticsSummary(SikluCommandParserBase):
-    multiline = True
+class ShowEthStatisticsSummary(SikluTableParserBase):
     columns = ['interval', 'start_ts', 'interface', 'in-octets', 'out-octets', 'in-rate', 'out-rate', 'util']
+    int_columns = ['in-octets', 'out-octets', 'in-rate', 'out-rate', 'util']
+    row_regex = re.compile(r"^(\d+)\s+([\.\d]+)\s+([:\d]+)\s+(eth\d)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)",
+                           re.MULTILINE)
 
-    def __init__(self, connection=None, eth='eth1'):
+    def __init__(self, connection=None, eth='eth1', since=None):
+        SikluTableParserBase.__init__(self, connection, since)
         self.cmd = 'show eth %s statistics-summary' % eth
-        SikluCommandParserBase.__init__(self, connection)
-        self.cmd_params = [item for sublist in [self.gen_cmd_params(time_interval) for time_interval in range(0, 96)]
-                           for item in sublist]
-
-    def gen_cmd_params(self, time_interval):
-        return [
-            SikluCommandParam('record_%d' % time_interval, '',
-                              r"^(%d\s+[\.\d]+\s+[:\d]+\s+eth\d\s+[\d]+\s+[\d]+\s+[\d]+\s+[\d]+\s+[\d]+)" % time_interval),
-        ]
 
-    def parse_reply(self):
-        stats = []
-        # print self.reply
-        for param in self.cmd_params:
-            interval_values = self.find_value(param.regex, self.reply)
-            # print param.regex
-            # import pdb; pdb.set_trace()
-            if interval_values:
-                r = re.search(
-                    r"(\d+)\s+([\.\d]+\s+[:\d]+)\s+(eth[\d])\s+([\d]+)\s+([\d]+)\s+([\d]+)\s+([\d]+)\s+([\d]+)",
-                    interval_values)
-                if r:
-                    r = r.groups()
-                    stats.append(
-                        [int(r[0]), datetime.strptime(r[1], '%Y.%m.%d %H:%M:%S'), r[2], int(r[3]), int(r[4]), int(r[5]),
-                         int(r[6]), int(r[7])])
-                else:
-                    continue
 
-        return pd.DataFrame(stats, columns=self.columns)
+#######################################################################################
+def parse_commands(unit, commands, pipeline=False):
+    # the values of every command
+    if not commands:
+        return []
+
+    replies = None
+    if pipeline:
+        replies = unit.send_commands([command.cmd for command in commands])
+
+    values = []
+    if replies is None:
+        # strict sequential mode, one round trip per command
+        for command in commands:
+            command.set_connection(unit)
+            values.append(command.parse())
+    else:
+        for command, reply in zip(commands, replies):
+            command.set_connection(unit)
+            values.append(command.parse_text(reply))
 
-    def __str__(self):
-        return ','.join(self.columns)
+    return values
 
 
-#######################################################################################
-def scan_unit(unit, commands):
+def scan_unit(unit, commands, pipeline=False, cache=None):
+    # with a scan_cache.ScanCache only the commands without a valid cached value are sent
     status = [unit.host, 'scan', True]
 
-    for command in commands:
-        command.set_connection(unit)
-        status += command.parse()
+    values = cache.lookup(commands) if cache else [None] * len(commands)
+    fresh = [i for i, value in enumerate(values) if value is None]
+    for i, value in zip(fresh, parse_commands(unit, [commands[i] for i in fresh], pipeline)):
+        values[i] = value
 
+    if cache and cache.update(commands, values, fresh):
+        # rebooted or replaced since the cache was filled, the cached columns are read again
+        cached = [i for i in range(len(commands)) if i not in fresh]
+        for i, value in zip(cached, parse_commands(unit, [commands[i] for i in cached], pipeline)):
+            values[i] = value
+        cache.update(commands, values, range(len(commands)))
+
+    for value in values:
+        status += value
     return status
 
 
-def copy_sw_unit(unit, command):
+def get_firmware_command(command):
+    # the image url pointed at FIRMWARE_URL, the file name is kept
+    if not FIRMWARE_URL:
+        return command
+    words = command.split(' ')
+    for i, word in enumerate(words):
+        if '://' in word:
+            words[i] = FIRMWARE_URL.rstrip('/') + '/' + word.split('/')[-1]
+    return ' '.join(words)
+
+
+def copy_sw_unit(unit, command, tracker=None, callback=None):
+    # with a transfer_tracker.TransferTracker the callback fires once the image is in the standby bank
     try:
-        status = unit.send_command(command.replace('upload_sw', 'copy'), no_wait=True)
+        command = get_firmware_command(command.replace('upload_sw', 'copy'))
+        if tracker:
+            tracker.track(unit, 'sw', command, callback)
+        else:
+            unit.send_command(command, no_wait=True)
         status = [unit.host, 'copy', True]
     except Exception as e:
         print(e)
@@ -605,9 +861,13 @@ def accept_unit(unit):
     return status
 
 
-def copy_script_unit(unit, command):
+def copy_script_unit(unit, command, tracker=None, callback=None):
     try:
-        status = unit.send_command(command.replace('upload_script', 'copy'), no_wait=True)
+        command = command.replace('upload_script', 'copy')
+        if tracker:
+            tracker.track(unit, 'script', command, callback)
+        else:
+            unit.send_command(command, no_wait=True)
         status = [unit.host, 'upload_script', True]
     except Exception as e:
         print(e)
@@ -646,23 +906,33 @@ def run_command(unit_):
         unit.connect()
 
     if unit.connected:
-        if command.startswith('upload_sw'):
-            status = copy_sw_unit(unit, command)
-        elif command.startswith('run_sw'):
-            status = run_sw_unit(unit, accept_timeout=600, rollback_timeout=600)
-        elif command.startswith('accept'):
-            status = accept_unit(unit)
-        elif command.startswith('scan'):
-            commands = unit_['scan_commands']
-            status = scan_unit(unit, commands)
-        elif command.startswith('upload_script'):
-            status = copy_script_unit(unit, command)
-        elif command.startswith('run_script'):
-            status = run_script_unit(unit, command)
-        elif command.startswith('run_command'):
-            status = run_command_unit(unit, command)
-        else:
-            status = [unit.host, command, False, 'Invalid command']
+        try:
+            if not command.startswith('scan') and not command.startswith('upload'):
+                # run_sw, accept, run_script and run_command may change what the cache holds
+                scan_cache.invalidate(unit.host)
+            if command.startswith('upload_sw'):
+                status = copy_sw_unit(unit, command)
+            elif command.startswith('run_sw'):
+                status = run_sw_unit(unit, accept_timeout=600, rollback_timeout=600)
+            elif command.startswith('accept'):
+                status = accept_unit(unit)
+            elif command.startswith('scan'):
+                commands = unit_['scan_commands']
+                cache = (scan_cache.ScanCache(unit.host, unit_.get('cache_ttls') or get_cache_ttls())
+                         if unit_.get('scan_cache', SCAN_CACHE) else None)
+                status = scan_unit(unit, commands, unit_.get('pipeline', PIPELINE_SCAN), cache)
+            elif command.startswith('upload_script'):
+                status = copy_script_unit(unit, command)
+            elif command.startswith('run_script'):
+                status = run_script_unit(unit, command)
+            elif command.startswith('run_command'):
+                status = run_command_unit(unit, command)
+            else:
+                status = [unit.host, command, False, 'Invalid command']
+        except Exception as e:
+            # e.g. a scan timing out on a hung unit, report it instead of failing the whole run
+            print("[%s] %s" % (unit.host, e))
+            status = [unit.host, command.split(' ')[0], False, str(e).splitlines()[0] if str(e) else repr(e)]
     else:
         status = [unit.host, 'scan', False, 'No connection']
 
@@ -671,8 +941,18 @@ def run_command(unit_):
     return s
 
 
-def units_manager_parallel(hosts):
-    units = []
+def run_command_timed(unit_):
+    # run_command in a Pool worker, the worker's timing samples travel back with the reply
+    latency.collect()
+    reply = run_command(unit_)
+    return reply, latency.drain()
+
+
+def get_scan_commands(rings=None, mh_enabled=None):
+    if rings is None:
+        rings = RINGS
+    if mh_enabled is None:
+        mh_enabled = MH_ENABLED
 
     # add scan commands here
     scan_commands = [ShowInventory(), ShowSystem(), ShowNTP(),
@@ -680,27 +960,198 @@ def units_manager_parallel(hosts):
                      ShowRfStatisticsSummaryLast(),
                      ShowSW(), ShowRF(), ShowRFDebug(), ShowLicense(),
                      ShowMngVLAN(), ShowEth1(), ShowEth2(), ShowEth3(), ShowLLDPRemote()] \
-                    + [ShowRing(ring_num=n + 1) for n in range(RINGS)] \
+                    + [ShowRing(ring_num=n + 1) for n in range(rings)] \
                     + [ShowRfStatisticsDaily(), ]
 
-    if MH_ENABLED:
+    if mh_enabled:
         scan_commands += [ShowBU(), ShowTU(), ShowRemoteTU()]
 
-    for i, host in hosts.iterrows():
-        unit = SikluUnit(host['ip'], host['user'], host['password'])
-        units.append({'unit': unit, 'command': host['command'], 'scan_commands': scan_commands})
+    return scan_commands
+
 
+def get_execution_log_filename():
     ts = time.strftime('%d%m%Y_%H%M', time.localtime())
-    filename = 'execution_log_%s.csv' % ts
+    return 'execution_log_%s.csv' % ts
+
+
+def get_execution_log_header(scan_commands):
+    return 'time_stamp,host,command,command_status,' + ','.join(str(command) for command in scan_commands) + '\n'
+
+
+class ExecutionLogWriter:
+    # execution log written line by line as the units complete, flushed periodically
+    def __init__(self, filename, header, flush_lines=None, flush_interval=None):
+        self.filename = filename
+        self.flush_lines = flush_lines or FLUSH_LINES
+        self.flush_interval = flush_interval or FLUSH_INTERVAL_SEC
+        self.pending = 0
+        self.last_flush = time.time()
+        self.fid = open(filename, 'w')
+        self.fid.write(header)
+        self.fid.flush()
+
+    def write(self, line):
+        self.fid.write(line + '\n')
+        self.pending += 1
+        if self.pending >= self.flush_lines or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.fid.flush()
+        self.pending = 0
+        self.last_flush = time.time()
+
+    def close(self):
+        self.fid.close()
+
+
+class ScanProgress:
+    # done/failed/in-flight counters and ETA of a run, fed with the execution log lines
+    def __init__(self, total, max_in_flight):
+        self.total = total
+        self.max_in_flight = max_in_flight
+        self.done = 0
+        self.failed = 0
+        self.start = time.time()
+
+    def update(self, line):
+        self.done += 1
+        fields = line.split(',')
+        if len(fields) < 4 or fields[3] != 'True':
+            self.failed += 1
+
+    def in_flight(self):
+        return min(self.max_in_flight, self.total - self.done)
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def eta(self):
+        # seconds, None until the first unit completed
+        if not self.done:
+            return None
+        return self.elapsed() / self.done * (self.total - self.done)
+
+    def fraction(self):
+        return float(self.done) / self.total if self.total else 1.0
 
-    file_header = 'time_stamp,host,command,command_status,' + ','.join(str(command) for command in scan_commands) + '\n'
+    def __str__(self):
+        eta = self.eta()
+        return 'done %d/%d, failed %d, in flight %d, elapsed %s, ETA %s' % (
+            self.done, self.total, self.failed, self.in_flight(),
+            timedelta(seconds=int(self.elapsed())), '-' if eta is None else timedelta(seconds=int(eta)))
 
-    pool = Pool(processes=N_PROCESSES)
-    replies = pool.map(run_command, units)
-    pool.close()
-    pool.join()
 
-    fid = open(filename, 'w')
-    fid.write(file_header)
-    fid.write('\n'.join(replies))
+def preflight_units(units):
+    # (reachable units, execution log lines of the others). Not done when SPAWN_CMD replaces ssh
+    if not PREFLIGHT or SPAWN_CMD or not units:
+        return units, []
+    results = preflight.check_hosts([unit_['unit'].host for unit_ in units])
+    ts = time.strftime('%d-%m-%Y %H:%M:%S', time.localtime())
+    reachable, replies = [], []
+    for unit_ in units:
+        alive, reason = results[unit_['unit'].host]
+        if alive:
+            reachable.append(unit_)
+        else:
+            replies.append(','.join([ts, unit_['unit'].host, unit_['command'].split(' ')[0], 'False', reason]))
+    return reachable, replies
+
+
+def imap_adaptive(pool, units, controller):
+    # run_command_timed of the units in completion order, like imap_unordered, with at most
+    # controller.limit of them in the pool at a time
+    done = queue.Queue()
+    pending = list(reversed(units))
+    in_flight = 0
+    while pending or in_flight:
+        while pending and in_flight < controller.limit:
+            pool.apply_async(run_command_timed, (pending.pop(),), callback=done.put, error_callback=done.put)
+            in_flight += 1
+        result = done.get()
+        in_flight -= 1
+        if isinstance(result, BaseException):
+            raise result
+        controller.update(result[0], result[1], in_flight)
+        yield result
+
+
+def record_scan_history(filename):
+    # the changes of the scan into the history, a failure there does not fail the run
+    if not SCAN_HISTORY:
+        return None
+    try:
+        return snapshot_store.record_scan(filename)
+    except Exception as e:
+        print('Scan history: %s' % e)
+        return None
+
+
+def print_progress(progress):
+    print('\r' + str(progress), end='\n' if progress.done == progress.total else '')
+    sys.stdout.flush()
+
+
+def units_manager_parallel(hosts, progress_callback=None):
+    units = []
+
+    scan_commands = get_scan_commands()
+
+    for i, host in hosts.iterrows():
+        unit = SikluUnit(host['ip'], host['user'], host['password'], connection_timeout=CONNECTION_TIMEOUT_SEC,
+                         spawn_cmd=get_host_spawn_cmd(host['ip']))
+        units.append({'unit': unit, 'command': host['command'], 'scan_commands': scan_commands,
+                      'pipeline': PIPELINE_SCAN, 'scan_cache': SCAN_CACHE, 'cache_ttls': get_cache_ttls()})
+
+    filename = get_execution_log_filename()
+    log = ExecutionLogWriter(filename, get_execution_log_header(scan_commands))
+    progress = ScanProgress(len(units), N_PROCESSES)
+    if TIMING_LOG:
+        latency.open_timing_file(filename.replace('execution_log', 'timing_log'))
+
+    units, replies = preflight_units(units)
+    for reply in replies:
+        log.write(reply)
+        progress.update(reply)
+    if progress_callback and replies:
+        progress_callback(progress)
+
+    pool = Pool(processes=N_PROCESSES)
+    controller = None
+    if ADAPTIVE_CONCURRENCY:
+        controller = ConcurrencyController(N_PROCESSES, filename.replace('execution_log', 'concurrency_log'))
+        replies = imap_adaptive(pool, units, controller)
+    else:
+        replies = pool.imap_unordered(run_command_timed, units)
+    try:
+        # every reply is written as soon as its unit completes, a hung unit only delays itself
+        for reply, samples in replies:
+            latency.merge(samples)
+            log.write(reply)
+            if controller:
+                progress.max_in_flight = controller.limit
+            progress.update(reply)
+            if progress_callback:
+                progress_callback(progress)
+    finally:
+        pool.close()
+        pool.join()
+        log.close()
+        if controller:
+            controller.close()
+        latency.close_timing_file()
+
+    record_scan_history(filename)
     return filename
+
+
+##############################################################################
+##############################################################################
+if __name__ == '__main__':
+    # python siklu_api.py [file.ini]
+    load_config(sys.argv[1] if len(sys.argv) > 1 else None)
+
+    hosts = pd.read_csv(CSV_FILENAME, comment='#')
+    hosts.dropna(subset=['ip', 'user', 'command'], how='any', inplace=True)
+    print(units_manager_parallel(hosts, print_progress))
+    print(latency.report())
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# Local stand-in for a Siklu unit's CLI, spawned by SikluUnit instead of ssh (see SPAWN_CMD in file.ini):
+#   python siklu_simulator.py HOST [--latency 0.05] [--jitter 0.01] [--loss 0.01] [--reply-size 0] ...
+# It asks for the password like ssh does, then answers the show commands with the captured replies in
+# fixtures/. Only the standard library is imported, thousands of these may run at the same time.
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from urllib.request import urlopen
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+PROMPT = 'EH-8010FX>'
+# extra delay of a lost segment, doubled for every retransmission like TCP does
+RETRANSMIT_SEC = 0.2
+
+
+SHOW_SW_HEADER = 'Flash Banks   Version       Date         Time       Running   Scheduled to run   Startup'
+
+
+def load_replies():
+    replies = {}
+    for filename in os.listdir(FIXTURES_DIR):
+        lines = open(os.path.join(FIXTURES_DIR, filename), newline='').read().split('\r\n')
+        # first line is the echoed command, last one the prompt
+        replies[lines[0]] = '\r\n'.join(lines[1:-1])
+    return replies
+
+
+class SikluSimulator:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed if args.seed is not None else args.host)
+        # the \n of a \r\n pair ends nothing, the \r already ended the line
+        self.after_cr = False
+        self.replies = load_replies()
+        self.fd_in = sys.stdin.fileno()
+        self.fd_out = sys.stdout.fileno()
+        self.state = self.load_state()
+
+    def get_state_filename(self):
+        return os.path.join(self.args.state_dir, '%s.json' % self.args.host) if self.args.state_dir else None
+
+    def load_state(self):
+        # SW banks, pending copy and reboot of the unit, kept between sessions with --state-dir
+        filename = self.get_state_filename()
+        if filename and os.path.exists(filename):
+            return json.load(open(filename))
+        return {'banks': [['10.5.0', '2019-11-06', '16:18:01', 'yes'], ['10.1.2', '2019-01-15', '10:11:22', 'no']],
+                'copy_version': None, 'copy_done_at': 0, 'reboot_until': 0, 'accepted': True}
+
+    def save_state(self):
+        filename = self.get_state_filename()
+        if filename:
+            tmp_filename = filename + '.tmp'
+            json.dump(self.state, open(tmp_filename, 'w'))
+            os.replace(tmp_filename, filename)
+
+    def update_copy(self):
+        # the copied image lands in the bank that is not running
+        state = self.state
+        if state['copy_version'] and time.time() >= state['copy_done_at']:
+            bank = [b for b in state['banks'] if b[3] == 'no'][0]
+            bank[:3] = [state['copy_version'], time.strftime('%Y-%m-%d'), time.strftime('%H:%M:%S')]
+            state['copy_version'] = None
+            self.save_state()
+
+    def show_sw(self):
+        self.update_copy()
+        lines = [SHOW_SW_HEADER]
+        for i, (version, date, time_, running) in enumerate(self.state['banks']):
+            lines.append('%-14s%-14s%-13s%-11s%-10s%-19s%s' % (i + 1, version, date, time_, running, 'no', running))
+        return '\r\n'.join(lines)
+
+    def download(self, url):
+        try:
+            response = urlopen(url, timeout=60)
+            while response.read(64 * 1024):
+                pass
+            self.state['copy_done_at'] = time.time()
+        except Exception:
+            self.state['copy_version'] = None
+        self.save_state()
+
+    def sw_command(self, command):
+        # copy sw <url>, run sw ..., accept sw
+        state = self.state
+        if command.startswith('copy sw') or command.startswith('copy ') and '/' in command:
+            r = re.search(r"(\d+\.\d+\.\d+(?:\.\d+)?)", command.split('/')[-1])
+            state['copy_version'] = r.groups()[0] if r else 'unknown'
+            state['copy_done_at'] = time.time() + self.args.copy_sec
+            url = [word for word in command.split() if '://' in word]
+            if self.args.download and url:
+                # done when the whole image was read from the server
+                state['copy_done_at'] = float('inf')
+                thread = threading.Thread(target=self.download, args=(url[0],))
+                thread.daemon = True
+                thread.start()
+            self.save_state()
+        elif command.startswith('run sw'):
+            self.update_copy()
+            for bank in state['banks']:
+                bank[3] = 'no' if bank[3] == 'yes' else 'yes'
+            state['accepted'] = False
+            state['reboot_until'] = time.time() + self.args.reboot_sec
+            self.save_state()
+            # the unit reboots a moment later, the session drops
+            threading.Timer(1.0, os._exit, [0]).start()
+        elif command == 'accept sw':
+            state['accepted'] = True
+            self.save_state()
+
+    def write(self, text):
+        os.write(self.fd_out, text.encode('utf-8'))
+
+    def delay(self, base):
+        d = base + self.random.gauss(0, self.args.jitter) if self.args.jitter else base
+        rto = RETRANSMIT_SEC
+        while self.args.loss and self.random.random() < self.args.loss:
+            d += rto
+            rto *= 2
+        if d > 0:
+            time.sleep(d)
+
+    def readline(self, echo=True):
+        # raw mode: the line is echoed when the CLI gets to it, like the unit's own CLI does
+        line = b''
+        while True:
+            c = os.read(self.fd_in, 1)
+            if not c:
+                return None
+            after_cr, self.after_cr = self.after_cr, c == b'\r'
+            if c == b'\n' and after_cr and not line:
+                continue
+            if c in (b'\r', b'\n'):
+                # an empty line is answered with a new prompt, like the unit's CLI does
+                break
+            line += c
+        text = line.decode('utf-8', 'replace')
+        if echo:
+            self.write(text + '\r\n')
+        return text
+
+    def reply(self, command):
+        if command == 'show sw':
+            text = self.show_sw()
+        elif command.startswith('copy ') or command.startswith('run sw') or command == 'accept sw':
+            self.sw_command(command)
+            text = ''
+        elif command in self.replies:
+            text = self.replies[command]
+        elif command.startswith('show ring '):
+            text = ''
+        elif command.startswith('show '):
+            text = '%% Unknown command: %s' % command
+        else:
+            # copy, run, accept, set ... succeed silently
+            text = ''
+        if self.args.reply_size:
+            filler = ' ' * 79
+            text += ''.join('\r\n' + filler for i in range(self.args.reply_size // 80))
+        return text + '\r\n' if text else ''
+
+    def run(self):
+        args = self.args
+        if args.unreachable or self.random.random() < args.dead_rate or time.time() < self.state['reboot_until']:
+            time.sleep(3600)
+            return
+
+        self.delay(args.connect_delay if args.connect_delay is not None else 2 * args.latency)
+        # the terminal mode is set before the password prompt, a password typed right after it would be
+        # flushed with the pending input
+        import termios
+        if not args.line_echo:
+            import tty
+            tty.setraw(self.fd_in, termios.TCSANOW)
+        else:
+            # canonical mode, the pty echoes queued input before the CLI reads it
+            attrs = termios.tcgetattr(self.fd_in)
+            attrs[3] &= ~termios.ECHO
+            termios.tcsetattr(self.fd_in, termios.TCSANOW, attrs)
+        self.write("%s@%s's password: " % (args.user, args.host))
+        self.readline(echo=False)
+        if args.line_echo:
+            attrs[3] |= termios.ECHO
+            termios.tcsetattr(self.fd_in, termios.TCSANOW, attrs)
+        self.write('\r\n')
+        self.delay(args.latency)
+
+        while True:
+            self.write(PROMPT)
+            command = self.readline(echo=not args.line_echo)
+            if command is None or command.strip() == 'exit':
+                break
+            command = command.strip()
+            if command:
+                self.delay(args.latency)
+                self.write(self.reply(command))
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description='Siklu CLI simulator')
+    parser.add_argument('host')
+    parser.add_argument('--user', default='admin')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every reply')
+    parser.add_argument('--jitter', type=float, default=0.0, help='std. deviation of the latency, seconds')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability a reply needs a retransmission')
+    parser.add_argument('--connect-delay', type=float, default=None, help='seconds before the password prompt')
+    parser.add_argument('--reply-size', type=int, default=0, help='bytes of padding added to every reply')
+    parser.add_argument('--unreachable', action='store_true', help='never answer, like a dead host')
+    parser.add_argument('--dead-rate', type=float, default=0.0, help='fraction of the hosts that never answer')
+    parser.add_argument('--line-echo', action='store_true', help='echo queued input early (no pipelining)')
+    parser.add_argument('--state-dir', default=None, help='keep the SW banks of every unit in this directory')
+    parser.add_argument('--copy-sec', type=float, default=10.0, help='seconds a copy sw takes')
+    parser.add_argument('--download', action='store_true', help='copy sw reads the image from its url instead')
+    parser.add_argument('--reboot-sec', type=float, default=30.0, help='seconds a unit is down after run sw')
+    parser.add_argument('--seed', type=int, default=None)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    try:
+        SikluSimulator(get_args()).run()
+    except (KeyboardInterrupt, OSError):
+        pass
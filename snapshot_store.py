@@ -0,0 +1,232 @@
+#!/usr/bin/python
+# History of the scans: the last full state of every host plus the changed columns of every scan.
+#   python snapshot_store.py ingest execution_log_<ts>.csv ...   (writes changes_<ts>.csv)
+#   python snapshot_store.py state <host> ["YYYY-MM-DD HH:MM:SS"]
+#   python snapshot_store.py changes ["YYYY-MM-DD HH:MM:SS" ["YYYY-MM-DD HH:MM:SS"]]
+import json
+import sqlite3
+import sys
+import time
+
+SCAN_HISTORY_DB = 'scan_history.db'
+# a full state of the host is kept every KEYFRAME_DELTAS changed columns, a state query replays at most that many
+KEYFRAME_DELTAS = 500
+# columns changing on every scan, not history
+VOLATILE_COLUMNS = ['system_time', 'system_date']
+# columns of the changes report, by category. The ring columns repeat per ring: state, state.1, ...
+FIRMWARE_COLUMNS = ['b1_ver', 'b1_running', 'b1_scheduled_to_run', 'b1_startup',
+                    'b2_ver', 'b2_running', 'b2_scheduled_to_run', 'b2_startup']
+RING_COLUMNS = ['ring-id', 'role', 'state', 'cw-status-data', 'acw-status-data', 'cw-status-raps', 'acw-status-raps']
+CONFIG_COLUMNS = ['system_sn', 'system_name', 'system_location', 'ntp_1_server', 'syslog_1_server',
+                  'snmp_mng_1_ip_addr', 'snmp_agent_read_com', 'snmp_agent_write_com',
+                  'data_rate_status', 'data_rate_permission', 'eth1_pvid', 'rf_operational', 'rf_mode', 'rf_role']
+RSSI_COLUMN = 'rf_rssi'
+# RSSI classes, lower bounds in dBm
+RSSI_CLASSES = [(-50, 'excellent'), (-60, 'good'), (-70, 'fair'), (-80, 'poor'), (-200, 'bad')]
+
+CHANGES_HEADER = 'time_stamp,host,category,column,old,new\n'
+
+
+def get_columns(header):
+    # unique column names, a repeated name gets .1, .2, ... like pandas.read_csv does
+    columns = []
+    seen = {}
+    for name in header:
+        if name in seen:
+            seen[name] += 1
+            columns.append('%s.%d' % (name, seen[name]))
+        else:
+            seen[name] = 0
+            columns.append(name)
+    return columns
+
+
+def to_iso(ts):
+    # execution log time stamp (dd-mm-YYYY HH:MM:SS) to a sortable one
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.strptime(ts, '%d-%m-%Y %H:%M:%S'))
+
+
+def get_rssi_class(value):
+    try:
+        rssi = float(value)
+    except (TypeError, ValueError):
+        return ''
+    for bound, name in RSSI_CLASSES:
+        if rssi >= bound:
+            return name
+    return RSSI_CLASSES[-1][1]
+
+
+def get_category(column):
+    name = column.split('.')[0]
+    if name in FIRMWARE_COLUMNS:
+        return 'firmware'
+    if name in RING_COLUMNS:
+        return 'ring'
+    if name in CONFIG_COLUMNS:
+        return 'config'
+    return ''
+
+
+def read_scans(filename):
+    # (time stamp, host, {column: value}) of the successful scans of an execution log
+    with open(filename) as f:
+        columns = get_columns(f.readline().rstrip('\r\n').split(','))
+        for line in f:
+            fields = line.rstrip('\r\n').split(',')
+            if len(fields) < len(columns) or fields[2] != 'scan' or fields[3] != 'True':
+                continue
+            state = dict((column, value) for column, value in zip(columns[4:], fields[4:])
+                         if column not in VOLATILE_COLUMNS)
+            yield to_iso(fields[0]), fields[1], state
+
+
+############################################################################
+class SnapshotStore:
+    """Scan history in SQLite: snapshot_latest holds the last state of every host,
+    snapshot_delta the columns a scan changed (old and new value) and snapshot_keyframe a full
+    state every KEYFRAME_DELTAS changes, so state_at() replays a handful of deltas instead of
+    every scan since the first one.
+    """
+
+    def __init__(self, filename=None):
+        self.db = sqlite3.connect(filename or SCAN_HISTORY_DB)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS snapshot_latest (host TEXT PRIMARY KEY, ts TEXT, state TEXT, n_deltas INTEGER);
+            CREATE TABLE IF NOT EXISTS snapshot_keyframe (host TEXT, ts TEXT, state TEXT, PRIMARY KEY (host, ts));
+            CREATE TABLE IF NOT EXISTS snapshot_delta (host TEXT, ts TEXT, column_name TEXT, old TEXT, new TEXT);
+            CREATE INDEX IF NOT EXISTS snapshot_delta_host_ts ON snapshot_delta (host, ts);
+            CREATE INDEX IF NOT EXISTS snapshot_delta_ts ON snapshot_delta (ts);
+        """)
+
+    def ingest(self, scans):
+        # scans: (time stamp, host, state) in time order. Returns the changes report rows
+        latest = dict((host, (ts, json.loads(state), n_deltas)) for host, ts, state, n_deltas in
+                      self.db.execute('SELECT host, ts, state, n_deltas FROM snapshot_latest'))
+        deltas, keyframes, changes = [], [], []
+        updated = set()
+        for ts, host, state in scans:
+            if host not in latest:
+                latest[host] = (ts, state, 0)
+                updated.add(host)
+                keyframes.append((host, ts, json.dumps(state)))
+                continue
+            last_ts, last_state, n_deltas = latest[host]
+            if ts <= last_ts:
+                continue
+            changed = [(column, last_state.get(column), value) for column, value in state.items()
+                       if last_state.get(column) != value]
+            changed += [(column, value, None) for column, value in last_state.items() if column not in state]
+            deltas += [(host, ts, column, old, new) for column, old, new in changed]
+            changes += self.get_changes(ts, host, changed)
+            n_deltas += len(changed)
+            if n_deltas >= KEYFRAME_DELTAS:
+                keyframes.append((host, ts, json.dumps(state)))
+                n_deltas = 0
+            latest[host] = (ts, state, n_deltas)
+            updated.add(host)
+
+        with self.db:
+            self.db.executemany('INSERT INTO snapshot_delta VALUES (?, ?, ?, ?, ?)', deltas)
+            self.db.executemany('INSERT OR REPLACE INTO snapshot_keyframe VALUES (?, ?, ?)', keyframes)
+            self.db.executemany('INSERT OR REPLACE INTO snapshot_latest VALUES (?, ?, ?, ?)',
+                                [(host,) + latest[host][:1] + (json.dumps(latest[host][1]), latest[host][2])
+                                 for host in updated])
+        return changes
+
+    def get_changes(self, ts, host, changed):
+        # the report rows of one scan: firmware, ring and config columns, and RSSI class moves
+        changes = []
+        for column, old, new in changed:
+            if column == RSSI_COLUMN:
+                old_class, new_class = get_rssi_class(old), get_rssi_class(new)
+                if old_class != new_class:
+                    changes.append((ts, host, 'rssi_class', column, old_class, new_class))
+                continue
+            category = get_category(column)
+            if category:
+                changes.append((ts, host, category, column, old, new))
+        return changes
+
+    def state_at(self, host, ts=None):
+        # {column: value} of the host at ts (the last state without one), None before its first scan
+        if ts is None:
+            row = self.db.execute('SELECT state FROM snapshot_latest WHERE host = ?', (host,)).fetchone()
+            return json.loads(row[0]) if row else None
+        row = self.db.execute('SELECT ts, state FROM snapshot_keyframe WHERE host = ? AND ts <= ? '
+                              'ORDER BY ts DESC LIMIT 1', (host, ts)).fetchone()
+        if row is None:
+            return None
+        keyframe_ts, state = row[0], json.loads(row[1])
+        for column, new in self.db.execute('SELECT column_name, new FROM snapshot_delta WHERE host = ? AND ts > ? '
+                                           'AND ts <= ? ORDER BY ts, rowid', (host, keyframe_ts, ts)):
+            if new is None:
+                state.pop(column, None)
+            else:
+                state[column] = new
+        return state
+
+    def changes(self, since=None, until=None, hosts=None):
+        # the changes report rows between two time stamps
+        query = 'SELECT ts, host, column_name, old, new FROM snapshot_delta WHERE ts > ? AND ts <= ?'
+        params = [since or '', until or '9999']
+        if hosts:
+            query += ' AND host IN (%s)' % ','.join('?' * len(hosts))
+            params += list(hosts)
+        changes = []
+        for ts, host, column, old, new in self.db.execute(query + ' ORDER BY ts, host', params):
+            changes += self.get_changes(ts, host, [(column, old, new)])
+        return changes
+
+    def close(self):
+        self.db.close()
+
+
+def get_log_time(filename):
+    # time stamp of the first unit of an execution log, the file names do not sort by time
+    with open(filename) as f:
+        f.readline()
+        line = f.readline()
+    return to_iso(line.split(',')[0]) if line else ''
+
+
+def write_changes(changes, filename):
+    with open(filename, 'w') as f:
+        f.write(CHANGES_HEADER)
+        for change in changes:
+            f.write(','.join('' if x is None else str(x) for x in change) + '\n')
+
+
+def record_scan(log_filename, db_filename=None):
+    # the scans of an execution log into the history, their changes into changes_<ts>.csv.
+    # A log without successful scans (upload_sw, run_sw, accept ... runs) leaves no trace
+    scans = list(read_scans(log_filename))
+    if not scans:
+        return None
+    store = SnapshotStore(db_filename)
+    try:
+        changes = store.ingest(scans)
+    finally:
+        store.close()
+    filename = log_filename.replace('execution_log', 'changes')
+    write_changes(changes, filename)
+    print('%s: %d changes' % (filename, len(changes)))
+    return filename
+
+
+##############################################################################
+##############################################################################
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'ingest':
+        for log_filename in sorted(sys.argv[2:], key=get_log_time):
+            record_scan(log_filename)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'state':
+        state = SnapshotStore().state_at(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+        for column, value in sorted((state or {}).items()):
+            print('%-30s %s' % (column, value))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'changes':
+        sys.stdout.write(CHANGES_HEADER)
+        for change in SnapshotStore().changes(*sys.argv[2:4]):
+            print(','.join('' if x is None else str(x) for x in change))
+    else:
+        print('python snapshot_store.py ingest <execution logs> | state <host> [time] | changes [since [until]]')
@@ -18,7 +18,11 @@ from plotly.tools import make_subplots
 
 from statsmodels.tsa.seasonal import seasonal_decompose
 from db_wrapper import *
-from stats_downloader import RF_STATS_TABLE_NAME, ETH_STATS_TABLE_NAME
+from downsample import POINT_BUDGET, downsample
+from rssi_analytics import compute_rssi, split_hosts, summarize_hosts, top_links
+from stats_store import (RF_STATS_TABLE_NAME, ETH_STATS_TABLE_NAME, RF_ROLLUP_METRICS, ETH_ROLLUP_METRICS,
+                         get_rollup_table_name, open_stats_store)
+from telemetry_buffer import AlertRule, TelemetryStore, rolling
 
 @st.cache(allow_output_mutation=True)
 def load_data(filename):
@@ -27,48 +31,103 @@ def load_data(filename):
     return data[data['host'].notna()].sort_index(ascending=True)
 
 
+RF_COLUMNS = ['min-rssi', 'max-rssi', 'min-cinr', 'max-cinr']
+# longest span shown at 15 minute and hourly resolution, longer ones use the daily rollup
+RAW_MAX_DAYS = 14
+HOURLY_MAX_DAYS = 120
+# samples per day, the default decomposition period
+SAMPLES_PER_DAY = {'raw': 96, 'hourly': 24, 'daily': 7}
+# live RSSI: the charts show the last LIVE_WINDOW_SEC of the in-memory samples
+LIVE_WINDOW_SEC = 600
+LIVE_ROLLING_SAMPLES = 10
+
+
+def get_resolution(start, end):
+    days = (end - start).total_seconds() / 86400
+    if days <= RAW_MAX_DAYS:
+        return 'raw'
+    if days <= HOURLY_MAX_DAYS:
+        return 'hourly'
+    return 'daily'
+
+
 @st.cache(allow_output_mutation=True)
-def load_data_database(table='rf'):
-    db = levitan_db()
-    db_engine = db.engine
-    db_name = db.db_name
-    if table == 'rf':
-        sql_query = r"select * from %s.%s ;" % (db_name, RF_STATS_TABLE_NAME)
-    else:
-        sql_query = r"select * from %s.%s ;" % (db_name, ETH_STATS_TABLE_NAME)
+def get_stats_store(db_name):
+    return open_stats_store(db_name)
+
+
+@st.cache(allow_output_mutation=True)
+def get_live_sampler(ips, user, password, rate):
+    # one background sampler per set of units, kept across the reruns of the page; nothing is written to a DB
+    from rssi_logger import RssiSampler
+    hosts = pd.DataFrame({'ip': list(ips), 'user': user, 'password': password})
+    telemetry = TelemetryStore()
+    sampler = RssiSampler(hosts, None, rate, telemetry)
+    sampler.start()
+    return sampler, telemetry
+
+
+@st.cache(allow_output_mutation=True)
+def load_hosts(db_name, table='rf'):
+    store = get_stats_store(db_name)
+    table_name = RF_STATS_TABLE_NAME if table == 'rf' else ETH_STATS_TABLE_NAME
+    watermarks = [ts for (t, host), ts in store.read_watermarks().items() if t == table_name]
+    return store.get_hosts(table_name), max(watermarks) if watermarks else datetime.datetime.now()
+
 
-    data = pd.read_sql(sql_query, db_engine)
-    data = data[data['host'].notna()]
-    data.drop_duplicates(subset=['start_ts', 'host'], keep='first', inplace=True)
+@st.cache(allow_output_mutation=True)
+def load_data_database(table='rf', db_name='levitan', hosts=None, start=None, end=None, columns=None,
+                       resolution='raw'):
+    # hosts, time range and columns are filtered by the backend and every selection is cached,
+    # the tables have a unique key on (host, start_ts[, interface]), no duplicates to drop
+    store = get_stats_store(db_name)
+    table_name = RF_STATS_TABLE_NAME if table == 'rf' else ETH_STATS_TABLE_NAME
+    hosts = list(hosts) if hosts is not None else None
+    if resolution == 'raw':
+        data = store.read(table_name, hosts=hosts, start=start, end=end,
+                          columns=list(columns) if columns is not None else None)
+    else:
+        # min-x from x_min and max-x from x_max of the rollup keep the envelope of the raw intervals,
+        # the other metrics come from their mean. Without columns, every metric of the rollup
+        if columns is None:
+            columns = RF_ROLLUP_METRICS if table == 'rf' else ETH_ROLLUP_METRICS
+        rollup_columns = {'%s_%s' % (column, column[:3] if column[:3] in ['min', 'max'] else 'mean'): column
+                          for column in columns}
+        data = store.read(get_rollup_table_name(table_name, resolution), hosts=hosts, start=start, end=end,
+                          columns=list(rollup_columns))
+        data = data.rename(columns=rollup_columns)
     data.index = pd.to_datetime(data['start_ts'])
 
     return data.sort_index(ascending=True)
 
 
-def plot_rssi(df_, ips):
+def plot_rssi(hosts_rssi, max_points=POINT_BUDGET):
+    # hosts_rssi: {ip: compute_rssi() intervals of the ip}. Every trace is decimated to its share of
+    # max_points, min/max bucketing keeps the fades of the envelope, LTTB the shape of the average
     fig = Figure()
-    for ip in ips:
-        df = df_[df_['host'] == ip]
-        avg_rssi = df['max-rssi'] - (df['max-rssi'] - df['min-rssi']) / 2.0
-
+    n_points = max(max_points // (3 * max(len(hosts_rssi), 1)), 2)
+    for ip, df in hosts_rssi.items():
+        max_rssi = downsample(df['max-rssi'], n_points, 'minmax')
+        min_rssi = downsample(df['min-rssi'], n_points, 'minmax')
+        avg_rssi = downsample(df['avg-rssi'], n_points)
         fig.add_trace(Scatter(
-            x=df.index,
-            y=df['max-rssi'],
+            x=max_rssi.index,
+            y=max_rssi,
             name="max-rssi",
             showlegend=False,
             line=dict(color="#33CFA5"),
         ))
 
         fig.add_trace(Scatter(
-            x=df.index,
-            y=df['min-rssi'],
+            x=min_rssi.index,
+            y=min_rssi,
             name="min-rssi",
             showlegend=False,
             line=dict(color="#F06A6A"),
         ))
 
         fig.add_trace(Scatter(
-            x=df.index,
+            x=avg_rssi.index,
             y=avg_rssi,
             name="avg-rssi, %s" % ip,
             line=dict(color="#000000"),
@@ -77,25 +136,24 @@ def plot_rssi(df_, ips):
     fig.layout.title = 'RSSI'
     return fig
 
-def plot_rssi_delta(df_, ips, reference = 0, show_plot = False):
+def plot_rssi_delta(hosts_rssi, reference = 0, show_plot = False, max_points=POINT_BUDGET):
     fig = Figure()
+    n_points = max(max_points // max(len(hosts_rssi), 1), 2)
 
     if show_plot:
         visible = True
     else:
         visible = 'legendonly'
-    for ip in ips:
-        df = df_[df_['host'] == ip]
-        delta_rssi = df['max-rssi'] - df['min-rssi']
-
+    for ip, df in hosts_rssi.items():
+        delta_rssi = downsample(df['delta-rssi'], n_points, 'minmax')
         fig.add_trace(Scatter(
-            x=df.index,
+            x=delta_rssi.index,
             y=delta_rssi,
             name="%s" % ip,
             visible=visible,
         ))
 
-    x = [df_.index.min(), df_.index.max()]
+    x = [min(df.index.min() for df in hosts_rssi.values()), max(df.index.max() for df in hosts_rssi.values())]
     y = [reference, reference]
     fig.add_trace(Scatter(
         x=x,
@@ -107,45 +165,63 @@ def plot_rssi_delta(df_, ips, reference = 0, show_plot = False):
     fig.layout.title = 'RSSI Delta'
     return fig
 
-def plot_rssi_stats(df_, ip):
-    df = df_[df_['host'] == ip]
-    delta_rssi = df['max-rssi'] - df['min-rssi']
-    hist_data = [df['max-rssi'], df['min-rssi'], delta_rssi]
+def plot_rssi_stats(df):
+    hist_data = [df['max-rssi'], df['min-rssi'], df['delta-rssi']]
     group_labels = ['max-rssi', 'min-rssi', 'delta-rssi']
     return ff.create_distplot(hist_data, group_labels)
 
-def plot_rssi_decomp(df_, ip, period):
-    df = df_[df_['host'] == ip]
+def plot_fleet_ranking(ranking, by):
+    fig = Figure()
+    fig.add_trace(Bar(x=ranking.index, y=ranking[by], name=by))
+    fig.layout.title = 'Top {} links by {}'.format(len(ranking), by)
+    return fig
+
+def plot_live_rssi(telemetry, seconds, n_rolling):
+    fig = Figure()
+    for host in telemetry.hosts('rssi'):
+        ts, values = telemetry.window(host, 'rssi', seconds)
+        x = pd.to_datetime(ts, unit='s')
+        fig.add_trace(Scatter(x=x, y=values, name=host, mode='lines'))
+        # rolling mean at the end of every full window
+        mean = rolling(values, n_rolling, 'mean')
+        if len(mean):
+            fig.add_trace(Scatter(x=x[n_rolling - 1:], y=mean, name='{} mean({})'.format(host, n_rolling),
+                                  line=dict(dash='dot')))
+    fig.layout.title = 'Live RSSI, last {} sec'.format(seconds)
+    return fig
 
-    delta_rssi = (df['max-rssi'] + df['min-rssi']) / 2
-    s = seasonal_decompose(delta_rssi, model='additive', period=period)
+def plot_rssi_decomp(df, period, max_points=POINT_BUDGET):
+    s = seasonal_decompose(df['avg-rssi'], model='additive', period=period)
+    # decomposed at full resolution, drawn decimated
+    n_points = max(max_points // 4, 2)
+    observed, trend, seasonal, resid = [downsample(c, n_points) for c in [s.observed, s.trend, s.seasonal, s.resid]]
     x = df.index
     fig = make_subplots(rows=4, cols=1)
 
     fig.append_trace(Scatter(
-        x=s.observed.index,
-        y=s.observed,
+        x=observed.index,
+        y=observed,
         showlegend=False,
     ), row=1, col=1)
     fig.update_yaxes(title_text="Observed ({})".format(len(df)), row=1, col=1)
 
     fig.append_trace(Scatter(
-        x=s.trend.index,
-        y=s.trend,
+        x=trend.index,
+        y=trend,
         showlegend=False,
     ), row=2, col=1)
     fig.update_yaxes(title_text="Trend", row=2, col=1)
 
     fig.append_trace(Scatter(
-        x=s.seasonal.index,
-        y=s.seasonal,
+        x=seasonal.index,
+        y=seasonal,
         showlegend=False,
     ), row=3, col=1)
     fig.update_yaxes(title_text="Seasonal", row=3, col=1)
 
     fig.append_trace(Scatter(
-        x=s.resid.index,
-        y=s.resid,
+        x=resid.index,
+        y=resid,
         showlegend=False,
     ), row=4, col=1)
     fig.update_yaxes(title_text="Residual", row=4, col=1)
@@ -158,35 +234,80 @@ def main():
 
     # data_filename = st.sidebar.text_input('Stats filename:', r'c:\Python\upgrader\rf_stats_w.csv')
     # df = load_data(data_filename)
-    df = load_data_database()
-
-    ips = df['host'].drop_duplicates().to_list()
+    db_name = st.sidebar.text_input('Stats DB (levitan, aws, local, SQLite file or parquet:<dir>):', 'levitan')
+    ips, last_ts = load_hosts(db_name)
     selected_ips = st.sidebar.multiselect('Chose IPs', ips, default=[])
+    dates = st.sidebar.date_input('Dates', (last_ts.date() - datetime.timedelta(days=7), last_ts.date()))
+    start, end = (dates[0], dates[-1]) if isinstance(dates, (list, tuple)) and dates else (dates, dates)
+    start = datetime.datetime.combine(start, datetime.time.min)
+    end = datetime.datetime.combine(end, datetime.time.max)
+
+    # only the selected hosts and dates are fetched, long spans from the hourly/daily rollups
+    resolution = get_resolution(start, end)
+    df = load_data_database(db_name=db_name, hosts=tuple(selected_ips), start=start, end=end,
+                            columns=tuple(RF_COLUMNS), resolution=resolution)
 
-    st.write('Number of IPs: {}, Total records: {}'.format(len(ips), len(df)))
+    st.write('Number of IPs: {}, Total records: {}, resolution: {}'.format(len(ips), len(df), resolution))
 
     rssi_delta_db_ref = st.sidebar.slider('RSSI delta dB', 2, 20, value=4, step=2)
-    period = int(st.sidebar.text_input('Decom period:', 96))
+    # narrower dates re-read the data at a finer resolution, zooming in on the charts only magnifies
+    max_points = int(st.sidebar.number_input('Points per chart', 500, 100000, value=POINT_BUDGET, step=500))
+    period = int(st.sidebar.text_input('Decom period:', SAMPLES_PER_DAY[resolution]))
 
     if st.sidebar.checkbox('Drop RSSI = -128'):
         df = df[df['min-rssi'] != -128]
 
-    if st.sidebar.button('Run RF analysis'):
+    if st.sidebar.button('Run RF analysis') and selected_ips:
         data = df[df['host'].isin(selected_ips)]
         st.write('From: {} to {}'.format(data.index.min(), data.index.max()))
         st.dataframe(data.describe())
+        # avg/delta RSSI of all the intervals in one pass, then one frame per ip for the charts
+        hosts_rssi = split_hosts(compute_rssi(data), selected_ips)
         # RSSI
         st.header('RSSI')
-        st.plotly_chart(plot_rssi(df, selected_ips))
-        st.plotly_chart(plot_rssi_delta(df, selected_ips, reference=rssi_delta_db_ref, show_plot=True))
+        st.plotly_chart(plot_rssi(hosts_rssi, max_points))
+        st.plotly_chart(plot_rssi_delta(hosts_rssi, reference=rssi_delta_db_ref, show_plot=True, max_points=max_points))
 
-        for selected_ip in selected_ips:
+        for selected_ip, host_rssi in hosts_rssi.items():
             st.header('RSSI statistics: {}'.format(selected_ip))
-            st.plotly_chart(plot_rssi_stats(df, selected_ip))
+            st.plotly_chart(plot_rssi_stats(host_rssi))
             st.header('RSSI decomposition: {}'.format(selected_ip))
-            st.plotly_chart(plot_rssi_decomp(df, selected_ip, period))
+            st.plotly_chart(plot_rssi_decomp(host_rssi, period, max_points))
 
         # CINR
 
+    if st.sidebar.checkbox('Fleet ranking'):
+        # all the hosts, over the last RAW_MAX_DAYS of the selected dates at most
+        n_links = int(st.sidebar.number_input('Top links', 1, 500, value=20))
+        by = st.sidebar.selectbox('Rank by', ['delta_p95', 'delta_mean', 'dropout_rate', 'avg_rssi'])
+        fleet = load_data_database(db_name=db_name, start=max(start, end - datetime.timedelta(days=RAW_MAX_DAYS)),
+                                   end=end, columns=('min-rssi', 'max-rssi'))
+        # the weakest links first when ranking by level
+        ranking = top_links(summarize_hosts(compute_rssi(fleet)), n_links, by, ascending=by == 'avg_rssi')
+        st.header('Fleet ranking')
+        st.plotly_chart(plot_fleet_ranking(ranking, by))
+        st.dataframe(ranking)
+
+    if st.sidebar.checkbox('Live RSSI'):
+        # sampled by this process into memory, the page only reads the ring buffers
+        live_ips = st.sidebar.text_input('Live IPs (comma separated)', ','.join(selected_ips))
+        user = st.sidebar.text_input('User', 'admin')
+        password = st.sidebar.text_input('Password', 'admin', type='password')
+        rate = float(st.sidebar.number_input('Samples per second', 0.1, 10.0, value=1.0))
+        alert_below = float(st.sidebar.number_input('Alert below (dBm)', -128, 0, value=-70))
+        ips = tuple(ip.strip() for ip in live_ips.split(',') if ip.strip())
+        if ips:
+            sampler, telemetry = get_live_sampler(ips, user, password, rate)
+            st.header('Live RSSI')
+            st.write(sampler.report())
+            st.plotly_chart(plot_live_rssi(telemetry, LIVE_WINDOW_SEC, LIVE_ROLLING_SAMPLES))
+            summary = pd.DataFrame.from_dict(telemetry.summary('rssi', LIVE_WINDOW_SEC), orient='index',
+                                             columns=['last', 'min', 'max', 'mean', 'samples'])
+            st.dataframe(summary)
+            rule = AlertRule('rssi', 'mean', '<', alert_below, 60)
+            for host, value in rule.check(telemetry):
+                st.warning('{}: {} ({:.1f})'.format(host, rule, value))
+            st.button('Refresh')
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
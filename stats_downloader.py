@@ -1,4 +1,5 @@
-from scanner_v2 import SikluCommandParserBase, SikluUnit, SikluCommandParam
+import siklu_api
+from siklu_api import SikluUnit, ShowEthStatisticsSummary, ShowRfStatisticsSummary
 import datetime
 from db_wrapper import *
 import os, sys, time
@@ -17,89 +18,39 @@ import pandas as pd
 import collections
 import sys
 from multiprocessing import Pool
+from stats_store import ETH_STATS_TABLE_NAME, RF_STATS_TABLE_NAME, open_stats_store
+from stats_rollup import update_rollups
+from anomaly_detector import detect_anomalies
 try:
     from configparser import ConfigParser
 except ImportError:
     from ConfigParser import ConfigParser  # ver. < 3.0
 
 
-ETH_STATS_TABLE_NAME = 'eth_stats_table'
-RF_STATS_TABLE_NAME = 'rf_stats_table'
-
-db = levitan_db()
-db_engine = db.engine
-
-
-class ShowEthStatisticsSummary(SikluCommandParserBase):
-    multiline = True
-    columns = ['interval', 'start_ts', 'interface', 'in-octets', 'out-octets', 'in-rate', 'out-rate', 'util']
-
-    def __init__(self, connection = None, eth = 'eth1'):
-        self.cmd = 'show eth %s statistics-summary' % eth
-        SikluCommandParserBase.__init__(self, connection)
-        self.cmd_params = [item for sublist in [self.gen_cmd_params(time_interval) for time_interval in range(0, 96)] for item in sublist]
-
-    def gen_cmd_params(self, time_interval):
-        return [
-                SikluCommandParam('record_%d' % time_interval, '', r"^(%d\s+[\.\d]+\s+[:\d]+\s+eth\d\s+[\d]+\s+[\d]+\s+[\d]+\s+[\d]+\s+[\d]+)" % time_interval),
-                ]
-
-    def parse_reply(self):
-        stats = []
-        # print self.reply
-        for param in self.cmd_params:
-            interval_values = self.find_value(param.regex, self.reply)
-            # print param.regex
-            # import pdb; pdb.set_trace()
-            if interval_values:
-                r = re.search(r"(\d+)\s+([\.\d]+\s+[:\d]+)\s+(eth[\d])\s+([\d]+)\s+([\d]+)\s+([\d]+)\s+([\d]+)\s+([\d]+)", interval_values)
-                if r:
-                    r = r.groups()
-                    stats.append([int(r[0]), datetime.datetime.strptime(r[1], '%Y.%m.%d %H:%M:%S'), r[2], int(r[3]), int(r[4]), int(r[5]), int(r[6]), int(r[7])])
-                else:
-                    continue
-
-        return pd.DataFrame(stats, columns=self.columns)
-
-    def __str__(self):
-        return ','.join(columns)
-
-class ShowRfStatisticsSummary(SikluCommandParserBase):
-    multiline = True
-    columns = ['interval', 'start_ts', 'min-rssi', 'max-rssi', 'min-cinr', 'max-cinr', 'min-mod', 'max-mod']
-
-    def __init__(self, connection = None):
-        self.cmd = 'show rf statistics-summary'
-        SikluCommandParserBase.__init__(self, connection)
-        self.cmd_params = [item for sublist in [self.gen_cmd_params(time_interval) for time_interval in range(0, 96)] for item in sublist]
-
-    def gen_cmd_params(self, time_interval):
-        return [
-                SikluCommandParam('record_%d' % time_interval, '', r"^(%d\s+[\.\d]+\s+[:\d]+\s+[-\d]+\s+[-\d]+\s+[-\d]+\s+[-\d]+\s+[\w\d]+\s+[\w\d]+\s+[yesno]+)" % time_interval),
-                ]
-
-    def parse_reply(self):
-        stats = []
-        for param in self.cmd_params:
-            interval_values = self.find_value(param.regex, self.reply)
-            # import pdb; pdb.set_trace()
-            if interval_values:
-                r = re.search(r"(\d+)\s+([\.\d]+\s+[:\d]+)\s+([-\d]+)\s+([-\d]+)\s+([-\d]+)\s+([-\d]+)\s+([\w\d]+)\s+([\w\d]+)", interval_values)
-                if r:
-                    r = r.groups()
-                    stats.append([int(r[0]), datetime.datetime.strptime(r[1], '%Y.%m.%d %H:%M:%S'), int(r[2]), int(r[3]), int(r[4]), int(r[5]), r[6], r[7]])
-                else:
-                    continue
-
-        return pd.DataFrame(stats, columns=self.columns)
-
-    def __str__(self):
-        return ','.join(columns)
+STATS_DB = 'levitan'
+
+
+def get_stats_store(db_name=None):
+    store = open_stats_store(db_name or STATS_DB)
+    store.create_tables()
+    return store
+
+
+def store_stats(store, stats, table_name):
+    stats = [stat for stat in stats if not stat.empty]
+    if not stats:
+        print('%s: no new intervals' % table_name)
+        return pd.DataFrame([])
+    stats = pd.concat(stats)
+    store.write(table_name, stats)
+    print('%s: %d new intervals' % (table_name, len(stats)))
+    return stats
 
 
 def run_command(unit_):
     unit = unit_['unit']
     # db_engine = unit_['db_engine']
+    watermarks = unit_.get('watermarks', {})
 
     eth_stats = pd.DataFrame([])
     rf_stats = pd.DataFrame([])
@@ -108,11 +59,11 @@ def run_command(unit_):
     if unit.connected:
         # command = ShowEthStatisticsSummary(unit, 'eth1')
         # db_table = ETH_STATS_TABLE_NAME
-        eth_stats = ShowEthStatisticsSummary(unit, 'eth1').parse()
+        eth_stats = ShowEthStatisticsSummary(unit, 'eth1', since=watermarks.get(ETH_STATS_TABLE_NAME)).parse()
         eth_stats['host'] = unit.host
         # command = ShowRfStatisticsSummary(unit)
         # db_table = RF_STATS_TABLE_NAME
-        rf_stats = ShowRfStatisticsSummary(unit).parse()
+        rf_stats = ShowRfStatisticsSummary(unit, since=watermarks.get(RF_STATS_TABLE_NAME)).parse()
         rf_stats['host'] = unit.host
 
     return (eth_stats, rf_stats)
@@ -126,9 +77,16 @@ def units_manager_parallel(cfg_file, n_processes):
     hosts = pd.read_csv(cfg_file, comment='#')
     units = []
 
+    # only the intervals after the last stored one are parsed and inserted
+    store = get_stats_store()
+    watermarks = store.read_watermarks()
+
     for i, host in hosts.iterrows():
-        unit = SikluUnit(host['ip'], host['user'], host['password'])
-        units.append({'unit':unit, 'command':host['command']})
+        unit = SikluUnit(host['ip'], host['user'], host['password'],
+                         spawn_cmd=siklu_api.get_host_spawn_cmd(host['ip']))
+        units.append({'unit':unit, 'command':host['command'],
+                      'watermarks': {table_name: watermarks.get((table_name, host['ip']))
+                                     for table_name in [ETH_STATS_TABLE_NAME, RF_STATS_TABLE_NAME]}})
 
     # for unit in units:
     #     run_command(unit)
@@ -138,13 +96,10 @@ def units_manager_parallel(cfg_file, n_processes):
 
     # import pdb; pdb.set_trace()
     print('Updating db...')
-    db_table = ETH_STATS_TABLE_NAME
-    eth_stats_ = pd.concat([eth_stat for eth_stat in eth_stats if ~eth_stat.empty])
-    eth_stats_.to_sql(db_table, db_engine, if_exists='append', index=False)
-
-    db_table = RF_STATS_TABLE_NAME
-    rf_stats_ = pd.concat([rf_stat for rf_stat in rf_stats if ~rf_stat.empty])
-    rf_stats_.to_sql(db_table, db_engine, if_exists='append', index=False)
+    store_stats(store, eth_stats, ETH_STATS_TABLE_NAME)
+    rf_stats = store_stats(store, rf_stats, RF_STATS_TABLE_NAME)
+    update_rollups(store)
+    detect_anomalies(store, rf_stats)
     print('Done...')
 
 if __name__ == '__main__':
@@ -154,16 +109,16 @@ if __name__ == '__main__':
     # accept
 
     config = ConfigParser()
+    config.read_dict({'DEFAULT': {'RINGS': 0,
+                                  'MH_ENABLED': False,
+                                  'N_PROCESSES': 10,
+                                  'CONNECTION_TIMEOUT_SEC': 12,
+                                  'CSV_FILENAME': 'cfg.csv',
+                                  'STATS_DB': STATS_DB,
+                                  'SPAWN_CMD': ''}})
 
     if len(sys.argv) == 2:
         config.read(sys.argv[1])
-    else:
-        config.add_section('DEFAULT')
-        config.set('DEFAULT', 'RINGS', 0)
-        config.set('DEFAULT', 'MH_ENABLED', False)
-        config.set('DEFAULT', 'N_PROCESSES', 10)
-        config.set('DEFAULT', 'CONNECTION_TIMEOUT_SEC', 12)
-        config.set('DEFAULT', 'CSV_FILENAME', 'cfg.csv')
 
 
     RINGS = config.getint('DEFAULT', 'RINGS')
@@ -171,6 +126,10 @@ if __name__ == '__main__':
     N_PROCESSES = config.getint('DEFAULT', 'N_PROCESSES')
     CONNECTION_TIMEOUT_SEC = config.getint('DEFAULT', 'CONNECTION_TIMEOUT_SEC')
     CSV_FILENAME = config.get('DEFAULT', 'CSV_FILENAME')
+    # levitan, aws, local, a SQLite filename (see db_wrapper.get_db()) or parquet:<directory>
+    STATS_DB = config.get('DEFAULT', 'STATS_DB')
+    # e.g. the simulator or ssh through a jump host instead of ssh to the unit, see siklu_api.get_host_spawn_cmd()
+    siklu_api.SPAWN_CMD = config.get('DEFAULT', 'SPAWN_CMD', raw=True)
 
     units_manager_parallel(CSV_FILENAME, N_PROCESSES)
 
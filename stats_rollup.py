@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# Hourly and daily aggregates of the RF and Eth statistics, kept up to date incrementally:
+#   python stats_rollup.py [levitan|aws|local|<SQLite file>|parquet:<directory>]
+import sys
+
+import pandas as pd
+
+from stats_store import *
+
+DROPOUT_RSSI = -128
+# hosts read from the stats tables at a time
+ROLLUP_HOSTS_PER_BATCH = 500
+
+
+def rollup(stats, table_name, resolution):
+    # one row per host (and interface) and hour/day. RSSI/CINR statistics are over the intervals
+    # without a dropout, the dropouts are counted separately
+    key = get_unique_key(ROLLUP_TABLES[get_rollup_table_name(table_name, resolution)])
+    stats = stats.assign(start_ts=stats['start_ts'].dt.floor(ROLLUP_RESOLUTIONS[resolution]))
+    groups = stats.groupby(key)
+    data = groups.size().rename('count').to_frame()
+
+    if table_name == RF_STATS_TABLE_NAME:
+        metrics = RF_ROLLUP_METRICS
+        dropouts = stats['min-rssi'] == DROPOUT_RSSI
+        data['dropouts'] = dropouts.groupby([stats[column] for column in key]).sum()
+        valid = stats[~dropouts]
+    else:
+        metrics = ETH_ROLLUP_METRICS
+        for column in ETH_ROLLUP_SUMS:
+            data['%s_sum' % column] = groups[column].sum()
+        valid = stats
+
+    valid_groups = valid.groupby(key)[metrics]
+    aggregates = valid_groups.agg(['min', 'max', 'mean'])
+    aggregates.columns = ['%s_%s' % (metric, stat) for metric, stat in aggregates.columns]
+    percentiles = valid_groups.quantile([0.05, 0.5, 0.95]).unstack(-1)
+    percentiles.columns = ['%s_p%02d' % (metric, round(q * 100)) for metric, q in percentiles.columns]
+
+    return data.join(aggregates).join(percentiles).reset_index()
+
+
+def update_rollups(store, hosts_per_batch=ROLLUP_HOSTS_PER_BATCH):
+    # the last bucket of every host is recomputed, it may have been partial on the previous run
+    watermarks = store.read_watermarks()
+    for table_name in STATS_TABLES:
+        hosts = store.get_hosts(table_name)
+        for resolution in ROLLUP_RESOLUTIONS:
+            rollup_table_name = get_rollup_table_name(table_name, resolution)
+            n_rows = 0
+            for i in range(0, len(hosts), hosts_per_batch):
+                batch = hosts[i:i + hosts_per_batch]
+                since = [watermarks.get((rollup_table_name, host)) for host in batch]
+                start = None if None in since else min(since)
+                stats = store.read(table_name, hosts=batch, start=start)
+                if start is not None:
+                    since = stats['host'].map(dict(zip(batch, since)))
+                    stats = stats[stats['start_ts'] >= since]
+                if stats.empty:
+                    continue
+                data = rollup(stats, table_name, resolution)
+                store.write(rollup_table_name, data)
+                n_rows += len(data)
+            print('%s: %d rows updated' % (rollup_table_name, n_rows))
+
+
+##############################################################################
+##############################################################################
+if __name__ == '__main__':
+    store = open_stats_store(sys.argv[1] if len(sys.argv) > 1 else 'levitan')
+    store.create_tables()
+    update_rollups(store)
@@ -0,0 +1,398 @@
+import collections
+import glob
+import os
+import sys
+import time
+import uuid
+
+import pandas as pd
+from sqlalchemy import (BigInteger, Column, DateTime, Float, Index, Integer, MetaData, String, Table,
+                        UniqueConstraint, func, inspect, select, text)
+
+ETH_STATS_TABLE_NAME = 'eth_stats_table'
+RF_STATS_TABLE_NAME = 'rf_stats_table'
+# last stored start_ts per stats table and host
+WATERMARK_TABLE_NAME = 'stats_watermark_table'
+# rows per multi-row INSERT, well below the bind parameter limits of MySQL and SQLite
+UPSERT_BATCH_SIZE = 500
+
+metadata = MetaData()
+
+rf_stats_table = Table(
+    RF_STATS_TABLE_NAME, metadata,
+    Column('interval', Integer),
+    Column('start_ts', DateTime, nullable=False),
+    Column('min-rssi', Integer),
+    Column('max-rssi', Integer),
+    Column('min-cinr', Integer),
+    Column('max-cinr', Integer),
+    Column('min-mod', String(32)),
+    Column('max-mod', String(32)),
+    Column('host', String(64), nullable=False),
+    # the unique key doubles as the (host, start_ts) index of host and time range queries
+    UniqueConstraint('host', 'start_ts', name='uq_rf_stats_host_start_ts'),
+    Index('ix_rf_stats_start_ts', 'start_ts'))
+
+eth_stats_table = Table(
+    ETH_STATS_TABLE_NAME, metadata,
+    Column('interval', Integer),
+    Column('start_ts', DateTime, nullable=False),
+    Column('interface', String(16), nullable=False),
+    Column('in-octets', BigInteger),
+    Column('out-octets', BigInteger),
+    Column('in-rate', BigInteger),
+    Column('out-rate', BigInteger),
+    Column('util', Integer),
+    Column('host', String(64), nullable=False),
+    UniqueConstraint('host', 'start_ts', 'interface', name='uq_eth_stats_host_start_ts_interface'),
+    Index('ix_eth_stats_start_ts', 'start_ts'))
+
+watermark_table = Table(
+    WATERMARK_TABLE_NAME, metadata,
+    Column('table_name', String(64), nullable=False),
+    Column('host', String(64), nullable=False),
+    Column('start_ts', DateTime, nullable=False),
+    UniqueConstraint('table_name', 'host', name='uq_stats_watermark_table_name_host'))
+
+STATS_TABLES = {RF_STATS_TABLE_NAME: rf_stats_table, ETH_STATS_TABLE_NAME: eth_stats_table}
+
+# hourly and daily aggregates of the stats tables, see stats_rollup.py
+ROLLUP_RESOLUTIONS = collections.OrderedDict([('hourly', 'h'), ('daily', 'D')])
+ROLLUP_STATS = ['min', 'max', 'mean', 'p05', 'p50', 'p95']
+RF_ROLLUP_METRICS = ['min-rssi', 'max-rssi', 'min-cinr', 'max-cinr']
+ETH_ROLLUP_METRICS = ['in-rate', 'out-rate', 'util']
+ETH_ROLLUP_SUMS = ['in-octets', 'out-octets']
+
+
+def get_rollup_table_name(table_name, resolution):
+    # rf_stats_table -> rf_stats_hourly
+    return table_name.replace('_table', '_' + resolution)
+
+
+def make_rollup_table(name, key, metrics, extra_columns):
+    return Table(
+        name, metadata,
+        Column('host', String(64), nullable=False),
+        Column('start_ts', DateTime, nullable=False),
+        *[Column(column, String(16), nullable=False) for column in key[2:]],
+        Column('count', Integer),
+        *extra_columns,
+        *[Column('%s_%s' % (metric, stat), Float) for metric in metrics for stat in ROLLUP_STATS],
+        UniqueConstraint(*key, name='uq_%s_%s' % (name, '_'.join(key))))
+
+
+ROLLUP_TABLES = collections.OrderedDict()
+for resolution in ROLLUP_RESOLUTIONS:
+    name = get_rollup_table_name(RF_STATS_TABLE_NAME, resolution)
+    ROLLUP_TABLES[name] = make_rollup_table(name, ['host', 'start_ts'], RF_ROLLUP_METRICS,
+                                            [Column('dropouts', Integer)])
+    name = get_rollup_table_name(ETH_STATS_TABLE_NAME, resolution)
+    ROLLUP_TABLES[name] = make_rollup_table(name, ['host', 'start_ts', 'interface'], ETH_ROLLUP_METRICS,
+                                            [Column('%s_sum' % column, BigInteger) for column in ETH_ROLLUP_SUMS])
+
+# fades, step changes and dropouts found by anomaly_detector.py
+RF_ANOMALY_TABLE_NAME = 'rf_anomaly_table'
+rf_anomaly_table = Table(
+    RF_ANOMALY_TABLE_NAME, metadata,
+    Column('host', String(64), nullable=False),
+    Column('start_ts', DateTime, nullable=False),
+    Column('type', String(16), nullable=False),
+    Column('value', Float),
+    Column('expected', Float),
+    Column('score', Float),
+    UniqueConstraint('host', 'start_ts', 'type', name='uq_rf_anomaly_host_start_ts_type'),
+    Index('ix_rf_anomaly_start_ts', 'start_ts'))
+
+# every table read() and write() accept
+TABLES = dict(STATS_TABLES, **ROLLUP_TABLES)
+TABLES[RF_ANOMALY_TABLE_NAME] = rf_anomaly_table
+
+
+def get_unique_key(table):
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint):
+            return [column.name for column in constraint.columns]
+    return []
+
+
+def get_insert(conn, table):
+    # INSERT ... ON DUPLICATE KEY UPDATE on MySQL, INSERT ... ON CONFLICT DO UPDATE on SQLite and PostgreSQL
+    dialect = conn.dialect.name
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        raise ValueError('No upsert for %s' % dialect)
+    return insert(table)
+
+
+def upsert(conn, table, rows, batch_size=UPSERT_BATCH_SIZE):
+    # rows already stored (same unique key) are overwritten, the table never holds duplicates.
+    # One statement executed with many rows, SQLAlchemy and mysqlclient send it as multi-row INSERTs
+    key = get_unique_key(table)
+    stmt = get_insert(conn, table)
+    if conn.dialect.name == 'mysql':
+        stmt = stmt.on_duplicate_key_update({c.name: stmt.inserted[c.name] for c in table.columns
+                                             if c.name not in key})
+    else:
+        stmt = stmt.on_conflict_do_update(index_elements=key,
+                                          set_={c.name: stmt.excluded[c.name] for c in table.columns
+                                                if c.name not in key})
+    for i in range(0, len(rows), batch_size):
+        conn.execute(stmt, rows[i:i + batch_size])
+
+
+def get_columns(table, columns=None):
+    # host and start_ts are always read
+    if columns is None:
+        return list(table.columns)
+    return [c for c in table.columns if c.name in columns or c.name in ('host', 'start_ts')]
+
+
+def to_rows(stats, table):
+    # plain python values, the DB drivers do not bind numpy types
+    stats = stats[[c.name for c in table.columns]].astype(object)
+    return stats.where(pd.notna(stats), None).to_dict('records')
+
+
+############################################################################
+class SqlStatsStore:
+    """RF and Eth statistics in a SQL database (MySQL, or SQLite for local testing).
+
+    The tables have a unique key on (host, start_ts[, interface]) and are written with
+    batched upserts, so storing an interval twice leaves one row.
+    """
+
+    def __init__(self, engine, batch_size=UPSERT_BATCH_SIZE):
+        self.engine = engine
+        self.batch_size = batch_size
+
+    def has_unique_key(self, table_name):
+        inspector = inspect(self.engine)
+        return bool(inspector.get_unique_constraints(table_name) or
+                    [index for index in inspector.get_indexes(table_name) if index['unique']])
+
+    def migrate_table(self, table):
+        # tables created by DataFrame.to_sql() have no unique key and may hold duplicates:
+        # copy them into a keyed table, the upsert drops the duplicates on the way.
+        # MySQL commits every DDL statement, a migration that failed half way left <table>_old
+        # behind and is resumed from it; the upsert makes copying the rows again harmless
+        old_name = table.name + '_old'
+        print('Adding unique key (%s) to %s...' % (', '.join(get_unique_key(table)), table.name))
+        with self.engine.begin() as conn:
+            if inspect(conn).has_table(old_name):
+                print('Resuming from %s' % old_name)
+            else:
+                conn.execute(text('ALTER TABLE %s RENAME TO %s' % (table.name, old_name)))
+            table.create(conn, checkfirst=True)
+            for chunk in pd.read_sql(text('select * from %s' % old_name), conn, chunksize=10000,
+                                     parse_dates=['start_ts']):
+                upsert(conn, table, to_rows(chunk.dropna(subset=get_unique_key(table)), table), self.batch_size)
+            conn.execute(text('DROP TABLE %s' % old_name))
+
+    def create_tables(self):
+        inspector = inspect(self.engine)
+        new_watermarks = not inspector.has_table(WATERMARK_TABLE_NAME)
+        for table in metadata.sorted_tables:
+            if inspector.has_table(table.name + '_old') or \
+                    inspector.has_table(table.name) and not self.has_unique_key(table.name):
+                self.migrate_table(table)
+        metadata.create_all(self.engine)
+        # indexes added after the table was created
+        inspector = inspect(self.engine)
+        for table in metadata.sorted_tables:
+            names = [index['name'] for index in inspector.get_indexes(table.name)]
+            for index in table.indexes:
+                if index.name not in names:
+                    index.create(self.engine)
+
+        if new_watermarks:
+            # the first watermarks come from the data already stored
+            with self.engine.begin() as conn:
+                for table_name, table in TABLES.items():
+                    sql = select(table.c.host, func.max(table.c.start_ts).label('start_ts')).group_by(table.c.host)
+                    watermarks = pd.read_sql(sql, conn, parse_dates=['start_ts'])
+                    watermarks['table_name'] = table_name
+                    upsert(conn, watermark_table, to_rows(watermarks, watermark_table), self.batch_size)
+
+    def read_watermarks(self):
+        # {(table_name, host): last stored start_ts}
+        watermarks = pd.read_sql(select(watermark_table), self.engine, parse_dates=['start_ts'])
+        return {(w['table_name'], w['host']): w['start_ts'].to_pydatetime() for i, w in watermarks.iterrows()}
+
+    def write(self, table_name, stats):
+        # stats and the hosts' watermarks are stored in one transaction, a watermark never moves back
+        table = TABLES[table_name]
+        # a statement may not update the same row twice (ON CONFLICT)
+        stats = stats.drop_duplicates(subset=get_unique_key(table), keep='last')
+        current = self.read_watermarks()
+        watermarks = stats.groupby('host')['start_ts'].max().reset_index()
+        watermarks['table_name'] = table_name
+        watermarks = watermarks[[current.get((table_name, w['host'])) is None or w['start_ts'] > current[(table_name, w['host'])]
+                                 for i, w in watermarks.iterrows()]]
+        with self.engine.begin() as conn:
+            upsert(conn, table, to_rows(stats, table), self.batch_size)
+            upsert(conn, watermark_table, to_rows(watermarks, watermark_table), self.batch_size)
+
+    def get_hosts(self, table_name):
+        sql = select(watermark_table.c.host).where(watermark_table.c.table_name == table_name)
+        return sorted(pd.read_sql(sql, self.engine)['host'])
+
+    def read(self, table_name, hosts=None, start=None, end=None, columns=None):
+        # the filters and the column list go into the query, only the rows of the current view are sent
+        table = TABLES[table_name]
+        sql = select(*get_columns(table, columns))
+        if hosts is not None:
+            sql = sql.where(table.c.host.in_(list(hosts)))
+        if start is not None:
+            sql = sql.where(table.c.start_ts >= pd.Timestamp(start).to_pydatetime())
+        if end is not None:
+            sql = sql.where(table.c.start_ts <= pd.Timestamp(end).to_pydatetime())
+        return pd.read_sql(sql, self.engine, parse_dates=['start_ts'])
+
+
+############################################################################
+class ParquetStatsStore:
+    """RF and Eth statistics in Parquet files, partitioned by host and date.
+
+    root/<table>/host=<host>/date=<YYYY-MM-DD>/part-*.parquet. Every write appends one
+    file per partition it touches and read() keeps the last written row of every unique key,
+    so storing an interval twice reads as one row, like the SQL upserts. compact() merges
+    the files. read() only opens the files of the requested hosts and dates and only the
+    requested columns.
+    """
+
+    def __init__(self, root):
+        # optional dependency, only needed by this backend
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.root = root
+
+    def create_tables(self):
+        for table_name in TABLES:
+            os.makedirs(os.path.join(self.root, table_name), exist_ok=True)
+
+    def get_watermark_filename(self):
+        return os.path.join(self.root, WATERMARK_TABLE_NAME + '.parquet')
+
+    def write_file(self, data, filename):
+        # readers never see a half written file
+        tmp_filename = filename + '.tmp'
+        self.pq.write_table(self.pa.Table.from_pandas(data, preserve_index=False), tmp_filename)
+        os.replace(tmp_filename, filename)
+
+    def read_watermarks(self):
+        # {(table_name, host): last stored start_ts}
+        if not os.path.exists(self.get_watermark_filename()):
+            return {}
+        watermarks = self.pq.read_table(self.get_watermark_filename()).to_pandas()
+        return {(w['table_name'], w['host']): w['start_ts'].to_pydatetime() for i, w in watermarks.iterrows()}
+
+    def get_part_name(self):
+        # the names sort in write order, the last of duplicate rows is the one written last
+        now = time.time()
+        return 'part-%s%06d-%s.parquet' % (time.strftime('%Y%m%d%H%M%S', time.localtime(now)),
+                                           int(now % 1 * 1000000), uuid.uuid4().hex[:8])
+
+    def write(self, table_name, stats):
+        part = self.get_part_name()
+        stats = stats[[c.name for c in TABLES[table_name].columns]]
+        for (host, date), data in stats.groupby([stats['host'], stats['start_ts'].dt.strftime('%Y-%m-%d')]):
+            path = self.get_partition_path(table_name, host, date)
+            os.makedirs(path, exist_ok=True)
+            self.write_file(data, os.path.join(path, part))
+
+        watermarks = self.read_watermarks()
+        for host, start_ts in stats.groupby('host')['start_ts'].max().items():
+            if watermarks.get((table_name, host)) is None or start_ts > watermarks[(table_name, host)]:
+                watermarks[(table_name, host)] = start_ts
+        self.write_file(pd.DataFrame([(t, h, ts) for (t, h), ts in watermarks.items()],
+                                     columns=['table_name', 'host', 'start_ts']), self.get_watermark_filename())
+
+    def get_partition_path(self, table_name, host, date):
+        return os.path.join(self.root, table_name, 'host=%s' % host, 'date=%s' % date)
+
+    def get_hosts(self, table_name):
+        path = os.path.join(self.root, table_name)
+        if not os.path.isdir(path):
+            return []
+        return sorted(name[len('host='):] for name in os.listdir(path) if name.startswith('host='))
+
+    def get_files(self, table_name, hosts=None, start=None, end=None):
+        # partition pruning: only the directories of the hosts and dates asked for are listed
+        start_date = pd.Timestamp(start).strftime('%Y-%m-%d') if start is not None else None
+        end_date = pd.Timestamp(end).strftime('%Y-%m-%d') if end is not None else None
+        files = []
+        for host in (hosts if hosts is not None else self.get_hosts(table_name)):
+            host_path = os.path.join(self.root, table_name, 'host=%s' % host)
+            if not os.path.isdir(host_path):
+                continue
+            for name in sorted(os.listdir(host_path)):
+                date = name[len('date='):]
+                if (start_date and date < start_date) or (end_date and date > end_date):
+                    continue
+                files += sorted(glob.glob(os.path.join(host_path, name, 'part-*.parquet')))
+        return files
+
+    def read(self, table_name, hosts=None, start=None, end=None, columns=None):
+        import pyarrow.dataset as ds
+
+        key = get_unique_key(TABLES[table_name])
+        columns = [c.name for c in get_columns(TABLES[table_name], columns)]
+        files = self.get_files(table_name, hosts, start, end)
+        if not files:
+            return pd.DataFrame(columns=columns)
+
+        dataset = ds.dataset(files, format='parquet')
+        condition = None
+        if start is not None:
+            condition = ds.field('start_ts') >= pd.Timestamp(start)
+        if end is not None:
+            end_condition = ds.field('start_ts') <= pd.Timestamp(end)
+            condition = end_condition if condition is None else condition & end_condition
+        # the key columns are read for the duplicates, the files are scanned in write order
+        data = dataset.to_table(columns=columns + [c for c in key if c not in columns], filter=condition).to_pandas()
+        data = data.drop_duplicates(subset=key, keep='last')
+        return data[columns].reset_index(drop=True)
+
+    def compact(self, table_name, hosts=None):
+        # one file per partition, duplicates of the unique key dropped (the last written wins)
+        key = get_unique_key(TABLES[table_name])
+        partitions = collections.defaultdict(list)
+        for filename in self.get_files(table_name, hosts):
+            partitions[os.path.dirname(filename)].append(filename)
+
+        n_files = 0
+        for path, files in partitions.items():
+            if len(files) < 2:
+                continue
+            data = pd.concat([self.pq.read_table(filename).to_pandas() for filename in files])
+            data = data.drop_duplicates(subset=key, keep='last').sort_values('start_ts')
+            self.write_file(data, os.path.join(path, self.get_part_name()))
+            for filename in files:
+                os.remove(filename)
+            n_files += len(files)
+        print('%s: %d files compacted into %d' % (table_name, n_files, len([f for f in partitions.values() if len(f) > 1])))
+
+
+def open_stats_store(name='levitan'):
+    # parquet:<directory> or a db_wrapper.get_db() name
+    if name.startswith('parquet:'):
+        return ParquetStatsStore(name[len('parquet:'):])
+    from db_wrapper import get_db
+    return SqlStatsStore(get_db(name).engine)
+
+
+##############################################################################
+##############################################################################
+if __name__ == '__main__':
+    # python stats_store.py compact parquet:<directory> [host ...]
+    if len(sys.argv) > 2 and sys.argv[1] == 'compact':
+        store = open_stats_store(sys.argv[2])
+        for table_name in TABLES:
+            store.compact(table_name, sys.argv[3:] or None)
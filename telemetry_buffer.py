@@ -0,0 +1,127 @@
+# Live RF telemetry in memory: a fixed size NumPy ring buffer per host and metric, read without touching a database
+import threading
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# samples kept per host and metric, an hour at 1 Hz
+TELEMETRY_CAPACITY = 3600
+
+
+class RingBuffer:
+    """Time stamps and values of the last `capacity` samples of one metric.
+
+    Every sample is written twice, at i and i + capacity, so the last n samples are always one
+    contiguous slice: append() is O(1) and view() returns NumPy views, no copy. A view shows
+    the data at the time of the call; it is overwritten after `capacity` more appends.
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity or TELEMETRY_CAPACITY
+        self.ts = np.zeros(2 * self.capacity)
+        self.values = np.full(2 * self.capacity, np.nan)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, ts, value):
+        i = self.count % self.capacity
+        self.ts[i] = self.ts[i + self.capacity] = ts
+        self.values[i] = self.values[i + self.capacity] = value
+        self.count += 1
+
+    def view(self, n=None):
+        # (ts, values) of the last n samples, oldest first
+        n = len(self) if n is None else min(n, len(self))
+        end = (self.count - 1) % self.capacity + 1 + self.capacity if self.count else self.capacity
+        return self.ts[end - n:end], self.values[end - n:end]
+
+    def window(self, seconds, now=None):
+        # (ts, values) of the samples of the last `seconds`
+        ts, values = self.view()
+        start = np.searchsorted(ts, (now or time.time()) - seconds)
+        return ts[start:], values[start:]
+
+    def last(self):
+        if not self.count:
+            return None, np.nan
+        i = (self.count - 1) % self.capacity
+        return self.ts[i], self.values[i]
+
+
+def rolling(values, n, stat='mean'):
+    # rolling min/max/mean over n samples, one value per full window (len(values) - n + 1), NaN aware
+    if len(values) < n:
+        return np.zeros(0)
+    if stat == 'mean':
+        valid = ~np.isnan(values)
+        sums = np.concatenate([[0], np.cumsum(np.where(valid, values, 0))])
+        counts = np.concatenate([[0], np.cumsum(valid)])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (sums[n:] - sums[:-n]) / (counts[n:] - counts[:-n])
+    windows = sliding_window_view(values, n)
+    with np.errstate(invalid='ignore'):
+        return np.nanmin(windows, axis=1) if stat == 'min' else np.nanmax(windows, axis=1)
+
+
+class TelemetryStore:
+    # {(host, metric): RingBuffer}, written by the samplers' threads and read by the dashboard and the alerts
+    def __init__(self, capacity=None):
+        self.capacity = capacity or TELEMETRY_CAPACITY
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    def append(self, host, metric, ts, value):
+        buffer = self.buffers.get((host, metric))
+        if buffer is None:
+            with self.lock:
+                buffer = self.buffers.setdefault((host, metric), RingBuffer(self.capacity))
+        buffer.append(ts, value)
+
+    def get(self, host, metric):
+        return self.buffers.get((host, metric))
+
+    def hosts(self, metric=None):
+        return sorted(set(host for host, m in list(self.buffers) if metric is None or m == metric))
+
+    def window(self, host, metric, seconds):
+        buffer = self.get(host, metric)
+        if buffer is None:
+            return np.zeros(0), np.zeros(0)
+        return buffer.window(seconds)
+
+    def summary(self, metric, seconds):
+        # {host: (last, min, max, mean, samples)} of the last `seconds`
+        summary = {}
+        for host in self.hosts(metric):
+            ts, values = self.window(host, metric, seconds)
+            valid = values[~np.isnan(values)]
+            if len(valid):
+                summary[host] = (self.get(host, metric).last()[1], valid.min(), valid.max(), valid.mean(), len(valid))
+        return summary
+
+
+class AlertRule:
+    # e.g. AlertRule('rssi', 'mean', '<', -70, 60): the 60 sec RSSI mean of a host below -70 dBm
+    STATS = {'last': 0, 'min': 1, 'max': 2, 'mean': 3}
+
+    def __init__(self, metric, stat, op, threshold, seconds):
+        self.metric = metric
+        self.stat = stat
+        self.op = op
+        self.threshold = threshold
+        self.seconds = seconds
+
+    def check(self, store):
+        # [(host, value)] of the hosts breaking the rule
+        alerts = []
+        for host, values in store.summary(self.metric, self.seconds).items():
+            value = values[self.STATS[self.stat]]
+            if (value < self.threshold) if self.op == '<' else (value > self.threshold):
+                alerts.append((host, value))
+        return alerts
+
+    def __str__(self):
+        return '%s %s %s %s over %d sec' % (self.metric, self.stat, self.op, self.threshold, self.seconds)
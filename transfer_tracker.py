@@ -0,0 +1,208 @@
+# Completion of the copy sw / copy script transfers, polled in the background over the unit's own session
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen  # ver. < 3.0
+
+from siklu_api import ShowSW, TIMEOUT
+
+# seconds between two polls of a unit, and the longest a transfer may take
+TRANSFER_POLL_SEC = 5
+TRANSFER_TIMEOUT_SEC = 1800
+# units polled at the same time
+TRANSFER_POLL_WORKERS = 8
+# words in the copy command's reply telling the transfer failed
+TRANSFER_ERRORS = ['error', 'fail', 'not found', 'unknown']
+
+
+def get_url(command):
+    for word in command.split():
+        if '://' in word:
+            return word
+    return ''
+
+
+def get_image_version(command):
+    # version in the image file name, e.g. .../sw-10.6.0.bin
+    r = re.search(r"(\d+\.\d+\.\d+(?:\.\d+)?)", get_url(command).split('/')[-1])
+    return r.groups()[0] if r else ''
+
+
+def get_url_size(url, timeout=10):
+    # bytes of an http(s) image from a HEAD request, None when it is not known
+    if not url.startswith('http'):
+        return None
+    try:
+        request = Request(url)
+        request.get_method = lambda: 'HEAD'
+        length = urlopen(request, timeout=timeout).headers.get('Content-Length')
+        return int(length) if length else None
+    except Exception as e:
+        print('%s: %s' % (url, e))
+        return None
+
+
+def get_banks(unit):
+    # {bank: (version, running)}
+    values = ShowSW(unit).parse()
+    names = [param.name for param in ShowSW.cmd_params]
+    banks = {}
+    for bank in ['b1', 'b2']:
+        banks[bank] = (values[names.index(bank + '_ver')], values[names.index(bank + '_running')])
+    return banks
+
+
+def get_standby_version(banks):
+    # the copied image goes to the bank that is not running
+    for version, running in banks.values():
+        if running != 'yes':
+            return version
+    return ''
+
+
+############################################################################
+class Transfer:
+    # one copy on one unit. The unit's session belongs to the tracker until the transfer is over
+    def __init__(self, unit, kind, command, size=None, callback=None):
+        self.unit = unit
+        self.kind = kind
+        self.command = command
+        self.url = get_url(command)
+        self.size = size
+        self.callback = callback
+        self.target_version = get_image_version(command) if kind == 'sw' else ''
+        self.old_version = ''
+        self.version = ''
+        # the copy command returns the prompt first, for sw the image then shows up in the standby bank
+        self.replied = False
+        self.status = 'copying'
+        self.error = ''
+        self.start = time.time()
+        self.end = None
+        self.next_poll = self.start
+        self.finished = threading.Event()
+
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def throughput(self):
+        # bytes per second, None without the image size
+        if not self.size or self.end is None:
+            return None
+        return self.size / max(self.duration(), 1e-3)
+
+    def wait(self, timeout=None):
+        self.finished.wait(timeout)
+        return self.status == 'done'
+
+    def poll(self):
+        connection = self.unit.connection
+        if not self.replied:
+            try:
+                connection.expect(self.unit.prompt2, timeout=0)
+            except TIMEOUT:
+                return
+            self.replied = True
+            reply = self.unit.decode(connection.before).lower()
+            error = [word for word in TRANSFER_ERRORS if word in reply]
+            if error:
+                return self.finish('failed', reply.strip().splitlines()[-1] if reply.strip() else error[0])
+            if self.kind != 'sw':
+                return self.finish('done')
+
+        self.version = get_standby_version(get_banks(self.unit))
+        if self.target_version:
+            if self.version == self.target_version:
+                self.finish('done')
+        elif self.version and self.version != self.old_version:
+            self.finish('done')
+
+    def finish(self, status, error=''):
+        self.end = time.time()
+        self.status = status
+        self.error = error
+        throughput = self.throughput()
+        print('[%s] copy %s %s in %.1f sec%s%s' % (self.unit.host, self.kind, status, self.duration(),
+                                                  ', %.2f MB/s' % (throughput / 1e6) if throughput else '',
+                                                  ': ' + error if error else ''))
+        self.finished.set()
+        if self.callback:
+            self.callback(self)
+
+    def __str__(self):
+        throughput = self.throughput()
+        return ','.join(str(x) for x in [self.unit.host, self.kind, self.status, '%.1f' % self.duration(),
+                                         self.size or '', '%.0f' % throughput if throughput else '', self.version,
+                                         self.error.replace(',', ';')])
+
+
+class TransferTracker:
+    """Watches the copies started with track() until the image is in place.
+
+    A single background thread polls the due transfers (TRANSFER_POLL_WORKERS at a time): first
+    for the prompt of the copy command, then, for a SW image, `show sw` until the standby bank
+    holds the new version. The transfer's callback fires and its wait() returns as soon as it
+    is over, there is no fixed delay before run_sw.
+    """
+
+    def __init__(self, poll_interval=None, timeout=None, workers=None):
+        self.poll_interval = poll_interval or TRANSFER_POLL_SEC
+        self.timeout = timeout or TRANSFER_TIMEOUT_SEC
+        self.transfers = []
+        self.done = []
+        self.sizes = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers or TRANSFER_POLL_WORKERS)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_size(self, url):
+        # every unit pulls the same image, one HEAD request per url
+        with self.lock:
+            if url not in self.sizes:
+                self.sizes[url] = get_url_size(url)
+            return self.sizes[url]
+
+    def track(self, unit, kind, command, callback=None):
+        # sends the copy command on the connected unit and returns its Transfer
+        transfer = Transfer(unit, kind, command, self.get_size(get_url(command)), callback)
+        if kind == 'sw':
+            transfer.old_version = get_standby_version(get_banks(unit))
+        unit.send_command(command, no_wait=True)
+        transfer.start = transfer.next_poll = time.time()
+        with self.lock:
+            self.transfers.append(transfer)
+        return transfer
+
+    def poll(self, transfer):
+        try:
+            if time.time() - transfer.start > self.timeout:
+                transfer.finish('timeout', 'Not done after %d sec' % self.timeout)
+            else:
+                transfer.poll()
+        except Exception as e:
+            transfer.finish('failed', str(e).splitlines()[0] if str(e) else repr(e))
+        transfer.next_poll = time.time() + self.poll_interval
+
+    def run(self):
+        while not self.stopped.is_set():
+            now = time.time()
+            with self.lock:
+                due = [transfer for transfer in self.transfers if transfer.next_poll <= now]
+            list(self.executor.map(self.poll, due))
+            with self.lock:
+                self.done += [transfer for transfer in self.transfers if transfer.finished.is_set()]
+                self.transfers = [transfer for transfer in self.transfers if not transfer.finished.is_set()]
+            self.stopped.wait(0.2)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.executor.shutdown()
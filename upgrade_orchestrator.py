@@ -0,0 +1,316 @@
+#!/usr/bin/python
+# Rolling SW upgrade: upload_sw -> run_sw -> reconnect and health check -> accept, unit by unit, in waves
+#   python upgrade_orchestrator.py [file.ini]
+# The units are the cfg.csv rows with an upload_sw command, e.g. "upload_sw sw http://10.0.0.1/sw-10.6.0.bin"
+# With FIRMWARE_DIR and FIRMWARE_URL the image is served from this box, see firmware_server.py
+import collections
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse  # ver. < 3.0
+
+import firmware_server
+import siklu_api
+import transfer_tracker
+from firmware_server import FirmwareServer
+from siklu_api import *
+from transfer_tracker import TransferTracker, get_image_version
+
+# canary units first, then percentages of the fleet, the last wave takes the rest
+UPGRADE_WAVES = '1,10%,100%'
+# units copying the image at the same time, and units between run_sw and accept at the same time
+MAX_COPIES = 20
+MAX_IN_FLIGHT = 10
+# reboot after run_sw, the unit is probed every RECONNECT_INTERVAL_SEC until HEALTH_TIMEOUT_SEC
+REBOOT_WAIT_SEC = 60
+RECONNECT_INTERVAL_SEC = 15
+HEALTH_TIMEOUT_SEC = 600
+# the unit rolls back by itself when it is not accepted within ACCEPT_TIMEOUT_SEC
+ACCEPT_TIMEOUT_SEC = 600
+# a wave with more failures than this stops the waves after it
+MAX_FAILURE_RATE = 0.1
+# required running version after the upgrade, empty: taken from the upload_sw file name
+TARGET_VERSION = ''
+
+UPGRADE_LOG_HEADER = 'time_stamp,host,command,command_status,wave,stage,old_version,new_version,' \
+                     'copy_sec,run_sec,reboot_sec,accept_sec,total_sec,copy_bytes,copy_bytes_per_sec,' \
+                     'served_bytes,serve_wait_sec,serve_sec,error\n'
+
+
+def load_upgrade_config(filename=None):
+    global UPGRADE_WAVES, MAX_COPIES, MAX_IN_FLIGHT, REBOOT_WAIT_SEC, HEALTH_TIMEOUT_SEC, \
+        ACCEPT_TIMEOUT_SEC, MAX_FAILURE_RATE, TARGET_VERSION
+
+    config = load_config(filename)
+    section = config['DEFAULT']
+    UPGRADE_WAVES = section.get('UPGRADE_WAVES', UPGRADE_WAVES)
+    MAX_COPIES = int(section.get('MAX_COPIES', MAX_COPIES))
+    MAX_IN_FLIGHT = int(section.get('MAX_IN_FLIGHT', MAX_IN_FLIGHT))
+    REBOOT_WAIT_SEC = float(section.get('REBOOT_WAIT_SEC', REBOOT_WAIT_SEC))
+    HEALTH_TIMEOUT_SEC = float(section.get('HEALTH_TIMEOUT_SEC', HEALTH_TIMEOUT_SEC))
+    ACCEPT_TIMEOUT_SEC = int(section.get('ACCEPT_TIMEOUT_SEC', ACCEPT_TIMEOUT_SEC))
+    MAX_FAILURE_RATE = float(section.get('MAX_FAILURE_RATE', MAX_FAILURE_RATE))
+    TARGET_VERSION = section.get('TARGET_VERSION', TARGET_VERSION)
+    transfer_tracker.TRANSFER_POLL_SEC = float(section.get('TRANSFER_POLL_SEC', transfer_tracker.TRANSFER_POLL_SEC))
+    transfer_tracker.TRANSFER_TIMEOUT_SEC = float(section.get('TRANSFER_TIMEOUT_SEC',
+                                                              transfer_tracker.TRANSFER_TIMEOUT_SEC))
+    firmware_server.FIRMWARE_DIR = section.get('FIRMWARE_DIR', firmware_server.FIRMWARE_DIR)
+    firmware_server.MAX_TRANSFERS = int(section.get('MAX_TRANSFERS', firmware_server.MAX_TRANSFERS))
+    firmware_server.MAX_BANDWIDTH_MBPS = float(section.get('MAX_BANDWIDTH_MBPS', firmware_server.MAX_BANDWIDTH_MBPS))
+    return config
+
+
+def get_waves(n_units, waves=None):
+    # '1,10%,100%' -> sizes of the waves, e.g. [1, 10, 89] for 100 units
+    sizes = []
+    left = n_units
+    for wave in (waves or UPGRADE_WAVES).split(','):
+        wave = wave.strip()
+        size = int(round(n_units * float(wave[:-1]) / 100.0)) if wave.endswith('%') else int(wave)
+        size = min(max(size, 1), left)
+        if size:
+            sizes.append(size)
+            left -= size
+    if left:
+        sizes.append(left)
+    return sizes
+
+
+def get_running_version(unit):
+    values = dict(zip([param.name for param in ShowSW.cmd_params], ShowSW(unit).parse()))
+    for bank in ['b1', 'b2']:
+        if values.get(bank + '_running') == 'yes':
+            return values[bank + '_ver']
+    return ''
+
+
+def is_rf_up(unit):
+    values = dict(zip([param.name for param in ShowRF.cmd_params], ShowRF(unit).parse()))
+    return values.get('rf_operational') == 'up'
+
+
+############################################################################
+class UnitUpgrade:
+    # one unit going through the stages, its timings end up in the upgrade log
+    def __init__(self, host, wave, tracker):
+        self.host = host
+        self.wave = wave
+        self.tracker = tracker
+        self.transfer = None
+        # the firmware server's record of the unit's download
+        self.served = None
+        self.unit = SikluUnit(host['ip'], host['user'], host['password'],
+                              connection_timeout=siklu_api.CONNECTION_TIMEOUT_SEC, debug=False,
+                              spawn_cmd=get_host_spawn_cmd(host['ip']))
+        self.command = host['command']
+        self.target_version = TARGET_VERSION or get_image_version(self.command)
+        self.stage = 'pending'
+        self.ok = False
+        self.error = ''
+        self.old_version = ''
+        self.new_version = ''
+        self.durations = collections.OrderedDict((stage, 0.0) for stage in ['copy', 'run', 'reboot', 'accept'])
+        self.copy_done = threading.Event()
+        self.start = time.time()
+
+    def fail(self, error):
+        self.error = error
+        print('[%s] %s failed: %s' % (self.unit.host, self.stage, error))
+        return False
+
+    def copy(self):
+        self.stage = 'copy'
+        start = time.time()
+        if not self.unit.connected:
+            self.unit.connect()
+        if not self.unit.connected:
+            return self.fail('No connection')
+        self.old_version = get_running_version(self.unit)
+        # run_sw follows the moment the image is in the standby bank
+        status = copy_sw_unit(self.unit, self.command, self.tracker, self.copied)
+        if not status[2]:
+            return self.fail(status[3])
+        self.copy_done.wait()
+        self.durations['copy'] = time.time() - start
+        if self.transfer.status != 'done':
+            return self.fail('Copy %s: %s' % (self.transfer.status, self.transfer.error))
+        return True
+
+    def copied(self, transfer):
+        self.transfer = transfer
+        self.copy_done.set()
+
+    def run(self):
+        self.stage = 'run'
+        start = time.time()
+        if not self.unit.connected:
+            self.unit.connect()
+        if not self.unit.connected:
+            return self.fail('No connection')
+        status = run_sw_unit(self.unit, accept_timeout=ACCEPT_TIMEOUT_SEC, rollback_timeout=ACCEPT_TIMEOUT_SEC)
+        # the unit reboots, the session is gone
+        self.unit.connected = False
+        self.unit.connection = None
+        self.durations['run'] = time.time() - start
+        if not status[2]:
+            return self.fail(status[3])
+        return True
+
+    def reboot(self):
+        self.stage = 'reboot'
+        start = time.time()
+        time.sleep(REBOOT_WAIT_SEC)
+        while time.time() - start < HEALTH_TIMEOUT_SEC:
+            self.unit.connect()
+            if self.unit.connected:
+                try:
+                    self.new_version = get_running_version(self.unit)
+                    if self.new_version and self.new_version != self.old_version and is_rf_up(self.unit) and \
+                            (not self.target_version or self.new_version == self.target_version):
+                        self.durations['reboot'] = time.time() - start
+                        return True
+                except Exception as e:
+                    print('[%s] Health check: %s' % (self.unit.host, e))
+                    self.unit.connected = False
+                    self.unit.connection = None
+            time.sleep(RECONNECT_INTERVAL_SEC)
+        self.durations['reboot'] = time.time() - start
+        return self.fail('Not healthy after %d sec, running %s' % (HEALTH_TIMEOUT_SEC, self.new_version))
+
+    def accept(self):
+        self.stage = 'accept'
+        start = time.time()
+        status = accept_unit(self.unit)
+        self.durations['accept'] = time.time() - start
+        if not status[2]:
+            return self.fail(status[3])
+        self.stage = 'done'
+        self.ok = True
+        return True
+
+    def __str__(self):
+        ts = time.strftime('%d-%m-%Y %H:%M:%S', time.localtime())
+        values = [ts, self.unit.host, 'upgrade', self.ok, self.wave, self.stage, self.old_version, self.new_version] + \
+                 ['%.1f' % d for d in self.durations.values()] + \
+                 ['%.1f' % (time.time() - self.start)] + \
+                 (str(self.transfer).split(',')[4:6] if self.transfer else ['', '']) + \
+                 ([self.served['bytes'], '%.1f' % self.served['wait_sec'], '%.1f' % self.served['send_sec']]
+                  if self.served else ['', '', '']) + \
+                 [self.error.replace(',', ';')]
+        return ','.join(str(x) for x in values)
+
+
+class UpgradeOrchestrator:
+    """Drives every unit through copy -> run_sw -> reboot/health check -> accept on its own.
+
+    Copies are only limited by max_copies, they do not disturb the running SW. run_sw of a
+    unit waits for its wave's gate, which opens once the previous wave completed without
+    too many failures, and for a free in-flight slot. A unit moves on as soon as its own
+    previous stage is over, there is no fleet-wide barrier between the stages.
+    """
+
+    def __init__(self, hosts, waves=None, max_copies=None, max_in_flight=None, tracker=None, server=None):
+        self.max_copies = max_copies or MAX_COPIES
+        self.max_in_flight = max_in_flight or MAX_IN_FLIGHT
+        self.copies = threading.Semaphore(self.max_copies)
+        self.in_flight = threading.Semaphore(self.max_in_flight)
+
+        self.wave_sizes = get_waves(len(hosts), waves)
+        # a tracker of our own is stopped at the end of run()
+        self.own_tracker = tracker is None
+        self.tracker = tracker or TransferTracker()
+        self.server = server
+        self.upgrades = []
+        wave_of = []
+        for wave, size in enumerate(self.wave_sizes):
+            wave_of += [wave] * size
+        for (i, host), wave in zip(hosts.iterrows(), wave_of):
+            self.upgrades.append(UnitUpgrade(host, wave, self.tracker))
+
+        self.gates = [threading.Event() for size in self.wave_sizes]
+        self.gates[0].set()
+        self.remaining = list(self.wave_sizes)
+        self.failed = [0] * len(self.wave_sizes)
+        self.halted = False
+        self.lock = threading.Lock()
+
+    def upgrade_unit(self, upgrade):
+        try:
+            with self.copies:
+                ok = upgrade.copy()
+            if self.server:
+                upgrade.served = self.server.get_stats(upgrade.unit.host)
+            if ok:
+                self.gates[upgrade.wave].wait()
+                if self.halted:
+                    upgrade.fail('Halted after wave %d' % (upgrade.wave - 1))
+                else:
+                    with self.in_flight:
+                        upgrade.run() and upgrade.reboot() and upgrade.accept()
+        except Exception as e:
+            upgrade.fail(str(e).splitlines()[0] if str(e) else repr(e))
+        self.unit_done(upgrade)
+        return upgrade
+
+    def unit_done(self, upgrade):
+        with self.lock:
+            wave = upgrade.wave
+            self.remaining[wave] -= 1
+            if not upgrade.ok:
+                self.failed[wave] += 1
+            if self.remaining[wave] == 0 and wave + 1 < len(self.gates):
+                if self.failed[wave] > MAX_FAILURE_RATE * self.wave_sizes[wave]:
+                    print('Wave %d: %d of %d units failed, stopping' % (wave, self.failed[wave], self.wave_sizes[wave]))
+                    self.halted = True
+                    # the waiting units report the halt and finish
+                    for gate in self.gates[wave + 1:]:
+                        gate.set()
+                else:
+                    print('Wave %d done, %d failed' % (wave, self.failed[wave]))
+                    self.gates[wave + 1].set()
+
+    def run(self, progress_callback=None):
+        filename = get_execution_log_filename().replace('execution_log', 'upgrade_log')
+        log = ExecutionLogWriter(filename, UPGRADE_LOG_HEADER)
+        progress = ScanProgress(len(self.upgrades), self.max_in_flight)
+        print('Waves: %s' % ', '.join(str(size) for size in self.wave_sizes))
+        # the image is served from here, on the port of FIRMWARE_URL
+        own_server = self.server is None and firmware_server.FIRMWARE_DIR and siklu_api.FIRMWARE_URL
+        if own_server:
+            self.server = FirmwareServer(port=urlparse(siklu_api.FIRMWARE_URL).port or 80).start()
+
+        # enough threads for every unit copying plus every unit in flight, in wave order
+        executor = ThreadPoolExecutor(max_workers=max(self.max_copies + self.max_in_flight, 1))
+        try:
+            futures = [executor.submit(self.upgrade_unit, upgrade) for upgrade in self.upgrades]
+            for future in as_completed(futures):
+                line = str(future.result())
+                log.write(line)
+                progress.update(line)
+                if progress_callback:
+                    progress_callback(progress)
+        finally:
+            executor.shutdown()
+            if self.own_tracker:
+                self.tracker.stop()
+            if own_server:
+                self.server.stop()
+                self.server = None
+            log.close()
+        return filename
+
+
+##############################################################################
+##############################################################################
+if __name__ == '__main__':
+    load_upgrade_config(sys.argv[1] if len(sys.argv) > 1 else None)
+
+    hosts = pd.read_csv(siklu_api.CSV_FILENAME, comment='#')
+    hosts.dropna(subset=['ip', 'user', 'command'], how='any', inplace=True)
+    hosts = hosts[hosts['command'].str.startswith('upload_sw')]
+    print(UpgradeOrchestrator(hosts).run(print_progress))